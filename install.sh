@@ -23,10 +23,25 @@ RUN_EPI=/var/run/epipyweb
 SHARE_EPI=/usr/share/epipyweb
 
 mkdir -p $VAR_EPI
+mkdir -p $VAR_EPI/profile
 mkdir -p $RUN_EPI
 mkdir -p $SHARE_EPI
 
 chown www-data.www-data $RUN_EPI
+chown www-data.www-data $VAR_EPI/profile
+
+#  The web back-end writes forwarded records to the database when ingest
+#  is enabled, so it shares the database, and the journal files SQLite
+#  creates beside it, with the recorder through the www-data group
+touch $VAR_EPI/dns.db
+chgrp www-data $VAR_EPI $VAR_EPI/dns.db
+chmod g+ws $VAR_EPI
+chmod g+w $VAR_EPI/dns.db
+
+#  Shared tokens for forwarding, readable by the web back-end
+mkdir -p /etc/epipyweb
+chgrp www-data /etc/epipyweb
+chmod 750 /etc/epipyweb
 
 cp -r record serve ui uwsgi.sh $SHARE_EPI
 
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import argparse
+import sys
+
+import epipytrie
+
+from typing import *
+
+
+def parse_list_argument(
+        argument: str) -> Tuple[str, str]:
+
+    'Split a category=path argument'
+
+    (category, separator, path) = argument.partition('=')
+    if not separator or not category or '\n' in category:
+        raise argparse.ArgumentTypeError(
+            'expected category=path, not ' + argument)
+
+    return (category, path)
+
+
+def parse_cmdline() -> argparse.Namespace:
+
+    'Parse the commandline, collecting the category lists to compile'
+
+    parser = argparse.ArgumentParser(
+        description='Compile domain lists into the epipyweb category trie')
+
+    parser.add_argument(
+        'lists', metavar='category=path', nargs='+',
+        type=parse_list_argument,
+        help='a list of domains, or a hosts file, and its category,' +
+        ' with earlier lists taking precedence')
+    parser.add_argument(
+        '--output', default=epipytrie.CATEGORY_TRIE_PATH,
+        help='path of the trie file to write')
+
+    return parser.parse_args()
+
+
+def main() -> None:
+
+    'Compile the given domain lists, replacing the trie file'
+
+    args = parse_cmdline()
+
+    categories = cast(List[Tuple[str, Iterable[str]]], [])
+    for (category, path) in args.lists:
+        with open(path) as list_file:
+            domains = list(epipytrie.parse_domain_list(list_file))
+
+        sys.stdout.write('{}: {} domains\n'.format(category, len(domains)))
+        categories.append((category, domains))
+
+    epipytrie.write_trie(args.output, epipytrie.build_trie(categories))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,628 @@
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''Archive files holding the query groups and DNS queries of a single
+day, moved out of the database when it is rotated.
+
+Each file is LZMA compressed JSON, with the groups and the queries each
+stored as parallel arrays of column values.  Ids and times are delta
+encoded, and hosts, domain names and categories are dictionary encoded,
+so that the repetition in a day of queries compresses well.  Times are
+kept to the second, as they are recorded.'''
+
+import array
+import calendar
+import collections
+import contextlib
+import datetime
+import itertools
+import json
+import lzma
+import os
+import re
+import sqlite3
+
+import epipydb
+
+from typing import *
+
+
+ARCHIVE_DIR = '/var/lib/epipyweb/archive'
+ARCHIVE_RETENTION_DAYS = 365
+ARCHIVE_VERSION = 1
+ARCHIVE_MAX_DAYS_READ = 31
+ARCHIVE_CACHE_DAYS = 2
+
+ARCHIVE_FILENAME = re.compile(r'^dns-([0-9]{4}-[0-9]{2}-[0-9]{2})\.json\.xz$')
+
+GROUP_COLUMNS = [
+    ('id', 'delta'),
+    ('start_time', 'delta_time'),
+    ('end_time', 'delta_time'),
+    ('host', 'dictionary'),
+    ('first_value', 'dictionary'),
+    ('query_count', 'plain'),
+    ('category', 'dictionary'),
+]
+
+QUERY_COLUMNS = [
+    ('id', 'delta'),
+    ('group_id', 'delta'),
+    ('time', 'delta_time'),
+    ('last_time', 'delta_time'),
+    ('type', 'dictionary'),
+    ('value', 'dictionary'),
+    ('host', 'dictionary'),
+    ('host_ip', 'dictionary'),
+    ('repeat_count', 'plain'),
+    ('category', 'dictionary'),
+]
+
+#  The columns of the queries returned with a page of groups
+PAGE_QUERY_COLUMNS = [
+    (column, encoding) for (column, encoding) in QUERY_COLUMNS
+    if column in ['id', 'value', 'time', 'repeat_count', 'last_time']
+]
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def archive_path(
+        day: datetime.date,
+        archive_dir: str = ARCHIVE_DIR) -> str:
+
+    'The path of the archive file for a day'
+
+    return os.path.join(
+        archive_dir, 'dns-' + day.isoformat() + '.json.xz')
+
+
+def list_archive_days(
+        archive_dir: str = ARCHIVE_DIR) -> List[datetime.date]:
+
+    'List the days with archive files, oldest first'
+
+    try:
+        filenames = os.listdir(archive_dir)
+    except FileNotFoundError:
+        return []
+
+    days = []
+    for filename in filenames:
+        match = ARCHIVE_FILENAME.match(filename)
+        if match:
+            with contextlib.suppress(ValueError):
+                days.append(datetime.datetime.strptime(
+                    match.group(1), '%Y-%m-%d').date())
+
+    return sorted(days)
+
+
+def encode_columns(
+        rows: List[Dict],
+        columns: List[Tuple[str, str]]) -> Dict:
+
+    'Encode a list of rows as parallel arrays of column values'
+
+    table = cast(Dict, {
+        'length': len(rows),
+    })
+
+    for (column, encoding) in columns:
+        values = [row[column] for row in rows]
+
+        if encoding == 'delta_time':
+            values = [isotime_to_seconds(value) for value in values]
+
+        if encoding in ['delta', 'delta_time']:
+            deltas = []
+            previous = 0
+            for value in values:
+                deltas.append(value - previous)
+                previous = value
+            values = deltas
+        elif encoding == 'dictionary':
+            dictionary = cast(List[Any], [])
+            dictionary_index = cast(Dict[Any, int], {})
+            for value in values:
+                if value not in dictionary_index:
+                    dictionary_index[value] = len(dictionary)
+                    dictionary.append(value)
+            table[column + '_dictionary'] = dictionary
+            values = [dictionary_index[value] for value in values]
+
+        table[column] = values
+
+    return table
+
+
+def isotime_to_seconds(
+        isotime: str) -> int:
+
+    'Convert a time in ISO 8601 format to seconds since the epoch'
+
+    return calendar.timegm(epipydb.isotime_to_datetime(isotime).timetuple())
+
+
+def seconds_to_isotime(
+        seconds: int) -> str:
+
+    'Convert seconds since the epoch to a time in ISO 8601 format'
+
+    return (EPOCH + datetime.timedelta(seconds=seconds)).isoformat()
+
+
+def decode_table(
+        table: Dict,
+        columns: List[Tuple[str, str]]) -> Dict:
+
+    '''Undo the delta encoding of the columns of a table, keeping the
+    values as arrays of integers, with times in seconds since the epoch
+    and dictionary encoded values as indexes into their dictionaries,
+    so that rows are decoded only when needed'''
+
+    decoded = {
+        'length': table['length'],
+    }
+
+    for (column, encoding) in columns:
+        values = table[column]
+
+        if encoding in ['delta', 'delta_time']:
+            values = array.array('q', itertools.accumulate(values))
+        elif encoding == 'dictionary':
+            values = array.array('q', values)
+            decoded[column + '_dictionary'] = table[column + '_dictionary']
+
+        decoded[column] = values
+
+    return decoded
+
+
+def decode_row(
+        table: Dict,
+        columns: List[Tuple[str, str]],
+        index: int) -> Dict:
+
+    'Decode the given columns of a row of a table from decode_table'
+
+    row = {}
+    for (column, encoding) in columns:
+        value = table[column][index]
+
+        if encoding == 'delta_time':
+            value = seconds_to_isotime(value)
+        elif encoding == 'dictionary':
+            value = table[column + '_dictionary'][value]
+
+        row[column] = value
+
+    return row
+
+
+def decode_rows(
+        table: Dict,
+        columns: List[Tuple[str, str]]) -> List[Dict]:
+
+    'Decode every row of a table from decode_table'
+
+    return [
+        decode_row(table, columns, index)
+        for index in range(table['length'])]
+
+
+def read_archive_tables(
+        path: str) -> Tuple[Dict, Dict]:
+
+    '''Read the query groups and DNS queries from an archive file, as
+    tables from decode_table'''
+
+    with lzma.open(path, 'rt', encoding='utf-8') as archive_file:
+        archive = json.load(archive_file)
+
+    if archive.get('version') != ARCHIVE_VERSION:
+        raise ValueError(path)
+
+    return (
+        decode_table(archive['groups'], GROUP_COLUMNS),
+        decode_table(archive['queries'], QUERY_COLUMNS))
+
+
+def read_archive(
+        path: str) -> Tuple[List[Dict], List[Dict]]:
+
+    'Read the query groups and DNS queries from an archive file'
+
+    (groups, queries) = read_archive_tables(path)
+
+    return (
+        decode_rows(groups, GROUP_COLUMNS),
+        decode_rows(queries, QUERY_COLUMNS))
+
+
+def write_archive(
+        path: str,
+        groups: List[Dict],
+        queries: List[Dict]) -> None:
+
+    '''Write an archive file, merging with the groups and queries already
+    archived for the same day, if any, and replacing it at once so that
+    the web back-end never reads a partly written file'''
+
+    if os.path.exists(path):
+        (old_groups, old_queries) = read_archive(path)
+        groups = list({
+            group['id']: group for group in old_groups + groups}.values())
+        queries = list({
+            query['id']: query for query in old_queries + queries}.values())
+
+    groups.sort(key=lambda group: cast(int, group['id']))
+    queries.sort(key=lambda query: cast(int, query['id']))
+
+    archive = {
+        'version': ARCHIVE_VERSION,
+        'groups': encode_columns(groups, GROUP_COLUMNS),
+        'queries': encode_columns(queries, QUERY_COLUMNS),
+    }
+
+    temp_path = path + '.tmp'
+    with lzma.open(temp_path, 'wt', encoding='utf-8') as archive_file:
+        json.dump(archive, archive_file, separators=(',', ':'))
+    os.rename(temp_path, path)
+
+
+def archive_day(
+        db: sqlite3.Connection,
+        day: datetime.date,
+        end_iso: str,
+        archive_dir: str) -> int:
+
+    '''Archive the query groups starting on a day, before a given time,
+    with all their queries.  Returns the number of groups archived.'''
+
+    start_iso = datetime.datetime.combine(
+        day, datetime.time()).isoformat()
+    end_iso = min(end_iso, datetime.datetime.combine(
+        day + datetime.timedelta(days=1), datetime.time()).isoformat())
+
+    with contextlib.closing(db.cursor()) as cursor:
+        cursor.execute(
+            'SELECT id, start_time, COALESCE(end_time, start_time),' +
+            '     host, first_value, query_count, category' +
+            ' FROM querygroup' +
+            ' WHERE start_time >= ? AND start_time < ?',
+            (start_iso, end_iso))
+        groups = [
+            dict(zip([column for (column, _) in GROUP_COLUMNS], row))
+            for row in cursor.fetchall()]
+
+        if not groups:
+            return 0
+
+        group_ids = set(group['id'] for group in groups)
+        cursor.execute(
+            'SELECT id, group_id, time, COALESCE(last_time, time),' +
+            '     type, value, host, host_ip, repeat_count, category' +
+            ' FROM dnsquery' +
+            ' WHERE group_id BETWEEN ? AND ?',
+            (min(group_ids), max(group_ids)))
+        queries = [
+            dict(zip([column for (column, _) in QUERY_COLUMNS], row))
+            for row in cursor.fetchall() if row[1] in group_ids]
+
+    os.makedirs(archive_dir, exist_ok=True)
+    write_archive(archive_path(day, archive_dir), groups, queries)
+
+    return len(groups)
+
+
+def archive_before(
+        db: sqlite3.Connection,
+        archive_time: datetime.datetime,
+        archive_dir: str = ARCHIVE_DIR) -> int:
+
+    '''Archive the query groups starting before a time, one file per
+    day.  Returns the number of groups archived.'''
+
+    with contextlib.closing(db.cursor()) as cursor:
+        cursor.execute('SELECT MIN(start_time) FROM querygroup')
+        oldest = cursor.fetchone()[0]
+
+    if oldest is None:
+        return 0
+
+    archive_iso = archive_time.isoformat()
+    day = epipydb.isotime_to_datetime(oldest).date()
+    archived = 0
+    while datetime.datetime.combine(day, datetime.time()) < archive_time:
+        archived += archive_day(db, day, archive_iso, archive_dir)
+        day += datetime.timedelta(days=1)
+
+    return archived
+
+
+def prune_archive(
+        discard_day: datetime.date,
+        archive_dir: str = ARCHIVE_DIR) -> None:
+
+    'Delete the archive files of the days before a given day'
+
+    for day in list_archive_days(archive_dir):
+        if day < discard_day:
+            os.unlink(archive_path(day, archive_dir))
+
+
+class ArchiveCache:
+
+    '''The most recently read day files, as tables of column arrays from
+    decode_table, so that a page of the archive and then the queries of
+    its groups read each file only once, and the range of group ids in
+    every day file read, so that paging skips the days before or after
+    the page without reading them.  A file is read again once it has
+    been replaced.'''
+
+    def __init__(
+            self,
+            max_days: int = ARCHIVE_CACHE_DAYS) -> None:
+
+        self.max_days = max_days
+        self.days = cast(
+            OrderedDict[str, Tuple[Tuple[int, int], Dict, Dict]],
+            collections.OrderedDict())
+        self.id_ranges = cast(
+            Dict[str, Tuple[Tuple[int, int], int, int]], {})
+
+    def read(
+            self,
+            path: str) -> Tuple[Dict, Dict]:
+
+        'Read the query group and DNS query tables of a day file'
+
+        stat = os.stat(path)
+        version = (stat.st_ino, stat.st_mtime_ns)
+
+        cached = self.days.get(path)
+        if cached is not None and cached[0] == version:
+            self.days.move_to_end(path)
+            return (cached[1], cached[2])
+
+        (groups, queries) = read_archive_tables(path)
+        if groups['length']:
+            self.id_ranges[path] = (
+                version, min(groups['id']), max(groups['id']))
+
+        self.days[path] = (version, groups, queries)
+        self.days.move_to_end(path)
+        while len(self.days) > self.max_days:
+            self.days.popitem(last=False)
+
+        return (groups, queries)
+
+    def id_range(
+            self,
+            path: str) -> Optional[Tuple[int, int]]:
+
+        '''The lowest and highest group ids of a day file, if it has been
+        read since it was last replaced'''
+
+        id_range = self.id_ranges.get(path)
+        if id_range is None:
+            return None
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if id_range[0] != (stat.st_ino, stat.st_mtime_ns):
+            return None
+
+        return (id_range[1], id_range[2])
+
+
+def group_matches(
+        queries: Dict,
+        search_value: Optional[str],
+        category: Optional[str]) -> Optional[Set[int]]:
+
+    '''Find the groups with a query for a domain starting with the search
+    value, or any of its parent domains starting with it, as searched
+    for in the querydomain table, and with a query in the category, or
+    None if every group matches.
+
+    The search and category are matched against the dictionaries of
+    the query table, so that each distinct domain name is checked only
+    once, and then only the indexes of the queries are compared.'''
+
+    matching = cast(Optional[Set[int]], None)
+
+    if search_value:
+        search_value = search_value.lower()
+        value_indexes = set(
+            index for (index, value) in enumerate(queries['value_dictionary'])
+            if any(
+                domain.lower().startswith(search_value)
+                for domain in epipydb.list_domains(value)))
+        matching = set(
+            group_id for (group_id, value_index)
+            in zip(queries['group_id'], queries['value'])
+            if value_index in value_indexes)
+
+    if category:
+        categorized = cast(Set[int], set())
+        category_dictionary = queries['category_dictionary']
+        if category in category_dictionary:
+            category_index = category_dictionary.index(category)
+            categorized = set(
+                group_id for (group_id, query_category)
+                in zip(queries['group_id'], queries['category'])
+                if query_category == category_index)
+        if matching is None:
+            matching = categorized
+        else:
+            matching &= categorized
+
+    return matching
+
+
+def group_queries(
+        queries: Dict,
+        group_ids: Set[int]) -> Dict[int, List[Dict]]:
+
+    'Decode the queries of the given groups from a query table'
+
+    result = cast(Dict[int, List[Dict]], {})
+    if not group_ids:
+        return result
+
+    for (index, group_id) in enumerate(queries['group_id']):
+        if group_id in group_ids:
+            result.setdefault(group_id, []).append(
+                decode_row(queries, PAGE_QUERY_COLUMNS, index))
+
+    return result
+
+
+def archive_page(
+        search_value: Optional[str],
+        category: Optional[str],
+        since: Optional[str],
+        until: Optional[str],
+        before_id: Optional[int],
+        after_id: Optional[int],
+        count: int,
+        archive_dir: str = ARCHIVE_DIR,
+        cache: Optional[ArchiveCache] = None) -> Dict:
+
+    '''Search the archive for a page of query groups, in the same form
+    as a page from the database, with the queries of each group.
+
+    Only the files of the days between since and until are read, newest
+    first, or oldest first when paging with after_id, and no more files
+    are read once the page is full.  Days known from the cache to hold
+    only groups beyond before_id or after_id are skipped, and at most
+    ARCHIVE_MAX_DAYS_READ files are read for a page, after which the
+    page ends with the groups found so far.  Only the groups and
+    queries on the page are decoded from the column arrays of a day.'''
+
+    if count > 100:
+        count = 100
+
+    if cache is None:
+        cache = ArchiveCache()
+
+    days = list_archive_days(archive_dir)
+    if since is not None:
+        days = [day for day in days if day.isoformat() >= since[:10]]
+    if until is not None:
+        days = [day for day in days if day.isoformat() <= until[:10]]
+
+    since_seconds = None
+    if since is not None:
+        since_seconds = isotime_to_seconds(since)
+    until_seconds = None
+    if until is not None:
+        until_seconds = isotime_to_seconds(until)
+
+    reverse = after_id is not None
+    if not reverse:
+        days.reverse()
+
+    found = cast(List[Dict], [])
+    days_read = 0
+    more_days = False
+    for day in days:
+        if len(found) > count:
+            break
+
+        path = archive_path(day, archive_dir)
+        id_range = cache.id_range(path)
+        if id_range is not None:
+            if before_id is not None and id_range[0] >= before_id:
+                continue
+            if after_id is not None and id_range[1] <= after_id:
+                continue
+
+        if days_read >= ARCHIVE_MAX_DAYS_READ:
+            more_days = True
+            break
+        days_read += 1
+
+        try:
+            (groups, queries) = cache.read(path)
+        except (OSError, ValueError, EOFError, lzma.LZMAError):
+            continue
+
+        matching = group_matches(queries, search_value, category)
+
+        indexes = range(groups['length'])
+        if not reverse:
+            indexes = indexes[::-1]
+
+        day_found = cast(List[Dict], [])
+        for index in indexes:
+            if len(found) + len(day_found) > count:
+                break
+            group_id = groups['id'][index]
+            start_seconds = groups['start_time'][index]
+            if matching is not None and group_id not in matching:
+                continue
+            if before_id is not None and group_id >= before_id:
+                continue
+            if after_id is not None and group_id <= after_id:
+                continue
+            if since_seconds is not None and start_seconds < since_seconds:
+                continue
+            if until_seconds is not None and \
+                    start_seconds >= until_seconds:
+                continue
+
+            day_found.append(decode_row(groups, GROUP_COLUMNS, index))
+
+        queries_found = group_queries(
+            queries, set(group['id'] for group in day_found))
+        for group in day_found:
+            found.append({
+                'id': group['id'],
+                'query_count': group['query_count'],
+                'time': group['start_time'],
+                'host': group['host'],
+                'value': group['first_value'],
+                'category': group['category'],
+                'queries': queries_found.get(group['id'], []),
+            })
+
+    page_groups = found[:count]
+    if reverse:
+        page_groups.reverse()
+
+    #  Paging to a neighboring page is always possible from the page it
+    #  was reached from, and a page beyond is known of from the one
+    #  extra group searched for, or from days left unread
+    result = {
+        'groups': page_groups,
+        'next_page_present': after_id is not None,
+        'previous_page_present': before_id is not None,
+    }
+    if len(found) > count or (more_days and found):
+        if reverse:
+            result['previous_page_present'] = True
+        else:
+            result['next_page_present'] = True
+
+    return result
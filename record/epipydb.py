@@ -32,6 +32,36 @@ TEST_LOCK_FILENAME = '/var/lib/epipyweb/dns.test-lock'
 
 QUERY_GROUP_TIME_TOLERANCE = 60
 QUERY_GROUP_EXTENDED_TIME = 60 * 60
+QUERY_GROUP_MAX_QUERIES = 100
+
+
+#  Finds the category of a domain name, such as a CategoryTrie lookup
+CategoryLookup = Callable[[str], Optional[str]]
+
+#  The inode of the database file and the change counter in its header
+DatabaseSignature = Optional[Tuple[int, int]]
+
+#  The descriptor and inode of each database file opened to read its
+#  signature
+SIGNATURE_FILES = cast(Dict[str, Tuple[int, int]], {})
+
+
+class IngestSequenceError(Exception):
+
+    '''A forwarded batch with a sequence number below the last one applied
+    for its device, which is not a retry but a forwarder whose sequence
+    has gone backwards'''
+
+    def __init__(
+            self,
+            device: str,
+            sequence: int,
+            last_sequence: int) -> None:
+
+        super().__init__(
+            'batch {} from {} is below the last applied, {}'.format(
+                sequence, device, last_sequence))
+        self.last_sequence = last_sequence
 
 
 def syslog_time_to_datetime(
@@ -150,7 +180,7 @@ def log_dns_query_group(
             end_time = isotime_to_datetime(end_time_iso)
             querytime = isotime_to_datetime(querytime_iso)
 
-            if count < 100 and is_query_in_group(
+            if count < QUERY_GROUP_MAX_QUERIES and is_query_in_group(
                     db, group_id, querytime, queryvalue,
                     start_time, end_time):
                 return group_id
@@ -159,7 +189,7 @@ def log_dns_query_group(
             'INSERT INTO querygroup (start_time, end_time, host)' +
             ' VALUES (?,?,?)',
             (querytime_iso, querytime_iso, queryhost))
-        group_id = cursor.lastrowid
+        group_id = cast(int, cursor.lastrowid)
         return group_id
 
 
@@ -186,41 +216,95 @@ def find_hostname_from_ip(
             return ip_address
 
 
+def find_repeated_query(
+        db: sqlite3.Connection,
+        group_id: int,
+        querytype: str,
+        queryvalue: str) -> Optional[int]:
+
+    'Find an earlier query in a group with the same type and value'
+
+    with contextlib.closing(db.cursor()) as cursor:
+        cursor.execute(
+            'SELECT id FROM dnsquery' +
+            ' WHERE group_id = ? AND type = ? AND value = ?' +
+            ' ORDER BY id LIMIT 1',
+            (group_id, querytype, queryvalue))
+
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0]
+        else:
+            return None
+
+
+def update_query_group(
+        db: sqlite3.Connection,
+        group_id: int) -> None:
+
+    'Update the querygroup columns derived from its queries'
+
+    db.execute(
+        'UPDATE querygroup SET ' +
+        ' start_time=(SELECT MIN(time)' +
+        '     FROM dnsquery WHERE group_id = ?),' +
+        ' end_time=(SELECT MAX(COALESCE(last_time, time))' +
+        '     FROM dnsquery WHERE group_id = ?),' +
+        ' first_value=(SELECT value' +
+        '     FROM dnsquery WHERE group_id = ? ORDER BY id LIMIT 1),' +
+        ' query_count=(SELECT COUNT(id)' +
+        '     FROM dnsquery WHERE group_id = ?),' +
+        ' category=(SELECT category FROM dnsquery' +
+        '     WHERE group_id = ? AND category IS NOT NULL' +
+        '     ORDER BY id LIMIT 1)' +
+        ' WHERE id = ?',
+        (group_id, group_id, group_id, group_id, group_id, group_id))
+
+
 def log_dns_query(
         db: sqlite3.Connection,
-        querytime: str,
+        isotime: str,
         querytype: str,
         queryvalue: str,
-        address: str) -> None:
+        address: str,
+        coalesce: bool = False,
+        category: Optional[str] = None) -> int:
 
-    'Store the DNS query in the database'
+    '''Store the DNS query in the database, returning the id of its row.
 
-    isotime = syslog_time_to_datetime(querytime).isoformat()
+    If coalescing, a repeat of a query already in the group is counted
+    on the earlier query's row, rather than stored as a row of its own
+    with its own subdomains.  The category is that of the query value,
+    if it is listed in one.'''
 
     with contextlib.closing(db.cursor()) as cursor:
         hostname = find_hostname_from_ip(db, isotime, address)
         group_id = log_dns_query_group(db, isotime, queryvalue, hostname)
 
+        if coalesce:
+            repeated_id = find_repeated_query(
+                db, group_id, querytype, queryvalue)
+            if repeated_id is not None:
+                cursor.execute(
+                    'UPDATE dnsquery SET' +
+                    ' repeat_count=repeat_count + 1,' +
+                    ' time=MIN(time, ?),' +
+                    ' last_time=MAX(COALESCE(last_time, time), ?)' +
+                    ' WHERE id = ?',
+                    (isotime, isotime, repeated_id))
+                update_query_group(db, group_id)
+
+                return repeated_id
+
         cursor.execute(
             'INSERT INTO dnsquery' +
-            ' (group_id, time, type, value, host, host_ip)' +
-            ' VALUES (?,?,?,?,?,?)',
-            (group_id, isotime, querytype, queryvalue, hostname, address))
-        query_id = cursor.lastrowid
+            ' (group_id, time, type, value, host, host_ip, category)' +
+            ' VALUES (?,?,?,?,?,?,?)',
+            (group_id, isotime, querytype, queryvalue, hostname, address,
+                category))
+        query_id = cast(int, cursor.lastrowid)
 
-        #  Update derived querygroup columns
-        cursor.execute(
-            'UPDATE querygroup SET ' +
-            ' start_time=(SELECT MIN(time)' +
-            '     FROM dnsquery WHERE group_id = ?),' +
-            ' end_time=(SELECT MAX(time)' +
-            '     FROM dnsquery WHERE group_id = ?),' +
-            ' first_value=(SELECT value' +
-            '     FROM dnsquery WHERE group_id = ? ORDER BY id LIMIT 1),' +
-            ' query_count=(SELECT COUNT(id)' +
-            '     FROM dnsquery WHERE group_id = ?)' +
-            ' WHERE id = ?',
-            (group_id, group_id, group_id, group_id, group_id))
+        update_query_group(db, group_id)
 
         #  Associate the subdomains with the query
         for subdomain in list_domains(queryvalue):
@@ -230,18 +314,18 @@ def log_dns_query(
                 ' VALUES (?,?,?,?)',
                 querydomain)
 
+        return query_id
+
 
 def log_dhcp_assignment(
         db: sqlite3.Connection,
-        time: str,
+        isotime: str,
         ip_address: str,
         mac_address: str,
         hostname: str) -> None:
 
     'Record DHCP address assignment with a time and hostname'
 
-    isotime = syslog_time_to_datetime(time).isoformat()
-
     with contextlib.closing(db.cursor()) as cursor:
         cursor.execute(
             'INSERT INTO dhcpassignment' +
@@ -250,11 +334,11 @@ def log_dhcp_assignment(
             (ip_address, mac_address, hostname, isotime))
 
 
-def log_line(
-        db: sqlite3.Connection,
-        line: str) -> None:
+def parse_line(
+        line: str) -> Optional[Dict[str, str]]:
 
-    'Match the log line against DNS queries or DHCP allocations and log them'
+    '''Match the log line against DNS queries or DHCP allocations and
+    return the matching record, or None if the line is neither'''
 
     time_re = r'([A-Za-z]+ +[0-9]+ +[0-9:]+)'
     dnsmasq_re = r'dnsmasq\[[0-9]+\]'
@@ -269,11 +353,151 @@ def log_line(
 
     match = re.match(dns_query_re, line)
     if match:
-        log_dns_query(db, *match.groups())
+        (time, querytype, queryvalue, address) = match.groups()
+        return {
+            'record': 'dnsquery',
+            'time': syslog_time_to_datetime(time).isoformat(),
+            'type': querytype,
+            'value': queryvalue,
+            'address': address,
+        }
 
     match = re.match(dhcp_assignment_re, line)
     if match:
-        log_dhcp_assignment(db, *match.groups())
+        (time, ip_address, mac_address, hostname) = match.groups()
+        return {
+            'record': 'dhcpassignment',
+            'time': syslog_time_to_datetime(time).isoformat(),
+            'ip_address': ip_address,
+            'mac_address': mac_address,
+            'hostname': hostname,
+        }
+
+    return None
+
+
+def log_record(
+        db: sqlite3.Connection,
+        record: Dict[str, str],
+        namespace: Optional[str] = None,
+        coalesce: bool = False,
+        category_lookup: Optional[CategoryLookup] = None) -> Optional[int]:
+
+    '''Store a record parsed from a log line in the database, returning
+    the id of the DNS query row for DNS query records, coalescing
+    repeated queries if requested.  DNS queries are tagged with the
+    category found by the category lookup, if given.
+
+    If a namespace is given, hostnames and addresses are prefixed
+    with it, so that records forwarded from several devices don't
+    collide with each other.'''
+
+    prefix = ''
+    if namespace:
+        prefix = namespace + '/'
+
+    #  Validate the time, as forwarded records come from over the network
+    isotime = isotime_to_datetime(record['time']).isoformat()
+
+    if record['record'] == 'dnsquery':
+        category = None
+        if category_lookup:
+            category = category_lookup(record['value'])
+
+        return log_dns_query(
+            db, isotime, record['type'], record['value'],
+            prefix + record['address'], coalesce, category)
+    elif record['record'] == 'dhcpassignment':
+        log_dhcp_assignment(
+            db, isotime, prefix + record['ip_address'],
+            record['mac_address'], prefix + record['hostname'])
+        return None
+    else:
+        raise ValueError(record['record'])
+
+
+def log_line(
+        db: sqlite3.Connection,
+        line: str,
+        coalesce: bool = False,
+        category_lookup: Optional[CategoryLookup] = None) -> Optional[int]:
+
+    '''Match the log line against DNS queries or DHCP allocations and
+    log them, returning the id of the DNS query row, if any'''
+
+    record = parse_line(line)
+    if record:
+        return log_record(
+            db, record, coalesce=coalesce, category_lookup=category_lookup)
+
+    return None
+
+
+def last_ingest_sequence(
+        db: sqlite3.Connection,
+        device: str) -> int:
+
+    'Find the sequence number of the last batch ingested from a device'
+
+    with contextlib.closing(db.cursor()) as cursor:
+        cursor.execute(
+            'SELECT sequence FROM ingestsequence WHERE device = ?',
+            (device,))
+
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0]
+        else:
+            return 0
+
+
+def log_ingest_batch(
+        db: sqlite3.Connection,
+        device: str,
+        sequence: int,
+        records: List[Dict[str, str]],
+        category_lookup: Optional[CategoryLookup] = None) -> bool:
+
+    '''Store a batch of records forwarded from another device, using
+    the device name as the namespace for hosts.
+
+    Batches are applied at most once, in order.  A batch with the same
+    sequence number as the last one applied for the device is a retry,
+    and is ignored.  Returns true if the batch was applied.  A lower
+    sequence number means the forwarder's sequence was reset, and
+    raises IngestSequenceError rather than being silently ignored.'''
+
+    last_sequence = last_ingest_sequence(db, device)
+    if sequence == last_sequence:
+        return False
+    if sequence < last_sequence:
+        raise IngestSequenceError(device, sequence, last_sequence)
+
+    for record in records:
+        log_record(db, record, device, category_lookup=category_lookup)
+
+    db.execute(
+        'INSERT OR REPLACE INTO ingestsequence (device, sequence)' +
+        ' VALUES (?,?)',
+        (device, sequence))
+
+    return True
+
+
+def add_column(
+        db: sqlite3.Connection,
+        table: str,
+        column_definition: str) -> None:
+
+    'Add a column to a table created by an earlier version, if missing'
+
+    with contextlib.closing(db.cursor()) as cursor:
+        cursor.execute('PRAGMA table_info(' + table + ')')
+        columns = [row[1] for row in cursor.fetchall()]
+
+    if column_definition.split()[0] not in columns:
+        db.execute(
+            'ALTER TABLE ' + table + ' ADD COLUMN ' + column_definition)
 
 
 def create_tables(
@@ -285,17 +509,34 @@ def create_tables(
         'CREATE TABLE IF NOT EXISTS querygroup' +
         ' (id INTEGER PRIMARY KEY, host, start_time, end_time,' +
         '     first_value, query_count INTEGER)')
+    add_column(db, 'querygroup', 'category')
+    db.execute('DROP INDEX IF EXISTS querygroup_end_time')
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS querygroup_host_end_time ON querygroup' +
+        ' (host, end_time)')
     db.execute(
-        'CREATE INDEX IF NOT EXISTS querygroup_end_time ON querygroup' +
-        ' (end_time, host)')
+        'CREATE INDEX IF NOT EXISTS querygroup_start_time ON querygroup' +
+        ' (start_time)')
 
     db.execute(
         'CREATE TABLE IF NOT EXISTS dnsquery' +
         ' (id INTEGER PRIMARY KEY, group_id INTEGER, time,' +
         '     type, value, host, host_ip)')
+    add_column(db, 'dnsquery', 'repeat_count INTEGER DEFAULT 1')
+    add_column(db, 'dnsquery', 'last_time')
+    add_column(db, 'dnsquery', 'category')
     db.execute(
         'CREATE INDEX IF NOT EXISTS dnsquery_group ON dnsquery' +
         ' (group_id)')
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS dnsquery_time ON dnsquery' +
+        ' (time)')
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS dnsquery_host_time_repeats' +
+        ' ON dnsquery (host, time, repeat_count, last_time)')
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS dnsquery_category ON dnsquery' +
+        ' (category, group_id) WHERE category IS NOT NULL')
 
     db.execute(
         'CREATE TABLE IF NOT EXISTS querydomain' +
@@ -303,6 +544,9 @@ def create_tables(
     db.execute(
         'CREATE INDEX IF NOT EXISTS querydomain_domain ON querydomain' +
         ' (domain COLLATE NOCASE, group_id)')
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS querydomain_time ON querydomain' +
+        ' (time)')
 
     db.execute(
         'CREATE TABLE IF NOT EXISTS dhcpassignment' +
@@ -312,6 +556,45 @@ def create_tables(
         'CREATE INDEX IF NOT EXISTS dhcpassignment_ip_address' +
         ' ON dhcpassignment' +
         ' (ip_address, time)')
+    db.execute(
+        'CREATE INDEX IF NOT EXISTS dhcpassignment_time' +
+        ' ON dhcpassignment' +
+        ' (time)')
+
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS ingestsequence' +
+        ' (device PRIMARY KEY, sequence INTEGER)')
+
+
+def database_signature(
+        database_path: Optional[str] = None) -> DatabaseSignature:
+
+    '''Identify the current contents of the database file, by its inode
+    and the change counter SQLite increments in its header every time
+    a transaction is committed.  None if there is no database.'''
+
+    path = database_path or DATABASE_PATH
+    try:
+        inode = os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+
+    #  The file is kept open rather than opened for each read, because
+    #  closing any descriptor of a file releases the locks the process
+    #  holds on it, including those of SQLite's own connections
+    opened = SIGNATURE_FILES.get(path)
+    if opened is None or opened[1] != inode:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        if opened is not None:
+            os.close(opened[0])
+        opened = (fd, os.fstat(fd).st_ino)
+        SIGNATURE_FILES[path] = opened
+
+    (fd, inode) = opened
+    return (inode, int.from_bytes(os.pread(fd, 4, 24), 'big'))
 
 
 def open_database() -> sqlite3.Connection:
@@ -0,0 +1,361 @@
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextlib
+import gzip
+import json
+import os
+import re
+import syslog
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from typing import *
+
+
+SEQUENCE_PATH = '/var/lib/epipyweb/forward.sequence'
+QUEUE_DIR = '/var/lib/epipyweb/forward'
+TOKEN_PATH = '/etc/epipyweb/forward.token'
+
+FORWARD_TIMEOUT = 10
+FORWARD_MAX_PENDING_BATCHES = 1000
+
+#  After a failure to send, wait this long before retrying, doubling
+#  the wait after each further failure up to the maximum
+FORWARD_RETRY_MIN_DELAY = 1.0
+FORWARD_RETRY_MAX_DELAY = 300.0
+
+BATCH_FILENAME = re.compile(r'^batch-([0-9]+)\.ndjson\.gz$')
+
+
+class Forwarder:
+
+    '''Batch parsed log records and forward them to a central epipyweb
+    instance's /q/ingest endpoint.
+
+    Each batch is assigned a sequence number when it is sealed, and
+    keeps that number across retries, so the central instance can
+    discard batches it has already applied.  Sealed batches are kept in
+    the queue directory until sent, so that they survive a restart of
+    the recorder, and are sent in order by a separate thread, so that a
+    central instance which is down or slow doesn't hold up recording.'''
+
+    def __init__(
+            self,
+            url: str,
+            device: str,
+            token: str,
+            batch_size: int,
+            batch_interval: float,
+            queue_dir: str = QUEUE_DIR,
+            sequence_path: str = SEQUENCE_PATH) -> None:
+
+        self.url = url
+        self.device = device
+        self.token = token
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue_dir = queue_dir
+        self.sequence_path = sequence_path
+
+        self.records = cast(List[Dict[str, str]], [])
+        self.last_flush = time.monotonic()
+
+        os.makedirs(queue_dir, exist_ok=True)
+        self.pending = read_queue(queue_dir)
+        self.next_sequence = max(
+            [read_sequence(sequence_path)] +
+            [sequence + 1 for sequence in self.pending])
+
+        #  Held while changing the pending batches, and notified when
+        #  a batch is queued or sent
+        self.lock = threading.Condition()
+        self.stopping = threading.Event()
+        self.retry_delay = 0.0
+
+        self.sender = threading.Thread(target=self.send_pending, daemon=True)
+        self.sender.start()
+
+    def batch_path(
+            self,
+            sequence: int) -> str:
+
+        'The path of the queued batch with a sequence number'
+
+        return os.path.join(
+            self.queue_dir, 'batch-{:012d}.ndjson.gz'.format(sequence))
+
+    def add(
+            self,
+            record: Dict[str, str]) -> None:
+
+        'Add a record to the current batch, queueing it if it is full'
+
+        self.records.append(record)
+
+        if len(self.records) >= self.batch_size:
+            self.flush()
+
+    def timeout(self) -> float:
+
+        'Seconds remaining until the current batch should be queued'
+
+        elapsed = time.monotonic() - self.last_flush
+        return max(self.batch_interval - elapsed, 0.0)
+
+    def flush_if_due(self) -> None:
+
+        'Queue the current batch if the batch interval has elapsed'
+
+        if self.timeout() == 0.0:
+            self.flush()
+
+    def flush(self) -> None:
+
+        '''Compress the current batch, and queue it with a sequence
+        number for the sending thread'''
+
+        self.last_flush = time.monotonic()
+
+        if not self.records:
+            return
+
+        ndjson = str.join('', [
+            json.dumps(record) + '\n' for record in self.records])
+        payload = gzip.compress(ndjson.encode('utf-8'))
+        self.records = []
+
+        with self.lock:
+            sequence = self.next_sequence
+            write_file(self.batch_path(sequence), payload)
+            self.next_sequence += 1
+            write_file(
+                self.sequence_path, str(self.next_sequence).encode('utf-8'))
+            self.pending.append(sequence)
+
+            if len(self.pending) > FORWARD_MAX_PENDING_BATCHES:
+                dropped = self.pending.pop(0)
+                os.unlink(self.batch_path(dropped))
+                syslog.syslog('epipyweb forward dropped batch {}'.format(
+                    dropped))
+
+            self.lock.notify_all()
+
+    def close(
+            self,
+            timeout: float = FORWARD_TIMEOUT) -> None:
+
+        '''Queue the current batch, and wait up to a timeout for the
+        pending batches to be sent.  Those not sent by then are left
+        queued for the next run.'''
+
+        self.flush()
+
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0.0:
+                    break
+                self.lock.wait(remaining)
+
+        self.stopping.set()
+        with self.lock:
+            self.lock.notify_all()
+
+    def send_pending(self) -> None:
+
+        '''Send the pending batches in order, as they are queued, waiting
+        longer after each consecutive failure before retrying'''
+
+        while True:
+            with self.lock:
+                while not self.pending and not self.stopping.is_set():
+                    self.lock.wait()
+                if self.stopping.is_set():
+                    return
+
+                sequence = self.pending[0]
+                with open(self.batch_path(sequence), 'rb') as batch_file:
+                    payload = batch_file.read()
+
+            if self.send(sequence, payload):
+                self.retry_delay = 0.0
+                continue
+
+            self.retry_delay = min(
+                max(self.retry_delay * 2, FORWARD_RETRY_MIN_DELAY),
+                FORWARD_RETRY_MAX_DELAY)
+            self.stopping.wait(self.retry_delay)
+
+    def send(
+            self,
+            sequence: int,
+            payload: bytes) -> bool:
+
+        '''Send one batch, removing it from the queue once it has been
+        accepted or rejected outright.  Returns false if it is to be
+        retried later.'''
+
+        try:
+            send_batch(self.url, self.device, self.token, sequence, payload)
+        except urllib.error.HTTPError as e:
+            if e.code == 409:
+                return self.renumber(sequence, e)
+            if e.code != 400:
+                syslog.syslog('epipyweb forward failed: {}'.format(e))
+                return False
+
+            #  The central instance will never accept this batch
+            syslog.syslog('epipyweb forward rejected batch {}'.format(
+                sequence))
+        except (urllib.error.URLError, OSError) as e:
+            syslog.syslog('epipyweb forward failed: {}'.format(e))
+            return False
+
+        with self.lock:
+            if self.pending and self.pending[0] == sequence:
+                self.pending.pop(0)
+                os.unlink(self.batch_path(sequence))
+            self.lock.notify_all()
+
+        return True
+
+    def renumber(
+            self,
+            sequence: int,
+            error: urllib.error.HTTPError) -> bool:
+
+        '''Renumber the pending batches to follow the last sequence number
+        the central instance applied, after it refused a batch numbered
+        below that, because the sequence stored here has been reset.
+        Returns false if the central instance's response can't be read,
+        so that the batch is retried later.'''
+
+        try:
+            last_sequence = int(json.loads(
+                error.read().decode('utf-8'))['sequence'])
+        except (ValueError, KeyError, TypeError, OSError):
+            syslog.syslog('epipyweb forward failed: {}'.format(error))
+            return False
+
+        syslog.syslog((
+            'epipyweb forward sequence {} is below {} already applied,' +
+            ' renumbering pending batches').format(sequence, last_sequence))
+
+        with self.lock:
+            #  Move each batch aside first, so that a new number can't
+            #  collide with an old one not yet renumbered
+            for old_sequence in self.pending:
+                os.rename(
+                    self.batch_path(old_sequence),
+                    self.batch_path(old_sequence) + '.renumber')
+
+            renumbered = []
+            for (index, old_sequence) in enumerate(self.pending):
+                new_sequence = last_sequence + 1 + index
+                os.rename(
+                    self.batch_path(old_sequence) + '.renumber',
+                    self.batch_path(new_sequence))
+                renumbered.append(new_sequence)
+
+            self.pending = renumbered
+            self.next_sequence = last_sequence + 1 + len(renumbered)
+            write_file(
+                self.sequence_path, str(self.next_sequence).encode('utf-8'))
+
+        return True
+
+
+def read_queue(
+        queue_dir: str) -> List[int]:
+
+    'List the sequence numbers of the batches queued by the last run'
+
+    sequences = []
+    for filename in os.listdir(queue_dir):
+        match = BATCH_FILENAME.match(filename)
+        if match:
+            sequences.append(int(match.group(1)))
+
+    return sorted(sequences)
+
+
+def read_sequence(
+        sequence_path: str) -> int:
+
+    'Read the next batch sequence number to use from the last run'
+
+    try:
+        with open(sequence_path) as sequence_file:
+            return int(sequence_file.read())
+    except (FileNotFoundError, ValueError):
+        return 1
+
+
+def write_file(
+        path: str,
+        data: bytes) -> None:
+
+    '''Write a file, replacing it at once so that a crash never leaves it
+    partly written'''
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(data)
+    os.rename(temp_path, path)
+
+
+def read_token(
+        token_path: str = TOKEN_PATH) -> str:
+
+    'Read the token shared with the central instance to authorize batches'
+
+    with open(token_path) as token_file:
+        return token_file.read().strip()
+
+
+def send_batch(
+        url: str,
+        device: str,
+        token: str,
+        sequence: int,
+        payload: bytes) -> None:
+
+    'POST a compressed NDJSON batch to the central instance'
+
+    query = urllib.parse.urlencode({
+        'device': device,
+        'sequence': sequence,
+    })
+    request = urllib.request.Request(
+        url + '?' + query,
+        data=payload,
+        headers={
+            'Content-Type': 'application/x-ndjson',
+            'Content-Encoding': 'gzip',
+            'X-Epipyweb-Token': token,
+        })
+
+    with contextlib.closing(urllib.request.urlopen(
+            request, timeout=FORWARD_TIMEOUT)) as response:
+        response.read()
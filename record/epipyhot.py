@@ -0,0 +1,384 @@
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import collections
+import contextlib
+import datetime
+import json
+import os
+import socket
+import sqlite3
+
+import epipydb
+
+from typing import *
+
+
+HOT_SOCKET_PATH = '/var/run/epipyweb/hot.sock'
+
+HOT_TIER_MINUTES = 30
+HOT_TIER_MIN_GROUPS = 101
+HOT_TIER_MAX_GROUPS = 1000
+HOT_TIER_SOCKET_TIMEOUT = 1.0
+
+
+class HotTier:
+
+    '''The newest query groups and their queries, kept in memory by the
+    recorder so that the newest page of connections can be served
+    without reading the database.
+
+    The groups held are always every group from the oldest one held
+    onward, so a page of the newest groups is complete if enough
+    groups are held.  If the database is changed by something other
+    than the recorder, such as an import, a regroup, an ingested batch
+    or rotation, the hot tier is discarded and reloaded from the
+    database when next needed.'''
+
+    def __init__(self) -> None:
+
+        self.groups = cast(
+            OrderedDict[int, Dict], collections.OrderedDict())
+        self.warm = False
+        self.signature = cast(epipydb.DatabaseSignature, None)
+
+    def load(
+            self,
+            db: sqlite3.Connection) -> None:
+
+        'Fill the hot tier with the newest query groups in the database'
+
+        #  Taken before reading, so that a change made while reading is
+        #  noticed by the next check
+        self.signature = epipydb.database_signature()
+        self.groups = collections.OrderedDict()
+
+        with contextlib.closing(db.cursor()) as cursor:
+            cursor.execute(
+                'SELECT id, query_count, start_time, host, first_value,' +
+                '     category' +
+                ' FROM querygroup' +
+                ' ORDER BY id DESC LIMIT ?',
+                (HOT_TIER_MAX_GROUPS,))
+
+            for row in reversed(cursor.fetchall()):
+                self.groups[row[0]] = group_from_row(row)
+
+            self.evict()
+
+            if self.groups:
+                cursor.execute(
+                    'SELECT group_id, id, value, time, repeat_count,' +
+                    '     COALESCE(last_time, time)' +
+                    ' FROM dnsquery WHERE group_id >= ?' +
+                    ' ORDER BY group_id ASC, id ASC',
+                    (next(iter(self.groups)),))
+
+                for row in cursor.fetchall():
+                    group = self.groups.get(row[0])
+                    if group is not None:
+                        add_query(group, row[1:])
+
+        self.warm = True
+
+    def evict(self) -> None:
+
+        '''Discard the oldest groups beyond the maximum number held, or
+        beyond the time window, keeping enough for a full page'''
+
+        cutoff = datetime.datetime.now() - \
+            datetime.timedelta(minutes=HOT_TIER_MINUTES)
+        cutoff_iso = cutoff.isoformat()
+
+        while self.groups:
+            oldest = next(iter(self.groups.values()))
+
+            if len(self.groups) > HOT_TIER_MAX_GROUPS or \
+                    (len(self.groups) > HOT_TIER_MIN_GROUPS and
+                     oldest['time'] < cutoff_iso):
+                self.groups.popitem(last=False)
+            else:
+                break
+
+    def record(
+            self,
+            db: sqlite3.Connection,
+            query_id: Optional[int]) -> None:
+
+        '''Update the hot tier after the recorder has committed a log
+        line, adding the DNS query stored for it, if any.
+
+        The recorder checks that the hot tier is current while holding
+        the write lock, before writing, so the database should now be
+        at most the recorder's own commit on from the signature held.
+        If it is further on, another writer committed in between, and
+        the hot tier is discarded.'''
+
+        if not self.warm:
+            return
+
+        signature = epipydb.database_signature()
+        if signature is None or self.signature is None or \
+                signature[0] != self.signature[0] or \
+                (signature[1] - self.signature[1]) % 2**32 > 1:
+            self.discard()
+            return
+        self.signature = signature
+
+        if query_id is not None:
+            self.record_query(db, query_id)
+
+    def record_query(
+            self,
+            db: sqlite3.Connection,
+            query_id: int) -> None:
+
+        'Add a stored DNS query, and the latest state of its group'
+
+        with contextlib.closing(db.cursor()) as cursor:
+            cursor.execute(
+                'SELECT group_id, id, value, time, repeat_count,' +
+                '     COALESCE(last_time, time)' +
+                ' FROM dnsquery WHERE id = ?',
+                (query_id,))
+            query_row = cursor.fetchone()
+            group_id = query_row[0]
+
+            if self.groups and group_id < next(iter(self.groups)):
+                return
+
+            cursor.execute(
+                'SELECT id, query_count, start_time, host, first_value,' +
+                '     category' +
+                ' FROM querygroup WHERE id = ?',
+                (group_id,))
+            group = group_from_row(cursor.fetchone())
+
+        if group_id in self.groups:
+            group['queries'] = self.groups[group_id]['queries']
+        self.groups[group_id] = group
+
+        add_query(group, query_row[1:])
+        self.evict()
+
+    def check_current(self) -> None:
+
+        'Discard the hot tier if the database was changed by another writer'
+
+        if self.warm and self.signature != epipydb.database_signature():
+            self.discard()
+
+    def discard(self) -> None:
+
+        'Discard the groups held, to be reloaded when next needed'
+
+        self.warm = False
+        self.groups = collections.OrderedDict()
+
+    def dnsquerygroup(
+            self,
+            count: int) -> Optional[Dict]:
+
+        '''Get the newest page of query groups, in the same form as
+        dnsquerygroup_page, or None if not enough groups are held'''
+
+        if count > 100:
+            count = 100
+
+        if count < 1 or len(self.groups) <= count:
+            return None
+
+        groups = list(self.groups.values())[-count:]
+        groups.reverse()
+
+        return {
+            'groups': [group_summary(group) for group in groups],
+            'next_page_present': True,
+            'previous_page_present': False,
+        }
+
+    def groupqueries(
+            self,
+            group_id: int,
+            count: int) -> Optional[Dict]:
+
+        '''Get the queries of a group, in the same form as
+        groupqueries_page, or None if the group isn't held'''
+
+        group = self.groups.get(group_id)
+        if group is None:
+            return None
+
+        return {
+            'queries': group['queries'][:count],
+        }
+
+    def groupqueries_page(
+            self,
+            count: int) -> Optional[Dict]:
+
+        '''Get the queries of each group with more than one query on the
+        newest page of groups, in the same form as groupqueries_batch,
+        or None if not enough groups are held'''
+
+        page = self.dnsquerygroup(count)
+        if page is None:
+            return None
+
+        result = cast(Dict, {
+            'groups': {},
+        })
+        for group in page['groups']:
+            if group['query_count'] > 1:
+                result['groups'][group['id']] = {
+                    'queries': self.groups[group['id']]['queries'],
+                }
+
+        return result
+
+    def handle_request(
+            self,
+            request: str,
+            test_lock_held: bool) -> Dict:
+
+        '''Answer a request from the web back-end, reporting the hot tier
+        as cold if it can't answer from memory'''
+
+        self.check_current()
+
+        if test_lock_held:
+            return {'cold': True}
+
+        if not self.warm and epipydb.database_signature() is not None:
+            with contextlib.closing(epipydb.open_database()) as db:
+                self.load(db)
+
+        args = request.split()
+        result = None
+        if len(args) == 2 and args[0] == 'dnsquerygroup':
+            result = self.dnsquerygroup(int(args[1]))
+        elif len(args) == 3 and args[0] == 'groupqueries':
+            result = self.groupqueries(int(args[1]), int(args[2]))
+        elif len(args) == 2 and args[0] == 'groupqueries_page':
+            result = self.groupqueries_page(int(args[1]))
+
+        if result is None:
+            return {'cold': True}
+
+        return result
+
+
+def group_from_row(
+        row: Tuple) -> Dict:
+
+    'Create a hot tier group from a querygroup row'
+
+    return {
+        'id': row[0],
+        'query_count': row[1],
+        'time': row[2],
+        'host': row[3],
+        'value': row[4],
+        'category': row[5],
+        'queries': [],
+    }
+
+
+def group_summary(
+        group: Dict) -> Dict:
+
+    'The fields of a hot tier group returned for a page of groups'
+
+    return {
+        'id': group['id'],
+        'query_count': group['query_count'],
+        'time': group['time'],
+        'host': group['host'],
+        'value': group['value'],
+        'category': group['category'],
+    }
+
+
+def add_query(
+        group: Dict,
+        row: Tuple) -> None:
+
+    '''Add a query to a hot tier group from the id, value, time, repeat
+    count and last time of its dnsquery row, replacing it if already
+    present, as it is when a repeat has been coalesced onto it'''
+
+    query = {
+        'id': row[0],
+        'value': row[1],
+        'time': row[2],
+        'repeat_count': row[3],
+        'last_time': row[4],
+    }
+
+    queries = group['queries']
+    for (index, held) in enumerate(queries):
+        if held['id'] == query['id']:
+            queries[index] = query
+            return
+
+    if len(queries) < epipydb.QUERY_GROUP_MAX_QUERIES:
+        queries.append(query)
+
+
+def open_hot_socket() -> socket.socket:
+
+    'Listen for hot tier requests from the web back-end'
+
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(HOT_SOCKET_PATH)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(HOT_SOCKET_PATH)
+    os.chmod(HOT_SOCKET_PATH, 0o666)
+    sock.listen(16)
+
+    return sock
+
+
+def handle_hot_connection(
+        listen_sock: socket.socket,
+        hot_tier: HotTier,
+        test_lock_held: bool) -> None:
+
+    '''Accept a connection from the web back-end and answer its request,
+    which is a single line, with a single line of JSON'''
+
+    (sock, _) = listen_sock.accept()
+    with contextlib.closing(sock):
+        sock.settimeout(HOT_TIER_SOCKET_TIMEOUT)
+
+        recv_buff = b''
+        while b'\n' not in recv_buff:
+            data = sock.recv(4096)
+            if not data:
+                return
+            recv_buff += data
+
+        request = recv_buff.decode('utf-8').split('\n')[0]
+        try:
+            result = hot_tier.handle_request(request, test_lock_held)
+        except ValueError:
+            result = {'error': 'invalid request'}
+
+        sock.sendall(json.dumps(result).encode('utf-8') + b'\n')
@@ -0,0 +1,210 @@
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''Opt-in profiling of the recorder, log import and web back-end.
+
+Profiling is only possible when the EPIPYWEB_PROFILE environment
+variable is set, and is then switched on and off while running, by
+SIGUSR2 or a /q/debug/profile request.  While switched on, every
+function call is recorded with cProfile, and every allocation with
+tracemalloc.  When switched off, the hottest functions and the lines
+allocating the most memory are written to files.  Without the
+environment variable, nothing is installed, so there is no cost.'''
+
+import atexit
+import cProfile
+import datetime
+import os
+import pstats
+import signal
+import tracemalloc
+
+from typing import *
+
+
+PROFILE_ENVIRONMENT = 'EPIPYWEB_PROFILE'
+PROFILE_DIR = '/var/lib/epipyweb/profile'
+PROFILE_SIGNAL = signal.SIGUSR2
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_TOP_ALLOCATIONS = 40
+
+
+def profiling_enabled() -> bool:
+
+    'Check whether profiling has been enabled through the environment'
+
+    return os.environ.get(PROFILE_ENVIRONMENT, '') not in ['', '0']
+
+
+def profiling_at_start() -> bool:
+
+    'Check whether profiling is to be switched on from the start'
+
+    return os.environ.get(PROFILE_ENVIRONMENT, '') == 'start'
+
+
+class Profiler:
+
+    '''Function call and allocation profiling of a process, which can be
+    switched on and off repeatedly, writing a report each time it is
+    switched off'''
+
+    def __init__(
+            self,
+            name: str,
+            profile_dir: str = PROFILE_DIR) -> None:
+
+        self.name = name
+        self.profile_dir = profile_dir
+        self.profile = cast(Optional[cProfile.Profile], None)
+        self.start_time = cast(Optional[datetime.datetime], None)
+
+    @property
+    def active(self) -> bool:
+
+        'True while profiling is switched on'
+
+        return self.profile is not None
+
+    def start(self) -> None:
+
+        'Switch profiling on, if it isn\'t already'
+
+        if self.profile is not None:
+            return
+
+        self.start_time = datetime.datetime.now()
+        tracemalloc.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self) -> List[str]:
+
+        '''Switch profiling off, and write the profile and the report of
+        hot functions and allocation sites.  Returns the paths written.'''
+
+        if self.profile is None:
+            return []
+
+        self.profile.disable()
+        profile = self.profile
+        self.profile = None
+
+        snapshot = tracemalloc.take_snapshot()
+        (traced_size, traced_peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        assert self.start_time is not None
+        base_path = os.path.join(
+            self.profile_dir, 'profile-{}-{}-{}'.format(
+                self.name, os.getpid(),
+                self.start_time.strftime('%Y%m%dT%H%M%S')))
+        paths = [
+            base_path + '.pstats',
+            base_path + '-functions.txt',
+            base_path + '-allocations.txt',
+        ]
+
+        profile.dump_stats(paths[0])
+        with open(paths[1], 'w') as report_file:
+            write_function_report(report_file, profile)
+        with open(paths[2], 'w') as report_file:
+            write_allocation_report(
+                report_file, snapshot, traced_size, traced_peak)
+
+        return paths
+
+    def toggle(self) -> List[str]:
+
+        '''Switch profiling on if it is off, or off if it is on, returning
+        the paths written when switched off'''
+
+        if self.profile is None:
+            self.start()
+            return []
+
+        return self.stop()
+
+
+def write_function_report(
+        report_file: IO[str],
+        profile: cProfile.Profile) -> None:
+
+    '''Write the functions with the most time spent in them, and then
+    the most time spent in them and the functions they call'''
+
+    stats = pstats.Stats(profile, stream=report_file)
+    stats.sort_stats('tottime').print_stats(PROFILE_TOP_FUNCTIONS)
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+
+
+def write_allocation_report(
+        report_file: IO[str],
+        snapshot: tracemalloc.Snapshot,
+        traced_size: int,
+        traced_peak: int) -> None:
+
+    '''Write the source lines which allocated the most memory still in
+    use when profiling was switched off'''
+
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ])
+
+    report_file.write(
+        'Traced memory: {:.1f} KiB in use, {:.1f} KiB peak\n\n'.format(
+            traced_size / 1024, traced_peak / 1024))
+
+    for stat in snapshot.statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]:
+        frame = stat.traceback[0]
+        report_file.write('{:10.1f} KiB {:8} blocks  {}:{}\n'.format(
+            stat.size / 1024, stat.count, frame.filename, frame.lineno))
+
+
+def install_signal_toggle(
+        name: str,
+        log: Callable[[str], Any],
+        profile_dir: str = PROFILE_DIR) -> Optional[Profiler]:
+
+    '''If profiling is enabled, create a profiler switched on and off by
+    SIGUSR2, logging the paths of the reports it writes, and write a
+    report at exit if it is still on.  Returns None if not enabled.'''
+
+    if not profiling_enabled():
+        return None
+
+    profiler = Profiler(name, profile_dir)
+
+    def log_paths(paths: List[str]) -> None:
+        for path in paths:
+            log('Wrote profile ' + path)
+
+    def on_signal(signum: int, frame: Any) -> None:
+        log_paths(profiler.toggle())
+
+    signal.signal(PROFILE_SIGNAL, on_signal)
+    atexit.register(lambda: log_paths(profiler.stop()))
+
+    if profiling_at_start():
+        profiler.start()
+
+    return profiler
@@ -0,0 +1,292 @@
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import bisect
+import collections
+import contextlib
+import heapq
+import sqlite3
+import time
+
+import epipydb
+
+from typing import *
+
+
+SUGGEST_REFRESH_SECONDS = 2.0
+SUGGEST_REFRESH_MAX_ROWS = 50000
+SUGGEST_BUILD_CHUNK_DOMAINS = 20000
+SUGGEST_MEMORY_BUDGET = 16 * 1024 * 1024
+SUGGEST_MAX_CANDIDATES = 20000
+SUGGEST_MAX_COUNT = 50
+
+#  An estimate of the memory used for each domain held, beyond the
+#  characters of its name: the string object, its slot in the sorted
+#  list, and its entry and count in the popularity dictionary
+SUGGEST_ENTRY_OVERHEAD = 160
+
+#  Below this many new domains, they are inserted into the sorted list
+#  one at a time rather than appended and sorted
+SUGGEST_INSERT_LIMIT = 64
+
+
+def domain_size(
+        domain: str) -> int:
+
+    'The estimated memory used by a domain held in the index'
+
+    return len(domain) + SUGGEST_ENTRY_OVERHEAD
+
+
+def most_popular(
+        counts: Dict[str, int],
+        target: int) -> Dict[str, int]:
+
+    'Keep the most popular domains which fit in a memory target'
+
+    size = 0
+    kept = {}
+    for domain in sorted(counts, key=counts.__getitem__, reverse=True):
+        size += domain_size(domain)
+        if size > target:
+            break
+        kept[domain] = counts[domain]
+
+    return kept
+
+
+class DomainIndex:
+
+    '''A sorted array of the distinct domains in the querydomain table,
+    with the number of times each has been queried, for suggesting
+    search terms by prefix.
+
+    The index is built by counting the table with an aggregate over
+    the querydomain_domain index, which returns the domains in sorted
+    order, a chunk of domains for each refresh, so that no request
+    waits for the whole table to be counted, and nothing is suggested
+    until it is built.  After that, only the querydomain rows added
+    since are read, when the database signature shows it has changed.
+
+    Database rotation only discards the oldest rows, so the counts are
+    kept, including the queries rotated out since.  Only when the
+    newest row counted is gone, or the database file is replaced, is
+    the index built again in the same way, while the old one is still
+    used for suggestions.  Regrouping only changes the groups of rows,
+    so doesn't change the counts.
+
+    When the estimated memory used exceeds the budget, the least
+    popular domains are dropped, and they are counted afresh if they
+    are queried again.'''
+
+    def __init__(
+            self,
+            memory_budget: int = SUGGEST_MEMORY_BUDGET) -> None:
+
+        self.memory_budget = memory_budget
+        self.domains = cast(List[str], [])
+        self.counts = cast(Dict[str, int], {})
+        self.size = 0
+        self.ready = False
+        self.signature = cast(epipydb.DatabaseSignature, None)
+        self.last_rowid = 0
+        self.refresh_time = cast(Optional[float], None)
+
+        #  The counts of an index being built, the last domain counted,
+        #  and the newest row it is counting
+        self.build_counts = cast(Optional[Dict[str, int]], None)
+        self.build_signature = cast(epipydb.DatabaseSignature, None)
+        self.build_domain = ''
+        self.build_end_rowid = 0
+
+    def refresh(
+            self,
+            db: sqlite3.Connection,
+            signature: epipydb.DatabaseSignature) -> None:
+
+        '''Count the next chunk of rows of an index being built, or if
+        the database has changed, add the querydomain rows recorded since
+        the last refresh, or start building the index again if the
+        newest row counted is no longer there'''
+
+        with contextlib.closing(db.cursor()) as cursor:
+            if self.build_counts is not None:
+                self.build_chunk(cursor)
+                return
+
+            now = time.monotonic()
+            if self.refresh_time is not None and \
+                    now - self.refresh_time < SUGGEST_REFRESH_SECONDS:
+                return
+            self.refresh_time = now
+
+            if self.ready and signature is not None and \
+                    signature == self.signature:
+                return
+
+            replaced = signature is not None and \
+                self.signature is not None and \
+                signature[0] != self.signature[0]
+            last_rowid = self.newest_rowid(cursor)
+            if not self.ready or replaced or last_rowid < self.last_rowid:
+                self.start_build(signature, last_rowid)
+                self.build_chunk(cursor)
+                return
+
+            cursor.execute(
+                'SELECT rowid, domain FROM querydomain' +
+                ' WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                (self.last_rowid, SUGGEST_REFRESH_MAX_ROWS))
+            rows = cursor.fetchall()
+
+        #  Only note the signature once caught up, so that the rest of
+        #  the rows are read on the next refresh
+        if len(rows) < SUGGEST_REFRESH_MAX_ROWS:
+            self.signature = signature
+        if rows:
+            self.last_rowid = rows[-1][0]
+            self.add(collections.Counter(
+                domain.lower() for (_, domain) in rows if domain))
+
+    def newest_rowid(
+            self,
+            cursor: sqlite3.Cursor) -> int:
+
+        'Find the newest querydomain row, from the end of the primary key'
+
+        cursor.execute('SELECT MAX(rowid) FROM querydomain')
+
+        return cursor.fetchone()[0] or 0
+
+    def start_build(
+            self,
+            signature: epipydb.DatabaseSignature,
+            last_rowid: int) -> None:
+
+        '''Start counting the querydomain rows up to the newest now, so
+        that rows added while building are left for the refreshes after
+        it is built rather than counted twice'''
+
+        self.build_counts = {}
+        self.build_signature = signature
+        self.build_domain = ''
+        self.build_end_rowid = last_rowid
+
+    def build_chunk(
+            self,
+            cursor: sqlite3.Cursor) -> None:
+
+        '''Count the next chunk of domains of the index being built, and
+        use it in place of the old index once all are counted'''
+
+        counts = self.build_counts
+        assert counts is not None
+
+        #  Grouped in the order of the querydomain_domain index, which
+        #  holds the rowid, so the count is read from the index alone
+        cursor.execute(
+            'SELECT domain, COUNT(*) FROM querydomain' +
+            ' WHERE domain > ? COLLATE NOCASE AND rowid <= ?' +
+            ' GROUP BY domain COLLATE NOCASE' +
+            ' ORDER BY domain COLLATE NOCASE LIMIT ?',
+            (self.build_domain, self.build_end_rowid,
+             SUGGEST_BUILD_CHUNK_DOMAINS))
+        rows = cursor.fetchall()
+
+        for (domain, count) in rows:
+            domain = domain.lower()
+            counts[domain] = counts.get(domain, 0) + count
+
+        #  Keep the counts being built within twice the memory budget
+        if len(counts) * SUGGEST_ENTRY_OVERHEAD > 2 * self.memory_budget:
+            counts = self.build_counts = most_popular(
+                counts, self.memory_budget)
+
+        if len(rows) == SUGGEST_BUILD_CHUNK_DOMAINS:
+            self.build_domain = rows[-1][0]
+            return
+
+        self.domains = []
+        self.counts = {}
+        self.size = 0
+        self.ready = True
+        self.signature = self.build_signature
+        self.last_rowid = self.build_end_rowid
+        self.build_counts = None
+        self.add(counts)
+
+    def add(
+            self,
+            counts: Mapping[str, int]) -> None:
+
+        'Add to the counts of domains, inserting those not yet held'
+
+        new_domains = []
+        for (domain, count) in counts.items():
+            if domain in self.counts:
+                self.counts[domain] += count
+            else:
+                self.counts[domain] = count
+                self.size += domain_size(domain)
+                new_domains.append(domain)
+
+        if len(new_domains) < SUGGEST_INSERT_LIMIT:
+            for domain in new_domains:
+                bisect.insort(self.domains, domain)
+        else:
+            self.domains.extend(new_domains)
+            self.domains.sort()
+
+        if self.size > self.memory_budget:
+            self.trim()
+
+    def trim(self) -> None:
+
+        '''Drop the least popular domains, down to three quarters of the
+        memory budget, so that trimming isn't needed on every refresh'''
+
+        kept = most_popular(self.counts, self.memory_budget * 3 // 4)
+
+        self.counts = kept
+        self.domains = sorted(kept)
+        self.size = sum(map(domain_size, kept))
+
+    def suggest(
+            self,
+            prefix: str,
+            count: int) -> List[Dict]:
+
+        '''Find the most frequently queried domains starting with a
+        prefix.  For short prefixes matching a great many domains, only
+        the first of them in sorted order are ranked.'''
+
+        count = max(0, min(count, SUGGEST_MAX_COUNT))
+        prefix = prefix.lower()
+
+        low = bisect.bisect_left(self.domains, prefix)
+        high = bisect.bisect_left(self.domains, prefix + '\U0010ffff')
+        high = min(high, low + SUGGEST_MAX_CANDIDATES)
+
+        domains = heapq.nlargest(
+            count, self.domains[low:high], key=self.counts.__getitem__)
+
+        return [
+            {'domain': domain, 'count': self.counts[domain]}
+            for domain in domains
+        ]
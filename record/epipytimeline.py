@@ -0,0 +1,444 @@
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''Counts of the DNS queries of a host in each bucket of time, for
+charting its activity.
+
+The times of the queries in a range are read in one statement, already
+converted to seconds by SQLite, and binned with NumPy if it is
+installed, or in plain Python if not.  The repeats of a coalesced query
+are spread evenly from its first time to its last.  A query can only be
+repeated within its group, which ends within an hour of starting, so
+the counts of buckets which ended over an hour ago can't change, other
+than by queries stored late, from an ingested batch or an import of old
+logs.  They are kept in a least recently used cache, from which the
+buckets of late queries are dropped, and only the buckets not yet
+cached are read from the database.'''
+
+import collections
+import contextlib
+import datetime
+import operator
+import sqlite3
+
+import epipydb
+
+from typing import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = cast(Any, None)
+
+
+TIMELINE_MAX_BUCKETS = 20160
+TIMELINE_CACHE_MAX_BUCKETS = 100000
+
+#  The longest a coalesced query can go on being repeated, after its
+#  first time, and so how long after a bucket ends its count can change
+TIMELINE_OPEN_SECONDS = epipydb.QUERY_GROUP_EXTENDED_TIME
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+#  The counts of a bucket, either the total, or by domain
+BucketCounts = Union[int, Dict[str, int]]
+
+#  Rows of first and last time, in seconds or as ISO 8601 for NumPy to
+#  parse, repeat count, and optionally query value
+TimelineRow = Tuple
+
+
+def epoch_to_isotime(
+        seconds: int) -> str:
+
+    'Convert seconds since the epoch to an ISO 8601 time'
+
+    return (EPOCH + datetime.timedelta(seconds=seconds)).isoformat()
+
+
+def query_domain(
+        value: str) -> str:
+
+    'The domain a query value is counted under, its last two labels'
+
+    return str.join('.', value.lower().split('.')[-2:])
+
+
+def spread_repeats(
+        first: int,
+        last: int,
+        repeat_count: int,
+        start: int,
+        bucket: int,
+        bucket_count: int) -> Iterator[Tuple[int, int]]:
+
+    '''Spread the repeats of a query evenly from its first time to its
+    last, where the first and last of them are known to be, yielding
+    each bucket in range with some of them and how many'''
+
+    span = last - first
+    if repeat_count <= 1 or span <= 0:
+        number = (first - start) // bucket
+        if 0 <= number < bucket_count:
+            yield (number, repeat_count)
+        return
+
+    intervals = repeat_count - 1
+
+    def repeats_before(
+            seconds: int) -> int:
+        if seconds <= first:
+            return 0
+        if seconds > last:
+            return repeat_count
+        return -(-(seconds - first) * intervals // span)
+
+    for number in range(
+            max(0, (first - start) // bucket),
+            min(bucket_count, (last - start) // bucket + 1)):
+        bucket_start = start + number * bucket
+        count = repeats_before(bucket_start + bucket) - \
+            repeats_before(bucket_start)
+        if count:
+            yield (number, count)
+
+
+def bin_rows(
+        rows: List[TimelineRow],
+        start: int,
+        bucket: int,
+        bucket_count: int,
+        by_domain: bool) -> List[BucketCounts]:
+
+    '''Sum the repeat counts of query rows in each bucket, or the repeat
+    counts of each domain in each bucket'''
+
+    if not by_domain:
+        totals = [0] * bucket_count
+        for (first, last, repeat_count) in rows:
+            for (number, count) in spread_repeats(
+                    first, last, repeat_count, start, bucket, bucket_count):
+                totals[number] += count
+        return cast(List[BucketCounts], totals)
+
+    domains = cast(Dict[str, str], {})
+    buckets = [
+        cast(Dict[str, int], collections.Counter())
+        for _ in range(bucket_count)]
+    for (first, last, repeat_count, value) in rows:
+        if value not in domains:
+            domains[value] = query_domain(value or '')
+        for (number, count) in spread_repeats(
+                first, last, repeat_count, start, bucket, bucket_count):
+            buckets[number][domains[value]] += count
+
+    return [dict(counts) for counts in buckets]
+
+
+def bin_rows_numpy(
+        rows: List[TimelineRow],
+        start: int,
+        bucket: int,
+        bucket_count: int,
+        by_domain: bool) -> List[BucketCounts]:
+
+    '''Bin query rows with NumPy, parsing their ISO 8601 times and
+    histogramming their bucket numbers all at once, with the domain of
+    each row as a second dimension when counting by domain.  The few
+    coalesced rows repeated over a span of time are spread over their
+    buckets in plain Python.'''
+
+    firsts = numpy.array(
+        list(map(operator.itemgetter(0), rows)),
+        dtype='datetime64[s]').astype(numpy.int64)
+    lasts = numpy.array(
+        list(map(operator.itemgetter(1), rows)),
+        dtype='datetime64[s]').astype(numpy.int64)
+    repeat_counts = numpy.fromiter(
+        map(operator.itemgetter(2), rows),
+        dtype=numpy.int64, count=len(rows))
+
+    spread = numpy.nonzero((lasts != firsts) & (repeat_counts > 1))[0]
+    single = (lasts == firsts) | (repeat_counts <= 1)
+    bucket_numbers = (firsts[single] - start) // bucket
+    single_counts = repeat_counts[single]
+
+    #  Rows read for repeats spreading into the range may start before it
+    in_range = bucket_numbers >= 0
+    bucket_numbers = bucket_numbers[in_range]
+    single_counts = single_counts[in_range]
+
+    if not by_domain:
+        totals = numpy.bincount(
+            bucket_numbers, weights=single_counts,
+            minlength=bucket_count).astype(numpy.int64).tolist()
+        for index in spread:
+            for (number, count) in spread_repeats(
+                    int(firsts[index]), int(lasts[index]),
+                    int(repeat_counts[index]), start, bucket, bucket_count):
+                totals[number] += count
+        return cast(List[BucketCounts], totals)
+
+    #  Find the domain of each distinct query value, rather than of
+    #  each row, and number the domains
+    values = list(map(operator.itemgetter(3), rows))
+    domain_names = cast(List[str], [])
+    domain_numbers = cast(Dict[str, int], {})
+    value_domains = {}
+    for value in set(values):
+        domain = query_domain(value or '')
+        if domain not in domain_numbers:
+            domain_numbers[domain] = len(domain_names)
+            domain_names.append(domain)
+        value_domains[value] = domain_numbers[domain]
+
+    row_domains = numpy.fromiter(
+        map(value_domains.__getitem__, values),
+        dtype=numpy.int64, count=len(values))[single][in_range]
+
+    counts = numpy.bincount(
+        bucket_numbers * len(domain_names) + row_domains,
+        weights=single_counts,
+        minlength=bucket_count * len(domain_names)).astype(numpy.int64)
+    counts = counts.reshape(bucket_count, len(domain_names))
+
+    buckets = [cast(Dict[str, int], {}) for _ in range(bucket_count)]
+    for (bucket_number, domain_number) in zip(*numpy.nonzero(counts)):
+        buckets[bucket_number][domain_names[domain_number]] = \
+            int(counts[bucket_number, domain_number])
+
+    for index in spread:
+        domain = domain_names[value_domains[values[index]]]
+        for (number, count) in spread_repeats(
+                int(firsts[index]), int(lasts[index]),
+                int(repeat_counts[index]), start, bucket, bucket_count):
+            buckets[number][domain] = buckets[number].get(domain, 0) + count
+
+    return cast(List[BucketCounts], buckets)
+
+
+def read_buckets(
+        db: sqlite3.Connection,
+        host: str,
+        start: int,
+        bucket: int,
+        bucket_count: int,
+        by_domain: bool) -> List[BucketCounts]:
+
+    'Read and bin the queries of a host in a range of buckets'
+
+    #  NumPy parses the times faster than SQLite converts them
+    time_column = "CAST(strftime('%s', time) AS INTEGER)"
+    last_time_column = \
+        "CAST(strftime('%s', COALESCE(last_time, time)) AS INTEGER)"
+    if numpy is not None:
+        time_column = 'time'
+        last_time_column = 'COALESCE(last_time, time)'
+
+    value_column = ''
+    if by_domain:
+        value_column = ', value'
+
+    #  Queries repeated into the range may have started before it
+    lookback_iso = epoch_to_isotime(start - TIMELINE_OPEN_SECONDS)
+    start_iso = epoch_to_isotime(start)
+    end_iso = epoch_to_isotime(start + bucket * bucket_count)
+
+    with contextlib.closing(db.cursor()) as cursor:
+        cursor.execute(
+            'SELECT ' + time_column + ', ' + last_time_column + ',' +
+            '     COALESCE(repeat_count, 1)' + value_column +
+            ' FROM dnsquery' +
+            ' WHERE host = ? AND time >= ? AND time < ?' +
+            '     AND COALESCE(last_time, time) >= ?',
+            (host, lookback_iso, end_iso, start_iso))
+        rows = cursor.fetchall()
+
+    if numpy is not None and rows:
+        return bin_rows_numpy(rows, start, bucket, bucket_count, by_domain)
+
+    #  Times which SQLite can't convert have no bucket
+    rows = [
+        row for row in rows if row[0] is not None and row[1] is not None]
+
+    return bin_rows(rows, start, bucket, bucket_count, by_domain)
+
+
+class TimelineCache:
+
+    '''The counts of buckets which ended long enough ago that no query in
+    them can be repeated again, most recently used last, keyed by host,
+    bucket size, bucket start and whether counted by domain.
+
+    Whenever the database signature changes, the queries stored since
+    the last check are found from the newest id seen, and the cached
+    buckets they fall in are dropped.  The whole cache is dropped when
+    the oldest queries are discarded by rotation, or the database file
+    is replaced.'''
+
+    def __init__(
+            self,
+            max_buckets: int = TIMELINE_CACHE_MAX_BUCKETS) -> None:
+
+        self.max_buckets = max_buckets
+        self.buckets = cast(
+            OrderedDict[Tuple[str, int, int, bool], BucketCounts],
+            collections.OrderedDict())
+        self.signature = cast(epipydb.DatabaseSignature, None)
+        self.id_range = cast(Optional[Tuple[Optional[int], int]], None)
+
+    def check_current(
+            self,
+            db: sqlite3.Connection,
+            signature: epipydb.DatabaseSignature,
+            now: int) -> None:
+
+        '''Drop the cached buckets of the queries stored since the last
+        check, if any are old enough to fall in a cached bucket'''
+
+        if signature is not None and signature == self.signature:
+            return
+
+        with contextlib.closing(db.cursor()) as cursor:
+            cursor.execute(
+                'SELECT (SELECT MIN(id) FROM dnsquery),' +
+                ' (SELECT MAX(id) FROM dnsquery)')
+            (first_id, last_id) = cursor.fetchone()
+            id_range = (first_id, last_id or 0)
+
+            replaced = signature is not None and \
+                self.signature is not None and \
+                signature[0] != self.signature[0]
+            if replaced or self.id_range is None or \
+                    id_range[0] != self.id_range[0] or \
+                    id_range[1] < self.id_range[1]:
+                self.buckets.clear()
+            elif id_range[1] > self.id_range[1]:
+                cursor.execute(
+                    "SELECT host, MIN(CAST(strftime('%s', time) AS INTEGER))" +
+                    ' FROM dnsquery WHERE id > ? GROUP BY host',
+                    (self.id_range[1],))
+                self.drop_late(dict(cursor.fetchall()), now)
+
+        self.signature = signature
+        self.id_range = id_range
+
+    def drop_late(
+            self,
+            earliest: Dict[str, Optional[int]],
+            now: int) -> None:
+
+        '''Drop the cached buckets of each host ending after the earliest
+        of its newly stored queries.  Buckets are only cached once they
+        ended an open period ago, so queries since then change none.'''
+
+        late = {
+            host: time for (host, time) in earliest.items()
+            if time is not None and time < now - TIMELINE_OPEN_SECONDS}
+        if not late:
+            return
+
+        for key in [
+                key for key in self.buckets
+                if key[0] in late and key[2] + key[1] > late[key[0]]]:
+            del self.buckets[key]
+
+    def timeline(
+            self,
+            db: sqlite3.Connection,
+            signature: epipydb.DatabaseSignature,
+            host: str,
+            since: int,
+            until: int,
+            bucket: int,
+            now: int,
+            by_domain: bool) -> Tuple[int, List[BucketCounts]]:
+
+        '''Count the queries of a host in buckets covering a time range,
+        in seconds, aligned to multiples of the bucket size.  Returns
+        the start of the first bucket and the counts of each.'''
+
+        start = since - since % bucket
+        bucket_count = max(1, -(-(until - start) // bucket))
+        if bucket_count > TIMELINE_MAX_BUCKETS:
+            raise ValueError('too many buckets')
+
+        self.check_current(db, signature, now)
+
+        keys = [
+            (host, bucket, start + index * bucket, by_domain)
+            for index in range(bucket_count)]
+        counts = cast(
+            List[Optional[BucketCounts]],
+            [self.buckets.get(key) for key in keys])
+
+        missing = [
+            index for (index, count) in enumerate(counts) if count is None]
+        if missing:
+            first = missing[0]
+            read = read_buckets(
+                db, host, start + first * bucket, bucket,
+                missing[-1] + 1 - first, by_domain)
+            for (index, count) in enumerate(read, first):
+                if counts[index] is None:
+                    counts[index] = count
+
+        filled = cast(List[BucketCounts], counts)
+        for (key, count) in zip(keys, filled):
+            if key in self.buckets:
+                self.buckets.move_to_end(key)
+            elif key[2] + bucket + TIMELINE_OPEN_SECONDS <= now:
+                self.buckets[key] = count
+
+        while len(self.buckets) > self.max_buckets:
+            self.buckets.popitem(last=False)
+
+        return (start, filled)
+
+
+def split_top_domains(
+        buckets: List[Dict[str, int]],
+        domain_count: int) -> Dict:
+
+    '''Split counts by domain into the most frequently queried domains
+    over all buckets, and the rest as other'''
+
+    totals = cast(Counter[str], collections.Counter())
+    for counts in buckets:
+        totals.update(counts)
+
+    top = [domain for (domain, _) in totals.most_common(domain_count)]
+
+    bucket_totals = [sum(counts.values()) for counts in buckets]
+    domains = [
+        {
+            'domain': domain,
+            'counts': [counts.get(domain, 0) for counts in buckets],
+        }
+        for domain in top]
+
+    other = [
+        total - sum(counts.get(domain, 0) for domain in top)
+        for (total, counts) in zip(bucket_totals, buckets)]
+
+    return {
+        'counts': bucket_totals,
+        'domains': domains,
+        'other': other,
+    }
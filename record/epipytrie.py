@@ -0,0 +1,316 @@
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''A compiled trie of domain names and their categories, such as ads,
+tracker or malware, which is memory-mapped rather than loaded, so that
+lists of millions of domains can be looked up without the memory or
+start-up time of reading them into Python objects.
+
+The trie is keyed by domain label, from the top level domain down, and
+a domain inherits the category of the nearest listed domain above it.
+The file is laid out as:
+
+    header      magic, node count, edge count, and the offsets of the
+                label pool and the category names
+    nodes       for each node, the index of its first edge, its number
+                of edges, and its category number, or zero for none
+    edges       for each edge, the offset of its label in the label
+                pool and the index of its child node, sorted by label
+                within each node so that they can be binary searched
+    labels      each label as a length byte followed by UTF-8 bytes
+    categories  the category names, one per line, numbered from one
+
+Node zero is the root, whose edges are the top level domains.'''
+
+import bisect
+import collections
+import contextlib
+import mmap
+import os
+import struct
+
+import epipydb
+
+from typing import *
+
+
+CATEGORY_TRIE_PATH = '/var/lib/epipyweb/categories.trie'
+
+TRIE_MAGIC = b'EPITRIE1'
+TRIE_HEADER = struct.Struct('<8sIIII')
+TRIE_NODE = struct.Struct('<IIH2x')
+TRIE_EDGE = struct.Struct('<II')
+
+
+class CategoryTrie:
+
+    '''A memory-mapped category trie file.  The file is reopened when
+    it is replaced, and lookups find nothing while it doesn't exist or
+    can't be read.'''
+
+    def __init__(
+            self,
+            path: str) -> None:
+
+        self.path = path
+        self.signature = cast(Optional[Tuple[int, int]], None)
+        self.map = cast(Optional[mmap.mmap], None)
+        self.node_count = 0
+        self.edges_offset = 0
+        self.labels_offset = 0
+        self.categories = cast(List[str], [])
+
+    def refresh(self) -> None:
+
+        'Open the trie file, or reopen it if it has been replaced'
+
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            signature = None
+
+        if signature == self.signature:
+            return
+
+        self.close()
+        self.signature = signature
+        if signature is not None:
+            #  A damaged file is left unused until it is replaced
+            with contextlib.suppress(OSError, ValueError, struct.error):
+                self.open()
+
+    def open(self) -> None:
+
+        'Map the trie file into memory and read its header'
+
+        with open(self.path, 'rb') as trie_file:
+            self.map = mmap.mmap(
+                trie_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.node_count, edge_count, self.labels_offset,
+            categories_offset) = TRIE_HEADER.unpack_from(self.map, 0)
+        if magic != TRIE_MAGIC:
+            self.map.close()
+            self.map = None
+            raise ValueError(self.path)
+
+        self.edges_offset = TRIE_HEADER.size + \
+            self.node_count * TRIE_NODE.size
+        self.categories = [''] + \
+            self.map[categories_offset:].decode('utf-8').split('\n')
+
+    def close(self) -> None:
+
+        'Unmap the trie file'
+
+        if self.map is not None:
+            self.map.close()
+        self.map = None
+        self.signature = None
+
+    def find_child(
+            self,
+            node: int,
+            label: bytes) -> Optional[int]:
+
+        'Binary search the edges of a node for a label'
+
+        assert self.map is not None
+
+        (first_edge, edge_count, _) = TRIE_NODE.unpack_from(
+            self.map, TRIE_HEADER.size + node * TRIE_NODE.size)
+
+        low = first_edge
+        high = first_edge + edge_count
+        while low < high:
+            middle = (low + high) // 2
+            (label_offset, child) = TRIE_EDGE.unpack_from(
+                self.map, self.edges_offset + middle * TRIE_EDGE.size)
+
+            start = self.labels_offset + label_offset
+            end = start + 1 + self.map[start]
+            edge_label = self.map[start + 1:end]
+
+            if edge_label < label:
+                low = middle + 1
+            elif edge_label > label:
+                high = middle
+            else:
+                return child
+
+        return None
+
+    def node_category(
+            self,
+            node: int) -> int:
+
+        'The category number of a node, or zero if it has none'
+
+        assert self.map is not None
+
+        (_, _, category) = TRIE_NODE.unpack_from(
+            self.map, TRIE_HEADER.size + node * TRIE_NODE.size)
+        return category
+
+    def lookup(
+            self,
+            hostname: str) -> Optional[str]:
+
+        '''Find the category of a domain name, walking down from its top
+        level domain through the same subdomains as list_domains, one
+        label at a time'''
+
+        if self.map is None:
+            return None
+
+        hostname = hostname.lower()
+        node = self.find_child(0, hostname.split('.')[-1].encode('utf-8'))
+        if node is None:
+            return None
+        category = self.node_category(node)
+
+        for subdomain in epipydb.list_domains(hostname):
+            label = subdomain.split('.', 1)[0]
+            node = self.find_child(node, label.encode('utf-8'))
+            if node is None:
+                break
+
+            category = self.node_category(node) or category
+
+        return self.categories[category] or None
+
+
+def open_category_trie(
+        path: str = CATEGORY_TRIE_PATH) -> CategoryTrie:
+
+    'Open a category trie file, if it exists'
+
+    trie = CategoryTrie(path)
+    trie.refresh()
+    return trie
+
+
+def parse_domain_list(
+        lines: Iterable[str]) -> Iterator[str]:
+
+    '''Iterate over the domains in a blocklist, which may be a plain list
+    of domains or in hosts file format, ignoring comments'''
+
+    for line in lines:
+        fields = line.split('#', 1)[0].split()
+        if len(fields) > 1 and fields[0] in ['0.0.0.0', '127.0.0.1', '::']:
+            fields = fields[1:]
+
+        for field in fields[:1]:
+            domain = field.strip('.').lower()
+            if domain and domain != 'localhost':
+                yield domain
+
+
+def build_trie(
+        categories: List[Tuple[str, Iterable[str]]]) -> bytes:
+
+    '''Compile lists of domains, each with a category name, into the
+    trie file format.  A domain in several lists takes the category of
+    the first list it appears in.'''
+
+    domain_categories = cast(Dict[str, int], {})
+    for (index, (_, domains)) in enumerate(categories):
+        for domain in domains:
+            #  Key by labels from the top level domain down, separated
+            #  by a character which sorts before any label character,
+            #  so that each node's descendants sort together
+            key = str.join('\0', reversed(domain.split('.')))
+            domain_categories.setdefault(key, index + 1)
+
+    keys = sorted(domain_categories)
+
+    nodes = [[0, 0, 0]]
+    edges = cast(List[Tuple[int, int]], [])
+    labels = bytearray()
+    label_offsets = cast(Dict[str, int], {})
+
+    #  Add the nodes breadth first, so that each node's edges are added
+    #  together when it is visited
+    pending = collections.deque([(0, 0, len(keys), '')])
+    while pending:
+        (node, low, high, prefix) = pending.popleft()
+        nodes[node][0] = len(edges)
+
+        if prefix and low < high and keys[low] == prefix[:-1]:
+            nodes[node][2] = domain_categories[keys[low]]
+            low += 1
+
+        while low < high:
+            label = keys[low][len(prefix):].split('\0', 1)[0]
+            child_high = bisect.bisect_left(
+                keys, prefix + label + '\1', low, high)
+
+            if label not in label_offsets:
+                label_bytes = label.encode('utf-8')[:255]
+                label_offsets[label] = len(labels)
+                labels.append(len(label_bytes))
+                labels.extend(label_bytes)
+
+            child = len(nodes)
+            nodes.append([0, 0, 0])
+            edges.append((label_offsets[label], child))
+            pending.append((child, low, child_high, prefix + label + '\0'))
+
+            low = child_high
+
+        nodes[node][1] = len(edges) - nodes[node][0]
+
+    labels_offset = TRIE_HEADER.size + len(nodes) * TRIE_NODE.size + \
+        len(edges) * TRIE_EDGE.size
+    categories_offset = labels_offset + len(labels)
+
+    trie = bytearray(categories_offset)
+    TRIE_HEADER.pack_into(
+        trie, 0, TRIE_MAGIC, len(nodes), len(edges), labels_offset,
+        categories_offset)
+
+    offset = TRIE_HEADER.size
+    for (first_edge, edge_count, category) in nodes:
+        TRIE_NODE.pack_into(trie, offset, first_edge, edge_count, category)
+        offset += TRIE_NODE.size
+
+    for (label_offset, child) in edges:
+        TRIE_EDGE.pack_into(trie, offset, label_offset, child)
+        offset += TRIE_EDGE.size
+
+    trie[labels_offset:categories_offset] = labels
+    trie.extend(str.join('\n', [
+        name for (name, _) in categories]).encode('utf-8'))
+
+    return bytes(trie)
+
+
+def write_trie(
+        path: str,
+        trie: bytes) -> None:
+
+    '''Write a trie file, replacing any previous one at once, so the
+    recorder never maps a partly written file'''
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as trie_file:
+        trie_file.write(trie)
+    os.rename(temp_path, path)
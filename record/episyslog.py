@@ -18,13 +18,19 @@
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import argparse
 import contextlib
 import os
+import selectors
 import sys
 import syslog
 import traceback
 
 import epipydb
+import epipyforward
+import epipyhot
+import epipyprofile
+import epipytrie
 
 from typing import *
 
@@ -54,26 +60,168 @@ def test_lock_held() -> bool:
         return False
 
 
+def parse_cmdline() -> argparse.Namespace:
+
+    'Parse the commandline, collecting forwarding options'
+
+    parser = argparse.ArgumentParser(
+        description='Record dnsmasq syslog lines to the epipyweb database')
+
+    parser.add_argument(
+        '--forward', metavar='url',
+        help='also forward records to the /q/ingest URL of another epipyweb')
+    parser.add_argument(
+        '--device',
+        help='device name used by the central instance to namespace hosts,' +
+        ' unique among the forwarding devices and required with --forward')
+    parser.add_argument(
+        '--token-file', default=epipyforward.TOKEN_PATH,
+        help='file holding the token the central instance requires')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='maximum number of records in a forwarded batch')
+    parser.add_argument(
+        '--batch-interval', type=float, default=10.0,
+        help='maximum seconds to wait before forwarding a batch')
+    parser.add_argument(
+        '--hot-socket', default=epipyhot.HOT_SOCKET_PATH,
+        help='Unix socket path for serving the newest query groups,' +
+        ' or an empty string to disable')
+    parser.add_argument(
+        '--categories', default=epipytrie.CATEGORY_TRIE_PATH,
+        help='category trie file used to tag DNS queries')
+    parser.add_argument(
+        '--coalesce-repeats', action='store_true',
+        help='count repeats of a query within its group on one row')
+
+    args = parser.parse_args()
+
+    #  Devices of the same model often share a hostname, so the device
+    #  name isn't defaulted to it, as their batches would then be taken
+    #  as one device's
+    if args.forward and not args.device:
+        parser.error('--device is required with --forward')
+
+    return args
+
+
 def handle_log_line(
-        line: str) -> None:
+        line: str,
+        forwarder: Optional[epipyforward.Forwarder],
+        hot_tier: Optional[epipyhot.HotTier],
+        coalesce: bool,
+        categories: epipytrie.CategoryTrie) -> None:
+
+    '''Commit a single log line to the database, tagged with its category,
+    add it to the hot tier, and queue it for forwarding'''
 
-    'Commit a single log line to the database'
+    record = epipydb.parse_line(line)
+    if not record:
+        return
+
+    categories.refresh()
 
     with contextlib.closing(epipydb.open_database()) as db:
         if not test_lock_held():
-            epipydb.log_line(db, line)
+            #  Check the hot tier is current while holding the write lock,
+            #  so that no other writer can commit between the check and
+            #  the recorder's own commit unnoticed
+            db.execute('BEGIN IMMEDIATE')
+            if hot_tier:
+                hot_tier.check_current()
+
+            query_id = epipydb.log_record(
+                db, record, coalesce=coalesce,
+                category_lookup=categories.lookup)
             db.commit()
 
+            if hot_tier:
+                hot_tier.record(db, query_id)
+
+    if forwarder:
+        forwarder.add(record)
+
 
 def main() -> None:
 
     'Record dnsmasq syslog lines to the epipyweb database'
 
-    for line in sys.stdin:
+    args = parse_cmdline()
+    epipyprofile.install_signal_toggle('episyslog', syslog.syslog)
+
+    forwarder = None
+    if args.forward:
+        try:
+            token = epipyforward.read_token(args.token_file)
+        except OSError:
+            syslog_trace(traceback.format_exc())
+        else:
+            forwarder = epipyforward.Forwarder(
+                args.forward, args.device, token, args.batch_size,
+                args.batch_interval)
+
+    categories = epipytrie.CategoryTrie(args.categories)
+
+    selector = selectors.DefaultSelector()
+    selector.register(sys.stdin.fileno(), selectors.EVENT_READ)
+
+    hot_tier = None
+    if args.hot_socket:
+        epipyhot.HOT_SOCKET_PATH = args.hot_socket
         try:
-            handle_log_line(line)
-        except:
+            hot_sock = epipyhot.open_hot_socket()
+        except OSError:
             syslog_trace(traceback.format_exc())
+        else:
+            hot_tier = epipyhot.HotTier()
+            selector.register(hot_sock, selectors.EVENT_READ, hot_tier)
+
+    #  Read stdin unbuffered, so that the selector doesn't miss lines
+    #  which have already been buffered when waiting for a timeout
+    read_buffer = b''
+    end_of_input = False
+    while not end_of_input:
+        timeout = None
+        if forwarder:
+            timeout = forwarder.timeout()
+
+        for (key, _) in selector.select(timeout):
+            if key.data is not None:
+                try:
+                    epipyhot.handle_hot_connection(
+                        hot_sock, key.data, test_lock_held())
+                except Exception:
+                    syslog_trace(traceback.format_exc())
+                continue
+
+            data = os.read(key.fd, 65536)
+            if not data:
+                end_of_input = True
+
+            read_buffer += data
+            lines = read_buffer.split(b'\n')
+            read_buffer = lines.pop()
+            if end_of_input and read_buffer:
+                lines.append(read_buffer)
+
+            for line in lines:
+                try:
+                    handle_log_line(
+                        line.decode('utf-8', 'replace'), forwarder,
+                        hot_tier, args.coalesce_repeats, categories)
+                except Exception:
+                    syslog_trace(traceback.format_exc())
+
+        #  Batches are only queued here, and sent by the forwarder's own
+        #  thread, so a slow central instance doesn't hold up recording
+        if forwarder:
+            try:
+                if end_of_input:
+                    forwarder.close()
+                else:
+                    forwarder.flush_if_due()
+            except Exception:
+                syslog_trace(traceback.format_exc())
 
 
 if __name__ == '__main__':
@@ -27,6 +27,8 @@ import sqlite3
 import sys
 
 import epipydb
+import epipyprofile
+import epipytrie
 
 from typing import *
 
@@ -41,20 +43,28 @@ def parse_cmdline() -> argparse.Namespace:
     parser.add_argument(
         'logfiles', metavar='logfile', nargs='+',
         help='log files to import')
+    parser.add_argument(
+        '--categories', default=epipytrie.CATEGORY_TRIE_PATH,
+        help='category trie file used to tag DNS queries')
+    parser.add_argument(
+        '--coalesce-repeats', action='store_true',
+        help='count repeats of a query within its group on one row')
 
     return parser.parse_args()
 
 
 def import_log(
         db: sqlite3.Connection,
-        logpath: str) -> None:
+        logpath: str,
+        coalesce: bool,
+        categories: epipytrie.CategoryTrie) -> None:
 
     'Match all the DNS query lines in the logfile and store them in the DB'
 
     linecount = 0
     with open(logpath) as logfile:
         for logline in logfile:
-            epipydb.log_line(db, logline)
+            epipydb.log_line(db, logline, coalesce, categories.lookup)
 
             linecount += 1
             if linecount % 100 == 0:
@@ -69,12 +79,15 @@ def main() -> None:
     'Given a list of logfiles, record all their DNS queries'
 
     args = parse_cmdline()
+    epipyprofile.install_signal_toggle(
+        'import-syslog', lambda message: sys.stderr.write(message + '\n'))
+    categories = epipytrie.open_category_trie(args.categories)
 
     with contextlib.closing(epipydb.open_database()) as db:
         success = True
         for log in args.logfiles:
             try:
-                import_log(db, log)
+                import_log(db, log, args.coalesce_repeats, categories)
                 db.commit()
             except IOError as e:
                 err = sys.argv[0] + ': ' + log + ' ' + str(e) + '\n'
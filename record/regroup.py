@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import argparse
+import contextlib
+import datetime
+import sqlite3
+import sys
+
+import epipydb
+
+from typing import *
+
+
+REGROUP_BATCH_SIZE = 1000
+
+
+class GroupingRules:
+
+    'The tunable parameters deciding which queries are grouped together'
+
+    def __init__(
+            self,
+            time_tolerance: int,
+            extended_time: int,
+            max_queries: int) -> None:
+
+        self.time_tolerance = time_tolerance
+        self.extended_time = extended_time
+        self.max_queries = max_queries
+
+
+class QueryGroup:
+
+    'A query group being assembled while sweeping through DNS queries'
+
+    def __init__(
+            self,
+            index: int,
+            host: str,
+            query_id: int,
+            query_time: datetime.datetime,
+            query_value: str) -> None:
+
+        self.index = index
+        self.host = host
+        self.start_time = query_time
+        self.end_time = query_time
+        self.first_id = query_id
+        self.first_value = query_value
+        self.query_count = 1
+        self.values = set([query_value])
+
+    def accepts(
+            self,
+            rules: GroupingRules,
+            query_time: datetime.datetime,
+            query_value: str) -> bool:
+
+        '''Does a query belong in this group?  This mirrors
+        epipydb.is_query_in_group, but with the group's values in
+        memory rather than queried from the database.'''
+
+        if self.query_count >= rules.max_queries:
+            return False
+
+        if self.start_time <= query_time and query_time <= self.end_time:
+            return True
+        elif self.start_time < query_time:
+            diff_time = query_time - self.start_time
+
+            if diff_time.days == 0 and \
+                    diff_time.seconds < rules.time_tolerance:
+                return True
+
+            if diff_time.days == 0 and \
+                    diff_time.seconds < rules.extended_time and \
+                    query_value in self.values:
+                return True
+
+        return False
+
+    def add(
+            self,
+            query_id: int,
+            query_time: datetime.datetime,
+            query_value: str) -> None:
+
+        'Add a query to the group, updating the derived columns'
+
+        self.start_time = min(self.start_time, query_time)
+        self.end_time = max(self.end_time, query_time)
+        if query_id < self.first_id:
+            self.first_id = query_id
+            self.first_value = query_value
+        self.query_count += 1
+        self.values.add(query_value)
+
+
+def parse_cmdline() -> argparse.Namespace:
+
+    'Parse the commandline, collecting the grouping parameters'
+
+    parser = argparse.ArgumentParser(
+        description='Recompute the query groups in the epipyweb database')
+
+    parser.add_argument(
+        '--since', type=epipydb.isotime_to_datetime,
+        help='regroup from this time (YYYY-MM-DDTHH:MM:SS) onward,' +
+        ' rather than the whole database')
+    parser.add_argument(
+        '--time-tolerance', type=int,
+        default=epipydb.QUERY_GROUP_TIME_TOLERANCE,
+        help='seconds after the start of a group any query may join it')
+    parser.add_argument(
+        '--extended-time', type=int,
+        default=epipydb.QUERY_GROUP_EXTENDED_TIME,
+        help='seconds after the start of a group a repeated query may' +
+        ' join it')
+    parser.add_argument(
+        '--max-queries', type=int,
+        default=epipydb.QUERY_GROUP_MAX_QUERIES,
+        help='maximum number of queries in a group')
+
+    return parser.parse_args()
+
+
+def first_regroup_id(
+        db: sqlite3.Connection,
+        since: Optional[datetime.datetime]) -> Optional[int]:
+
+    'Find the lowest query group id starting at or after a time'
+
+    with contextlib.closing(db.cursor()) as cursor:
+        if since:
+            cursor.execute(
+                'SELECT MIN(id) FROM querygroup WHERE start_time >= ?',
+                (since.isoformat(),))
+        else:
+            cursor.execute('SELECT MIN(id) FROM querygroup')
+
+        return cursor.fetchone()[0]
+
+
+def newest_query_id(
+        db: sqlite3.Connection) -> int:
+
+    'Find the id of the newest DNS query, from the end of the primary key'
+
+    with contextlib.closing(db.cursor()) as cursor:
+        cursor.execute('SELECT MAX(id) FROM dnsquery')
+
+        return cursor.fetchone()[0] or 0
+
+
+def sweep_rows(
+        db: sqlite3.Connection,
+        first_group_id: int,
+        max_id: int) -> Iterator[Tuple[int, str, str, str, str]]:
+
+    '''Read the queries in the groups being rebuilt, up to a newest id,
+    sorted by host and time, as the id, time, last time, value and host
+    of each.
+
+    The database has a rollback journal, so while a statement is
+    reading, the recorder can't commit.  Each host is read through the
+    host and time index instead, a batch of rows per statement, from
+    the earliest start of the groups being rebuilt, continuing from
+    the time and id of the last row read.  The rows sharing that time
+    are finished first, in id order, so that a batch never ends part
+    way through them.'''
+
+    with contextlib.closing(db.cursor()) as cursor:
+        cursor.execute(
+            'SELECT MIN(start_time) FROM querygroup WHERE id >= ?',
+            (first_group_id,))
+        start_iso = cursor.fetchone()[0]
+
+        cursor.execute(
+            'SELECT DISTINCT host FROM querygroup WHERE id >= ?' +
+            ' ORDER BY host',
+            (first_group_id,))
+        hosts = [row[0] for row in cursor.fetchall()]
+
+        for host in hosts:
+            (last_time_iso, last_id) = (start_iso, 0)
+            while True:
+                cursor.execute(
+                    'SELECT id, time, COALESCE(last_time, time), value' +
+                    ' FROM dnsquery' +
+                    ' WHERE host = ? AND time = ? AND id > ? AND id <= ?' +
+                    '     AND group_id >= ?' +
+                    ' ORDER BY id',
+                    (host, last_time_iso, last_id, max_id, first_group_id))
+                rows = cursor.fetchall()
+
+                cursor.execute(
+                    'SELECT id, time, COALESCE(last_time, time), value' +
+                    ' FROM dnsquery' +
+                    ' WHERE host = ? AND time > ? AND id <= ?' +
+                    '     AND group_id >= ?' +
+                    ' ORDER BY time, id LIMIT ?',
+                    (host, last_time_iso, max_id, first_group_id,
+                     REGROUP_BATCH_SIZE))
+                batch = cursor.fetchall()
+                rows.extend(batch)
+
+                for row in rows:
+                    yield row + (host,)
+
+                if len(batch) < REGROUP_BATCH_SIZE:
+                    break
+                (last_id, last_time_iso) = batch[-1][:2]
+
+
+def assign_query(
+        groups: List[QueryGroup],
+        latest: Dict[str, QueryGroup],
+        rules: GroupingRules,
+        row: Tuple[int, str, str, str, str]) -> int:
+
+    '''Add a query to the newest group of its host, or to a new group if
+    it doesn't belong there, returning the index of its group.
+
+    Only the newest group of each host keeps its set of values, so
+    memory grows with the number of groups rather than the number of
+    queries.'''
+
+    (query_id, query_time_iso, last_time_iso, query_value, host) = row
+    query_time = epipydb.isotime_to_datetime(query_time_iso)
+
+    group = latest.get(host)
+    if group and group.accepts(rules, query_time, query_value):
+        group.add(query_id, query_time, query_value)
+    else:
+        #  The group being replaced can't be added to again
+        if group:
+            group.values = set()
+        group = QueryGroup(
+            len(groups), host, query_id, query_time, query_value)
+        groups.append(group)
+        latest[host] = group
+
+    #  A row with coalesced repeats extends to its last repeat
+    group.end_time = max(
+        group.end_time, epipydb.isotime_to_datetime(last_time_iso))
+
+    return group.index
+
+
+def sweep_queries(
+        db: sqlite3.Connection,
+        rules: GroupingRules,
+        first_group_id: int,
+        max_id: int) -> List[QueryGroup]:
+
+    '''Assign every query in the groups being rebuilt, up to a newest
+    id, to a new group, in a single pass over the queries sorted by
+    host and time, without holding a transaction open.
+
+    The new group of each query is recorded by index in the temporary
+    regroupquery table, as the final group ids aren't known until
+    all groups have been formed.  Each batch is committed as it is
+    written, so that writing to the temporary table doesn't keep a
+    transaction open across the reads of the database.'''
+
+    groups = cast(List[QueryGroup], [])
+    latest = cast(Dict[str, QueryGroup], {})
+    assignments = cast(List[Tuple[int, int]], [])
+
+    for row in sweep_rows(db, first_group_id, max_id):
+        assignments.append(
+            (row[0], assign_query(groups, latest, rules, row)))
+        if len(assignments) >= REGROUP_BATCH_SIZE:
+            db.executemany(
+                'INSERT INTO regroupquery (query_id, group_index)' +
+                ' VALUES (?,?)',
+                assignments)
+            db.commit()
+            assignments = []
+
+    db.executemany(
+        'INSERT INTO regroupquery (query_id, group_index) VALUES (?,?)',
+        assignments)
+    db.commit()
+
+    return groups
+
+
+def carry_over_queries(
+        db: sqlite3.Connection,
+        rules: GroupingRules,
+        groups: List[QueryGroup],
+        first_group_id: int,
+        max_id: int) -> None:
+
+    '''Assign the queries recorded since the sweep began to the new
+    groups, while holding the write lock, so that none are left
+    pointing at a group which is about to be replaced.  They are added
+    to the newest group of their host, or to groups of their own.'''
+
+    latest = {group.host: group for group in groups}
+
+    with contextlib.closing(db.cursor()) as cursor:
+        cursor.execute(
+            'SELECT id, time, COALESCE(last_time, time), value, host' +
+            ' FROM dnsquery WHERE id > ? AND group_id >= ?' +
+            ' ORDER BY id',
+            (max_id, first_group_id))
+
+        db.executemany(
+            'INSERT INTO regroupquery (query_id, group_index) VALUES (?,?)',
+            [(row[0], assign_query(groups, latest, rules, row))
+             for row in cursor.fetchall()])
+
+
+def rewrite_groups(
+        db: sqlite3.Connection,
+        groups: List[QueryGroup],
+        first_group_id: int) -> None:
+
+    '''Replace the query groups from the first regrouped id onward with
+    the newly formed groups, and point the queries and query domains
+    at them.  New ids are assigned in order of start time, so that
+    group ids continue to increase with time.'''
+
+    groups = sorted(groups, key=lambda g: (g.start_time, g.first_id))
+
+    db.executemany(
+        'INSERT INTO regroupid (group_index, group_id) VALUES (?,?)',
+        [(group.index, first_group_id + i)
+            for (i, group) in enumerate(groups)])
+
+    db.execute(
+        'DELETE FROM querygroup WHERE id >= ?',
+        (first_group_id,))
+    db.executemany(
+        'INSERT INTO querygroup' +
+        ' (id, host, start_time, end_time, first_value, query_count)' +
+        ' VALUES (?,?,?,?,?,?)',
+        [(first_group_id + i, group.host,
+            group.start_time.isoformat(), group.end_time.isoformat(),
+            group.first_value, group.query_count)
+            for (i, group) in enumerate(groups)])
+
+    db.execute(
+        'UPDATE dnsquery SET group_id =' +
+        ' (SELECT regroupid.group_id FROM regroupquery, regroupid' +
+        '     WHERE regroupquery.query_id = dnsquery.id' +
+        '     AND regroupid.group_index = regroupquery.group_index)' +
+        ' WHERE group_id >= ?',
+        (first_group_id,))
+    db.execute(
+        'UPDATE querygroup SET category =' +
+        ' (SELECT category FROM dnsquery' +
+        '     WHERE dnsquery.group_id = querygroup.id' +
+        '     AND category IS NOT NULL' +
+        '     ORDER BY id LIMIT 1)' +
+        ' WHERE id >= ?',
+        (first_group_id,))
+    db.execute(
+        'UPDATE querydomain SET group_id =' +
+        ' (SELECT group_id FROM dnsquery' +
+        '     WHERE dnsquery.id = querydomain.query_id)' +
+        ' WHERE group_id >= ?',
+        (first_group_id,))
+
+
+def regroup(
+        db: sqlite3.Connection,
+        rules: GroupingRules,
+        since: Optional[datetime.datetime]) -> int:
+
+    '''Recompute the query groups starting at or after a time.  Returns
+    the number of groups formed.
+
+    The queries are swept without holding a transaction open, so that
+    the recorder can keep writing.  The write lock is taken only to
+    replace the groups, in one transaction, after assigning the
+    queries recorded during the sweep.'''
+
+    group_count = 0
+
+    #  The temporary tables are dropped however the regroup ends, so
+    #  that it can be retried on the same connection after a failure
+    try:
+        db.execute(
+            'CREATE TEMP TABLE regroupquery' +
+            ' (query_id INTEGER PRIMARY KEY, group_index INTEGER)')
+        db.execute(
+            'CREATE TEMP TABLE regroupid' +
+            ' (group_index INTEGER PRIMARY KEY, group_id INTEGER)')
+
+        first_group_id = first_regroup_id(db, since)
+        if first_group_id is not None:
+            max_id = newest_query_id(db)
+            groups = sweep_queries(db, rules, first_group_id, max_id)
+
+            db.execute('BEGIN IMMEDIATE')
+            carry_over_queries(db, rules, groups, first_group_id, max_id)
+            rewrite_groups(db, groups, first_group_id)
+            group_count = len(groups)
+            db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.execute('DROP TABLE IF EXISTS regroupquery')
+        db.execute('DROP TABLE IF EXISTS regroupid')
+
+    return group_count
+
+
+def main() -> None:
+
+    'Recompute the query groups with the given grouping parameters'
+
+    args = parse_cmdline()
+    rules = GroupingRules(
+        args.time_tolerance, args.extended_time, args.max_queries)
+
+    with contextlib.closing(epipydb.open_database()) as db:
+        group_count = regroup(db, rules, args.since)
+
+    sys.stdout.write('Formed {} query groups\n'.format(group_count))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,13 @@
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import calendar
 import contextlib
+import csv
+import datetime
+import hmac
+import io
+import itertools
 import json
 import os
 import re
@@ -25,6 +31,15 @@ import socket
 import sqlite3
 import urllib.parse
 import uwsgi
+import zlib
+
+import epipyarchive
+import epipydb
+import epipyhot
+import epipyprofile
+import epipysuggest
+import epipytimeline
+import epipytrie
 
 from typing import *
 
@@ -32,6 +47,53 @@ from typing import *
 DATABASE_PATH = '/var/lib/epipyweb/dns.db'
 EPIPYNET_SOCKET_PATH = '/var/run/epipynet/epipynet.sock'
 
+HOT_TIER_TIMEOUT = 1
+
+GROUPQUERIES_MAX_GROUPS = 100
+
+#  How each column is encoded in the columnar response format
+COLUMNAR_ENCODING = {
+    'id': 'delta',
+    'time': 'delta_time',
+    'last_time': 'delta_time',
+    'host': 'dictionary',
+    'category': 'dictionary',
+}
+
+GROUPQUERIES_COLUMNS = ['id', 'value', 'time', 'repeat_count', 'last_time']
+
+#  Each uWSGI worker keeps its own index of domains for suggestions,
+#  built a chunk at a time by the first requests for suggestions and
+#  refreshed from then on
+SUGGEST_INDEX = epipysuggest.DomainIndex()
+
+#  Each uWSGI worker also caches the counts of timeline buckets which
+#  have ended
+TIMELINE_CACHE = epipytimeline.TimelineCache()
+TIMELINE_MAX_DOMAINS = 20
+
+#  And the archive day files it read most recently, so that a page of
+#  the archive and the queries of its groups are decoded only once
+ARCHIVE_CACHE = epipyarchive.ArchiveCache()
+
+#  Each uWSGI worker can profile itself on request, if profiling has
+#  been enabled through the environment
+PROFILER = None
+if epipyprofile.profiling_enabled():
+    PROFILER = epipyprofile.Profiler('epipyweb')
+
+INGEST_MAX_BATCH_SIZE = 16 * 1024 * 1024
+
+#  Ingest is only enabled once a shared token has been written here,
+#  and forwarding devices must send the same token with each batch
+INGEST_TOKEN_PATH = '/etc/epipyweb/ingest.token'
+
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_COLUMNS = [
+    'id', 'group_id', 'time', 'type', 'value', 'host', 'host_ip',
+    'group_start_time', 'group_end_time', 'group_query_count',
+    'repeat_count', 'last_time', 'category']
+
 
 StartResponseHeaders = Iterable[Tuple[str, str]]
 StartResponse = Callable[[str, StartResponseHeaders], None]
@@ -48,8 +110,9 @@ def groupqueries_page(
 
     with contextlib.closing(db.cursor()) as cursor:
         cursor.execute(
-            'SELECT id, value, time FROM dnsquery' +
-            ' WHERE group_id = ?' +
+            'SELECT id, value, time, repeat_count,' +
+            '     COALESCE(last_time, time)' +
+            ' FROM dnsquery WHERE group_id = ?' +
             ' ORDER BY id ASC' +
             ' LIMIT ?',
             (group_id, count))
@@ -62,63 +125,106 @@ def groupqueries_page(
                 'id': row[0],
                 'value': row[1],
                 'time': row[2],
+                'repeat_count': row[3],
+                'last_time': row[4],
             })
 
         return result
 
 
+def groupqueries_batch(
+        db: sqlite3.Connection,
+        group_ids: List[int],
+        count: int) -> Dict:
+
+    '''Retrieve a page of DNS queries for each of several group IDs,
+    with a single pass over the group index'''
+
+    result = cast(Dict, {
+        'groups': {},
+    })
+    for group_id in group_ids:
+        result['groups'][group_id] = {
+            'queries': [],
+        }
+
+    if not group_ids:
+        return result
+
+    with contextlib.closing(db.cursor()) as cursor:
+        cursor.execute(
+            'SELECT group_id, id, value, time, repeat_count,' +
+            '     COALESCE(last_time, time)' +
+            ' FROM dnsquery WHERE group_id IN (' +
+            str.join(',', ['?'] * len(group_ids)) + ')' +
+            ' ORDER BY group_id ASC, id ASC',
+            group_ids)
+
+        for row in cursor.fetchall():
+            queries = result['groups'][row[0]]['queries']
+            if len(queries) < count:
+                queries.append({
+                    'id': row[1],
+                    'value': row[2],
+                    'time': row[3],
+                    'repeat_count': row[4],
+                    'last_time': row[5],
+                })
+
+    return result
+
+
 def dnsquerygroup_page_sql(
         search_value: Optional[str],
+        category: Optional[str],
         before_id: Optional[int],
         after_id: Optional[int],
         count: int) -> Tuple[str, List[Any], bool]:
 
     'Generate the SQL for searching for a page of DNS query groups'
 
-    sql = ''
-    where = ''
+    conditions = []
     sql_args = cast(List[Any], [])
     order = 'DESC'
     reverse = False
 
     if before_id:
-        where += ' WHERE querygroup.id < ?'
+        conditions.append('querygroup.id < ?')
         sql_args += [before_id]
     elif after_id:
-        where += ' WHERE querygroup.id > ?'
+        conditions.append('querygroup.id > ?')
         sql_args += [after_id]
         order = 'ASC'
         reverse = True
 
+    #  Select the groups through IN subqueries, rather than DISTINCT
+    #  joins, so that the matching group ids are collected into a set
+    #  which can be walked in id order, instead of being sorted in a
+    #  temporary B-tree
+    if category:
+        conditions.append(
+            'querygroup.id IN (SELECT group_id FROM dnsquery' +
+            '     WHERE category = ?)')
+        sql_args += [category]
+
     if search_value:
-        if where == '':
-            where = ' WHERE'
-        else:
-            where = where + ' AND'
-
-        sql = \
-            'SELECT DISTINCT querygroup.id, querygroup.query_count,' + \
-            '     querygroup.start_time, querygroup.host,' + \
-            '     querygroup.first_value' + \
-            ' FROM querydomain, querygroup' + \
-            where + \
-            '     querydomain.domain COLLATE NOCASE BETWEEN ? AND ?' + \
-            '     AND querydomain.group_id = querygroup.id' + \
-            ' ORDER BY querydomain.group_id ' + order + \
-            ' LIMIT ?'
-        sql_args += [search_value, search_value + '~', count]
-
-        where = ''
-    else:
-        sql = \
-            'SELECT id, query_count, start_time,' + \
-            '     host, first_value' + \
-            ' FROM querygroup' + \
-            where + \
-            ' ORDER BY id ' + order + \
-            ' LIMIT ?'
+        conditions.append(
+            'querygroup.id IN (SELECT group_id FROM querydomain' +
+            '     WHERE domain COLLATE NOCASE BETWEEN ? AND ?)')
+        sql_args += [search_value, search_value + '~']
 
-        sql_args += [count]
+    where = ''
+    if conditions:
+        where = ' WHERE ' + str.join(' AND ', conditions)
+
+    sql = \
+        'SELECT id, query_count, start_time,' + \
+        '     host, first_value, category' + \
+        ' FROM querygroup' + \
+        where + \
+        ' ORDER BY querygroup.id ' + order + \
+        ' LIMIT ?'
+    sql_args += [count]
 
     return (sql, sql_args, reverse)
 
@@ -128,6 +234,7 @@ def check_neighbor_pages_present(
         rows: List[Any],
         count: int,
         search_value: Optional[str],
+        category: Optional[str],
         before_id: Optional[int],
         after_id: Optional[int]) -> Tuple[bool, bool]:
 
@@ -145,14 +252,14 @@ def check_neighbor_pages_present(
     with contextlib.closing(db.cursor()) as cursor:
         if before_id is not None:
             (sql, sql_args, _) = dnsquerygroup_page_sql(
-                search_value, None, before_id, 1)
+                search_value, category, None, before_id, 1)
             cursor.execute(sql, sql_args)
             if cursor.fetchone():
                 previous_page_present = True
 
         if after_id is not None:
             (sql, sql_args, _) = dnsquerygroup_page_sql(
-                search_value, after_id, None, 1)
+                search_value, category, after_id, None, 1)
             cursor.execute(sql, sql_args)
             if cursor.fetchone():
                 next_page_present = True
@@ -163,6 +270,7 @@ def check_neighbor_pages_present(
 def dnsquerygroup_page(
         db: sqlite3.Connection,
         search_value: Optional[str],
+        category: Optional[str],
         before_id: Optional[int],
         after_id: Optional[int],
         count: int) -> Dict:
@@ -175,7 +283,7 @@ def dnsquerygroup_page(
 
     with contextlib.closing(db.cursor()) as cursor:
         (sql, sql_args, reverse) = dnsquerygroup_page_sql(
-            search_value, before_id, after_id, count + 1)
+            search_value, category, before_id, after_id, count + 1)
 
         cursor.execute(sql, sql_args)
         rows = cursor.fetchall()
@@ -188,7 +296,7 @@ def dnsquerygroup_page(
 
     (result['previous_page_present'], result['next_page_present']) = \
         check_neighbor_pages_present(
-            db, rows, count, search_value, before_id, after_id)
+            db, rows, count, search_value, category, before_id, after_id)
 
     if len(rows) > count:
         rows = rows[:count]
@@ -200,6 +308,7 @@ def dnsquerygroup_page(
             'time': row[2],
             'host': row[3],
             'value': row[4],
+            'category': row[5],
         })
 
     if reverse:
@@ -221,30 +330,149 @@ def sanitize_search(
     return match.group(0)
 
 
-def groupqueries(
-        query: QueryArgs) -> Dict:
+def sanitize_category(
+        category: str) -> str:
 
-    '''Handle a request for the DNS queries associated with a
-    connection group.'''
+    'Ensure a category name contains only word characters'
 
-    count = 100
-    with contextlib.suppress(KeyError, ValueError):
-        count = int(query['count'][0])
+    match = re.match(r'^[-A-Za-z0-9_]+$', category)
 
-    group_id = None
-    try:
-        group_id = int(query['id'][0])
-    except (KeyError, ValueError):
-        return {'error': 'missing group id'}
+    if not match:
+        raise ValueError(category)
 
-    with contextlib.closing(sqlite3.connect(DATABASE_PATH)) as db:
-        return groupqueries_page(db, group_id, count)
+    return match.group(0)
 
 
-def dnsquerygroup(
-        query: QueryArgs) -> Dict:
+def sanitize_host(
+        host: str) -> str:
+
+    'Ensure a host contains only hostname or IP address characters'
+
+    match = re.match(r'^[-A-Za-z0-9\.:/]+$', host)
+
+    if not match:
+        raise ValueError(host)
+
+    return match.group(0)
+
+
+def sanitize_device(
+        device: str) -> str:
+
+    'Ensure a forwarding device name contains only hostname characters'
+
+    match = re.match(r'^[-A-Za-z0-9\.]+$', device)
+
+    if not match:
+        raise ValueError(device)
+
+    return match.group(0)
+
+
+def sanitize_time(
+        isotime: str) -> str:
+
+    'Ensure a time is an ISO 8601 date or date and time'
+
+    for time_format in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']:
+        with contextlib.suppress(ValueError):
+            time = datetime.datetime.strptime(isotime, time_format)
+            return time.isoformat()
+
+    raise ValueError(isotime)
+
+
+def delta_encode(
+        values: List[int]) -> List[int]:
+
+    'Encode a list of integers as the first value followed by differences'
+
+    deltas = []
+    previous = 0
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+
+    return deltas
+
+
+def dictionary_encode(
+        values: List[Any]) -> Tuple[List[Any], List[int]]:
+
+    '''Encode a list of values as a list of the distinct values and a
+    list of indices into it'''
 
-    'Retrieve a batch of DNS query log entries'
+    dictionary = cast(List[Any], [])
+    dictionary_index = cast(Dict[Any, int], {})
+    indices = []
+    for value in values:
+        if value not in dictionary_index:
+            dictionary_index[value] = len(dictionary)
+            dictionary.append(value)
+
+        indices.append(dictionary_index[value])
+
+    return (dictionary, indices)
+
+
+def isotime_to_epoch(
+        isotime: str) -> int:
+
+    'Convert an ISO 8601 time to seconds since the epoch'
+
+    time = epipydb.isotime_to_datetime(isotime)
+    return calendar.timegm(time.timetuple())
+
+
+def encode_columnar(
+        rows: List[Dict],
+        columns: List[str]) -> Dict:
+
+    '''Encode a list of rows as parallel arrays of column values.  Ids
+    and times are delta encoded, and hosts are dictionary encoded, as
+    they are mostly repeated.'''
+
+    result = cast(Dict, {
+        'format': 'columnar',
+        'length': len(rows),
+        'encoding': {},
+    })
+
+    for column in columns:
+        values = [row[column] for row in rows]
+        encoding = COLUMNAR_ENCODING.get(column, 'plain')
+
+        if encoding == 'delta_time':
+            values = delta_encode([isotime_to_epoch(v) for v in values])
+        elif encoding == 'delta':
+            values = delta_encode(values)
+        elif encoding == 'dictionary':
+            (result[column + '_dictionary'], values) = \
+                dictionary_encode(values)
+
+        result['encoding'][column] = encoding
+        result[column] = values
+
+    return result
+
+
+def sanitize_format(
+        response_format: str) -> str:
+
+    'Ensure a response format is one we know how to generate'
+
+    if response_format not in ['rows', 'columnar']:
+        raise ValueError(response_format)
+
+    return response_format
+
+
+def parse_page_query(
+        query: QueryArgs) -> Tuple[Optional[str], Optional[str],
+                                   Optional[int], Optional[int], int]:
+
+    '''Collect the search value, category, paging ids and count of a
+    request for a page of DNS query groups'''
 
     count = 100
     with contextlib.suppress(KeyError, ValueError):
@@ -258,17 +486,680 @@ def dnsquerygroup(
     with contextlib.suppress(KeyError, ValueError):
         after_id = int(query['after'][0])
 
+    #  The errors raised name the argument which was invalid
     search_value = None
+    if 'search' in query:
+        try:
+            search_value = sanitize_search(query['search'][0])
+        except ValueError:
+            raise ValueError('Invalid search value')
+
+    category = None
+    if 'category' in query:
+        try:
+            category = sanitize_category(query['category'][0])
+        except ValueError:
+            raise ValueError('Invalid category')
+
+    return (search_value, category, before_id, after_id, count)
+
+
+def parse_archive_query(
+        query: QueryArgs) -> Optional[Tuple[Optional[str], Optional[str]]]:
+
+    '''Collect the time range of a request to search the archive, or
+    None if the archive isn't to be searched'''
+
+    if query.get('archive', ['0'])[0] != '1':
+        return None
+
+    since = None
+    if 'since' in query:
+        since = sanitize_time(query['since'][0])
+
+    until = None
+    if 'until' in query:
+        until = sanitize_time(query['until'][0])
+
+    return (since, until)
+
+
+def hot_tier_request(
+        request: str) -> Generator[bytes, None, Optional[Dict]]:
+
+    '''Ask the recorder for a result from the newest query groups it
+    holds in memory, through its Unix socket.  Returns None if the
+    recorder isn't running, is too busy to answer promptly, or doesn't
+    hold the groups needed.'''
+
+    with contextlib.closing(socket.socket(
+            socket.AF_UNIX, socket.SOCK_STREAM)) as sock:
+
+        try:
+            sock.connect(epipyhot.HOT_SOCKET_PATH)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+
+        sock.send(request.encode('utf-8') + b'\n')
+        recv_buff = b''
+        while b'\n' not in recv_buff:
+            uwsgi.wait_fd_read(sock.fileno(), HOT_TIER_TIMEOUT)
+            yield b''
+            if uwsgi.ready_fd() != sock.fileno():
+                return None
+
+            data = sock.recv(4096)
+            if not data:
+                return None
+            recv_buff += data
+
+    result = json.loads(recv_buff.decode('utf-8'))
+    if 'cold' in result or 'error' in result:
+        return None
+
+    return result
+
+
+def groupqueries(
+        query: QueryArgs) -> Generator[bytes, None, Dict]:
+
+    '''Handle a request for the DNS queries associated with a
+    connection group.
+
+    Several groups may be requested at once, either by repeating the
+    id argument, or with the page argument and the same arguments as
+    dnsquerygroup, for all the groups on that page with more than one
+    query.  The queries are then returned in a dictionary keyed by
+    group id.  With the page argument, count is the number of groups
+    on the page rather than the number of queries per group.'''
+
+    page = 'page' in query
+
+    count = 100
+    if not page:
+        with contextlib.suppress(KeyError, ValueError):
+            count = int(query['count'][0])
+
+    response_format = 'rows'
     try:
-        search_value = sanitize_search(query['search'][0])
+        response_format = sanitize_format(query['format'][0])
     except ValueError:
-        return {'error': 'Invalid search value'}
+        return {'error': 'Invalid format'}
     except KeyError:
         pass
 
+    group_ids = []
+    if not page:
+        try:
+            group_ids = [int(group_id) for group_id in query['id']]
+        except (KeyError, ValueError):
+            return {'error': 'missing group id'}
+
+        if len(group_ids) > GROUPQUERIES_MAX_GROUPS:
+            return {'error': 'too many group ids'}
+
+    try:
+        archive_range = parse_archive_query(query)
+    except ValueError:
+        return {'error': 'Invalid time'}
+
+    result = None
+    if len(group_ids) == 1 and not page and archive_range is None:
+        result = yield from hot_tier_request(
+            'groupqueries {} {}'.format(group_ids[0], count))
+
+    #  The newest page of groups, as shown when the page is first
+    #  loaded, is served from the hot tier like dnsquerygroup
+    if page and archive_range is None:
+        try:
+            (search_value, category, before_id, after_id,
+                page_count) = parse_page_query(query)
+        except ValueError as e:
+            return {'error': str(e)}
+
+        if search_value is None and category is None and \
+                before_id is None and after_id is None:
+            result = yield from hot_tier_request(
+                'groupqueries_page {}'.format(page_count))
+
+    if result is None and archive_range is not None:
+        if not page:
+            return {'error': 'archive requires page'}
+        result = groupqueries_from_archive(query, archive_range)
+        if 'error' in result:
+            return result
+
+    if result is None:
+        result = groupqueries_from_database(query, page, group_ids, count)
+        if 'error' in result:
+            return result
+
+    if response_format == 'columnar':
+        if 'queries' in result:
+            result['queries'] = encode_columnar(
+                result['queries'], GROUPQUERIES_COLUMNS)
+        else:
+            for group in result['groups'].values():
+                group['queries'] = encode_columnar(
+                    group['queries'], GROUPQUERIES_COLUMNS)
+
+    return result
+
+
+def groupqueries_from_database(
+        query: QueryArgs,
+        page: bool,
+        group_ids: List[int],
+        count: int) -> Dict:
+
+    'Retrieve the DNS queries of the requested groups from the database'
+
     with contextlib.closing(sqlite3.connect(DATABASE_PATH)) as db:
-        return dnsquerygroup_page(
-            db, search_value, before_id, after_id, count)
+        if page:
+            try:
+                (search_value, category, before_id, after_id,
+                    page_count) = parse_page_query(query)
+            except ValueError as e:
+                return {'error': str(e)}
+
+            groups = dnsquerygroup_page(
+                db, search_value, category, before_id, after_id,
+                page_count)
+            group_ids = [
+                group['id'] for group in groups['groups']
+                if group['query_count'] > 1]
+
+        if len(group_ids) == 1 and not page:
+            return groupqueries_page(db, group_ids[0], count)
+        else:
+            return groupqueries_batch(db, group_ids, count)
+
+
+def groupqueries_from_archive(
+        query: QueryArgs,
+        archive_range: Tuple[Optional[str], Optional[str]]) -> Dict:
+
+    'Retrieve the DNS queries of the groups on a page of the archive'
+
+    try:
+        (search_value, category, before_id, after_id, page_count) = \
+            parse_page_query(query)
+    except ValueError as e:
+        return {'error': str(e)}
+
+    (since, until) = archive_range
+    page = epipyarchive.archive_page(
+        search_value, category, since, until, before_id, after_id,
+        page_count, cache=ARCHIVE_CACHE)
+
+    result = cast(Dict, {
+        'groups': {},
+    })
+    for group in page['groups']:
+        if group['query_count'] > 1:
+            result['groups'][group['id']] = {
+                'queries': group['queries'],
+            }
+
+    return result
+
+
+def dnsquerygroup(
+        query: QueryArgs) -> Generator[bytes, None, Dict]:
+
+    '''Retrieve a batch of DNS query log entries.  The newest page is
+    served from the recorder's hot tier when it holds enough groups.
+    With the archive argument, the archive of days rotated out of the
+    database is searched instead, between the since and until times.'''
+
+    try:
+        (search_value, category, before_id, after_id, count) = \
+            parse_page_query(query)
+    except ValueError as e:
+        return {'error': str(e)}
+
+    try:
+        archive_range = parse_archive_query(query)
+    except ValueError:
+        return {'error': 'Invalid time'}
+
+    response_format = 'rows'
+    try:
+        response_format = sanitize_format(query['format'][0])
+    except ValueError:
+        return {'error': 'Invalid format'}
+    except KeyError:
+        pass
+
+    result = None
+    if search_value is None and category is None and \
+            before_id is None and after_id is None and \
+            archive_range is None:
+        result = yield from hot_tier_request(
+            'dnsquerygroup {}'.format(count))
+
+    if result is None and archive_range is not None:
+        (since, until) = archive_range
+        result = epipyarchive.archive_page(
+            search_value, category, since, until, before_id, after_id,
+            count, cache=ARCHIVE_CACHE)
+        for group in result['groups']:
+            del group['queries']
+
+    if result is None:
+        with contextlib.closing(sqlite3.connect(DATABASE_PATH)) as db:
+            result = dnsquerygroup_page(
+                db, search_value, category, before_id, after_id, count)
+
+    if response_format == 'columnar':
+        result['groups'] = encode_columnar(
+            result['groups'],
+            ['id', 'query_count', 'time', 'host', 'value', 'category'])
+
+    return result
+
+
+def suggest(
+        query: QueryArgs) -> Dict:
+
+    '''Suggest search terms for a partly typed domain, most frequently
+    queried first, from this worker's index of domains.  Nothing is
+    suggested until the index has been built.'''
+
+    try:
+        prefix = sanitize_search(query['prefix'][0])
+    except (KeyError, ValueError):
+        return {'error': 'Invalid prefix'}
+
+    count = 10
+    with contextlib.suppress(KeyError, ValueError):
+        count = int(query['count'][0])
+
+    with contextlib.closing(sqlite3.connect(DATABASE_PATH)) as db:
+        SUGGEST_INDEX.refresh(
+            db, epipydb.database_signature(DATABASE_PATH))
+
+    return {
+        'suggestions': SUGGEST_INDEX.suggest(prefix, count),
+    }
+
+
+def timeline(
+        query: QueryArgs) -> Dict:
+
+    '''Count the DNS queries of a host in each bucket of time between
+    the since and until times, for charting its activity.  With the
+    domains argument, the counts are also split by the most frequently
+    queried domains.'''
+
+    try:
+        host = sanitize_host(query['host'][0])
+    except (KeyError, ValueError):
+        return {'error': 'Invalid host'}
+
+    now = datetime.datetime.now().replace(microsecond=0)
+    try:
+        until = now.isoformat()
+        if 'until' in query:
+            until = sanitize_time(query['until'][0])
+
+        since = (epipydb.isotime_to_datetime(until) -
+                 datetime.timedelta(days=1)).isoformat()
+        if 'since' in query:
+            since = sanitize_time(query['since'][0])
+    except ValueError:
+        return {'error': 'Invalid time'}
+
+    bucket = 300
+    domain_count = 0
+    try:
+        if 'bucket' in query:
+            bucket = int(query['bucket'][0])
+        if 'domains' in query:
+            domain_count = int(query['domains'][0])
+    except ValueError:
+        return {'error': 'Invalid bucket or domains'}
+
+    if bucket < 1 or since >= until:
+        return {'error': 'Invalid bucket or range'}
+    domain_count = max(0, min(domain_count, TIMELINE_MAX_DOMAINS))
+
+    with contextlib.closing(sqlite3.connect(DATABASE_PATH)) as db:
+        try:
+            (start, buckets) = TIMELINE_CACHE.timeline(
+                db, epipydb.database_signature(DATABASE_PATH), host,
+                isotime_to_epoch(since), isotime_to_epoch(until),
+                bucket, isotime_to_epoch(now.isoformat()), domain_count > 0)
+        except ValueError as e:
+            return {'error': str(e)}
+
+    result = cast(Dict, {
+        'host': host,
+        'start': epipytimeline.epoch_to_isotime(start),
+        'bucket': bucket,
+    })
+    if domain_count > 0:
+        result.update(epipytimeline.split_top_domains(
+            cast(List[Dict[str, int]], buckets), domain_count))
+    else:
+        result['counts'] = buckets
+
+    return result
+
+
+def export_chunk_sql(
+        since: Optional[str],
+        until: Optional[str],
+        host: Optional[str],
+        after_id: int,
+        count: int) -> Tuple[str, List[Any]]:
+
+    '''Generate the SQL for a chunk of DNS queries to export.  The time
+    and host columns are kept from being used as index terms, with a
+    unary plus, so that every chunk walks the primary key from the last
+    exported id, in the order it is paged by, rather than sorting all
+    the remaining rows of a host or time range again.'''
+
+    where = ' WHERE dnsquery.id > ?'
+    sql_args = cast(List[Any], [after_id])
+
+    if since:
+        where += ' AND +dnsquery.time >= ?'
+        sql_args += [since]
+
+    if until:
+        where += ' AND +dnsquery.time < ?'
+        sql_args += [until]
+
+    if host:
+        where += ' AND +dnsquery.host = ?'
+        sql_args += [host]
+
+    sql = \
+        'SELECT dnsquery.id, dnsquery.group_id, dnsquery.time,' + \
+        '     dnsquery.type, dnsquery.value, dnsquery.host,' + \
+        '     dnsquery.host_ip, querygroup.start_time,' + \
+        '     querygroup.end_time, querygroup.query_count,' + \
+        '     dnsquery.repeat_count,' + \
+        '     COALESCE(dnsquery.last_time, dnsquery.time),' + \
+        '     dnsquery.category' + \
+        ' FROM dnsquery' + \
+        ' LEFT JOIN querygroup ON querygroup.id = dnsquery.group_id' + \
+        where + \
+        ' ORDER BY dnsquery.id ASC' + \
+        ' LIMIT ?'
+    sql_args += [count]
+
+    return (sql, sql_args)
+
+
+def export_chunks(
+        db: sqlite3.Connection,
+        since: Optional[str],
+        until: Optional[str],
+        host: Optional[str]) -> Iterator[List[Any]]:
+
+    '''Iterate over the DNS queries to export, a chunk at a time.
+
+    Each chunk is a separate statement continuing from the last
+    exported id, so no read lock is held on the database while a
+    chunk is being sent to the client, and the recorder can continue
+    to commit new queries during a long export.'''
+
+    after_id = 0
+    while True:
+        (sql, sql_args) = export_chunk_sql(
+            since, until, host, after_id, EXPORT_CHUNK_SIZE)
+
+        with contextlib.closing(db.cursor()) as cursor:
+            cursor.execute(sql, sql_args)
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+
+        if not rows:
+            return
+
+        yield rows
+
+        after_id = rows[-1][0]
+
+
+def format_export_ndjson(
+        rows: List[Any]) -> str:
+
+    'Format a chunk of exported rows as newline delimited JSON'
+
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n')
+
+    return str.join('', lines)
+
+
+def format_export_csv_header() -> str:
+
+    'Format the header line of a CSV export'
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(EXPORT_COLUMNS)
+
+    return buffer.getvalue()
+
+
+def format_export_csv(
+        rows: List[Any]) -> str:
+
+    'Format a chunk of exported rows as CSV'
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+
+    return buffer.getvalue()
+
+
+def export(
+        query: QueryArgs,
+        accept_encoding: str,
+        start_response: StartResponse) -> Iterator[bytes]:
+
+    '''Stream the DNS queries for a time range or host, joined with
+    their query groups, as NDJSON or CSV.  The response is gzip
+    compressed as it is generated if the client accepts it.'''
+
+    since = None
+    until = None
+    host = None
+    try:
+        if 'since' in query:
+            since = sanitize_time(query['since'][0])
+        if 'until' in query:
+            until = sanitize_time(query['until'][0])
+        if 'host' in query:
+            host = sanitize_host(query['host'][0])
+    except ValueError as e:
+        start_ok(start_response)
+        yield json.dumps({'error': 'Invalid value ' + str(e)}).encode('utf-8')
+        return
+
+    export_format = 'ndjson'
+    with contextlib.suppress(KeyError):
+        export_format = query['format'][0]
+
+    if export_format == 'csv':
+        content_type = 'text/csv'
+        header = format_export_csv_header()
+        format_chunk = format_export_csv
+    elif export_format == 'ndjson':
+        content_type = 'application/x-ndjson'
+        header = ''
+        format_chunk = format_export_ndjson
+    else:
+        start_ok(start_response)
+        yield json.dumps({'error': 'Invalid format'}).encode('utf-8')
+        return
+
+    headers = [
+        ('Content-Type', content_type),
+        ('Content-Disposition',
+            'attachment; filename="dnsquery.' + export_format + '"')]
+
+    compressor = None
+    if 'gzip' in accept_encoding:
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        headers.append(('Content-Encoding', 'gzip'))
+
+    start_response('200 OK', headers)
+
+    with contextlib.closing(sqlite3.connect(DATABASE_PATH)) as db:
+        chunks = map(format_chunk, export_chunks(db, since, until, host))
+        for chunk in itertools.chain([header], chunks):
+            data = chunk.encode('utf-8')
+            if compressor:
+                data = compressor.compress(data)
+
+            if data:
+                yield data
+
+    if compressor:
+        yield compressor.flush()
+
+
+def read_ingest_records(
+        env: Dict[str, Any]) -> List[Dict[str, str]]:
+
+    '''Read the request body of an ingest request as a list of records,
+    decompressing it if needed'''
+
+    length = int(env.get('CONTENT_LENGTH') or 0)
+    if length > INGEST_MAX_BATCH_SIZE:
+        raise ValueError('batch too large')
+
+    body = env['wsgi.input'].read(length)
+
+    if env.get('HTTP_CONTENT_ENCODING') == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(body, INGEST_MAX_BATCH_SIZE)
+        except zlib.error as e:
+            raise ValueError(str(e))
+        if decompressor.unconsumed_tail:
+            raise ValueError('batch too large')
+
+    records = []
+    for line in body.decode('utf-8').splitlines():
+        if not line:
+            continue
+
+        record = json.loads(line)
+        if not isinstance(record, dict) or \
+                not all(isinstance(v, str) for v in record.values()):
+            raise ValueError('invalid record')
+
+        records.append(record)
+
+    return records
+
+
+class IngestRefused(Exception):
+
+    '''An ingest request refused before reading it, because ingest isn't
+    enabled, or the request doesn't carry the shared token'''
+
+    def __init__(
+            self,
+            status: str,
+            message: str) -> None:
+
+        super().__init__(message)
+        self.status = status
+
+
+def check_ingest_token(
+        env: Dict[str, Any]) -> None:
+
+    '''Refuse an ingest request as not found if no shared token has been
+    configured, or as forbidden if it doesn't carry the token'''
+
+    try:
+        with open(INGEST_TOKEN_PATH) as token_file:
+            token = token_file.read().strip()
+    except FileNotFoundError:
+        token = ''
+
+    if not token:
+        raise IngestRefused('404 Not Found', 'ingest not enabled')
+
+    sent = env.get('HTTP_X_EPIPYWEB_TOKEN', '')
+    if not hmac.compare_digest(sent.encode('utf-8'), token.encode('utf-8')):
+        raise IngestRefused('403 Forbidden', 'invalid token')
+
+
+def ingest(
+        query: QueryArgs,
+        env: Dict[str, Any]) -> Dict:
+
+    '''Store a batch of records forwarded from the recorder on another
+    device.  Batches which have already been applied are acknowledged
+    without being applied again.'''
+
+    check_ingest_token(env)
+
+    if env['REQUEST_METHOD'] != 'POST':
+        raise ValueError('POST required')
+
+    device = sanitize_device(query['device'][0])
+    sequence = int(query['sequence'][0])
+    records = read_ingest_records(env)
+
+    categories = epipytrie.open_category_trie()
+    with contextlib.closing(sqlite3.connect(DATABASE_PATH)) as db:
+        epipydb.create_tables(db)
+
+        #  Hold the write lock from the sequence check through the
+        #  commit, so concurrent retries of a batch apply it only once
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            applied = epipydb.log_ingest_batch(
+                db, device, sequence, records, categories.lookup)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            categories.close()
+        db.commit()
+
+    return {
+        'sequence': sequence,
+        'applied': applied,
+    }
+
+
+def debug_profile(
+        profiler: epipyprofile.Profiler,
+        query: QueryArgs) -> Dict:
+
+    '''Switch profiling of the worker handling the request on or off,
+    with the action argument of start, stop, toggle or status'''
+
+    action = 'toggle'
+    with contextlib.suppress(KeyError):
+        action = query['action'][0]
+
+    files = cast(List[str], [])
+    if action == 'start':
+        profiler.start()
+    elif action == 'stop':
+        files = profiler.stop()
+    elif action == 'toggle':
+        files = profiler.toggle()
+    elif action != 'status':
+        return {'error': 'Invalid action'}
+
+    return {
+        'pid': os.getpid(),
+        'profiling': profiler.active,
+        'files': files,
+    }
 
 
 def get_disk_status() -> Dict:
@@ -331,10 +1222,46 @@ def application(
 
     if request == 'dnsquerygroup':
         start_ok(start_response)
-        yield json.dumps(dnsquerygroup(query)).encode('utf-8')
+        groups_obj = yield from dnsquerygroup(query)
+        yield json.dumps(groups_obj).encode('utf-8')
     elif request == 'groupqueries':
         start_ok(start_response)
-        yield json.dumps(groupqueries(query)).encode('utf-8')
+        queries_obj = yield from groupqueries(query)
+        yield json.dumps(queries_obj).encode('utf-8')
+    elif request == 'suggest':
+        start_ok(start_response)
+        yield json.dumps(suggest(query)).encode('utf-8')
+    elif request == 'timeline':
+        start_ok(start_response)
+        yield json.dumps(timeline(query)).encode('utf-8')
+    elif request == 'ingest':
+        try:
+            result = ingest(query, env)
+        except IngestRefused as e:
+            start_response(e.status, [('Content-Type', 'application/json')])
+            yield json.dumps({'error': str(e)}).encode('utf-8')
+        except epipydb.IngestSequenceError as e:
+            #  Tell the forwarder where its sequence has to continue from
+            start_response(
+                '409 Conflict', [('Content-Type', 'application/json')])
+            yield json.dumps({
+                'error': str(e),
+                'sequence': e.last_sequence,
+            }).encode('utf-8')
+        except (KeyError, ValueError) as e:
+            start_response(
+                '400 Bad Request', [('Content-Type', 'application/json')])
+            yield json.dumps({'error': str(e)}).encode('utf-8')
+        else:
+            start_ok(start_response)
+            yield json.dumps(result).encode('utf-8')
+    elif request == 'export':
+        yield from export(
+            query, env.get('HTTP_ACCEPT_ENCODING', ''), start_response)
+    elif request == 'debug' and path[3:] == ['profile'] and \
+            PROFILER is not None:
+        start_ok(start_response)
+        yield json.dumps(debug_profile(PROFILER, query)).encode('utf-8')
     elif request == 'status':
         start_ok(start_response)
         status_obj = yield from status()
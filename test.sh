@@ -23,6 +23,17 @@ EXIT_VALUE=0
 
 TESTS="""
     test/querygroup.py
+    test/export.py
+    test/hottier.py
+    test/ingest.py
+    test/regrouping.py
+    test/repeats.py
+    test/categories.py
+    test/suggest.py
+    test/archive.py
+    test/timeline.py
+    test/profiling.py
+    test/queryplan.py
 """
 
 rm -f $LOG
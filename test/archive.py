@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import array
+import contextlib
+import datetime
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+TOP_PATH = os.path.join(os.path.dirname(__file__), '..')
+sys.path.append(os.path.join(TOP_PATH, 'record'))
+import epipyarchive  # noqa: E402
+import epipydb  # noqa: E402
+import epipytest  # noqa: E402
+
+from typing import *  # noqa: E402
+
+
+START_TIME = datetime.datetime(2017, 1, 1, 22, 0, 0)
+
+
+class ArchiveTest(unittest.TestCase):
+
+    'Check archiving days of queries, and searching the archive'
+
+    def setUp(self) -> None:
+
+        '''Record queries over three days in a temporary database, with a
+        group which spans midnight'''
+
+        self.temp_dir = tempfile.mkdtemp(prefix='epipywebarchive')
+        self.archive_dir = os.path.join(self.temp_dir, 'archive')
+        self.db = sqlite3.connect(os.path.join(self.temp_dir, 'dns.db'))
+        epipydb.create_tables(self.db)
+
+        for (seconds, value, host) in [
+                (0, 'www.example.com', '192.168.1.2'),
+                (30, 'ads.example.com', '192.168.1.2'),
+                (7180, 'late.example.org', '192.168.1.3'),
+                (7210, 'early.example.org', '192.168.1.3'),
+                (86400, 'www.example.com', '192.168.1.2'),
+                (172800, 'www.example.net', '192.168.1.4')]:
+            isotime = (
+                START_TIME + datetime.timedelta(seconds=seconds)).isoformat()
+            category = None
+            if value.startswith('ads.'):
+                category = 'ads'
+            epipydb.log_dns_query(
+                self.db, isotime, 'A', value, host, category=category)
+        self.db.commit()
+
+    def tearDown(self) -> None:
+
+        'Discard the database and archive'
+
+        self.db.close()
+        shutil.rmtree(self.temp_dir)
+
+    def archive(
+            self,
+            day: int) -> int:
+
+        'Archive the groups starting before midnight on a day of the test'
+
+        archive_time = datetime.datetime.combine(
+            START_TIME.date() + datetime.timedelta(days=day),
+            datetime.time())
+        return epipyarchive.archive_before(
+            self.db, archive_time, self.archive_dir)
+
+    def search(
+            self,
+            search_value: Optional[str] = None,
+            category: Optional[str] = None,
+            since: Optional[str] = None,
+            until: Optional[str] = None,
+            before_id: Optional[int] = None,
+            after_id: Optional[int] = None,
+            count: int = 100,
+            cache: Optional[epipyarchive.ArchiveCache] = None) -> Dict:
+
+        'Search the test archive'
+
+        return epipyarchive.archive_page(
+            search_value, category, since, until, before_id, after_id,
+            count, self.archive_dir, cache)
+
+    def test_round_trip(self) -> None:
+
+        'Test that archived groups and queries are read back unchanged'
+
+        self.assertEqual(self.archive(2), 3)
+        self.assertEqual(
+            epipyarchive.list_archive_days(self.archive_dir),
+            [datetime.date(2017, 1, 1), datetime.date(2017, 1, 2)])
+
+        (groups, queries) = epipyarchive.read_archive(
+            epipyarchive.archive_path(
+                datetime.date(2017, 1, 1), self.archive_dir))
+
+        self.assertEqual(
+            [(group['start_time'], group['host'], group['query_count'])
+             for group in groups],
+            [('2017-01-01T22:00:00', '192.168.1.2', 2),
+             ('2017-01-01T23:59:40', '192.168.1.3', 2)])
+        self.assertEqual(groups[0]['category'], 'ads')
+
+        #  The queries of a group spanning midnight are archived with it
+        self.assertEqual(
+            [(query['value'], query['time'], query['category'])
+             for query in queries],
+            [('www.example.com', '2017-01-01T22:00:00', None),
+             ('ads.example.com', '2017-01-01T22:00:30', 'ads'),
+             ('late.example.org', '2017-01-01T23:59:40', None),
+             ('early.example.org', '2017-01-02T00:00:10', None)])
+
+    def test_merge(self) -> None:
+
+        'Test that archiving a day again adds to its archive file'
+
+        self.archive(1)
+        self.db.execute(
+            'DELETE FROM querygroup WHERE start_time < ?',
+            ('2017-01-02',))
+        epipydb.log_dns_query(
+            self.db, '2017-01-01T23:00:00', 'A', 'more.example.com',
+            '192.168.1.5')
+        self.db.commit()
+        self.archive(1)
+
+        (groups, _) = epipyarchive.read_archive(
+            epipyarchive.archive_path(
+                datetime.date(2017, 1, 1), self.archive_dir))
+        self.assertEqual(len(groups), 3)
+
+    def test_search(self) -> None:
+
+        'Test searching the archive by domain, category and time'
+
+        self.archive(3)
+
+        def values(page: Dict) -> List[str]:
+            return [group['value'] for group in page['groups']]
+
+        self.assertEqual(
+            values(self.search()),
+            ['www.example.net', 'www.example.com', 'late.example.org',
+             'www.example.com'])
+        self.assertEqual(
+            values(self.search('example.c')),
+            ['www.example.com', 'www.example.com'])
+        self.assertEqual(
+            values(self.search('EARLY')), ['late.example.org'])
+        self.assertEqual(
+            values(self.search(category='ads')), ['www.example.com'])
+        self.assertEqual(
+            values(self.search('example.org', category='ads')), [])
+        self.assertEqual(
+            values(self.search(
+                since='2017-01-02T00:00:00', until='2017-01-03T00:00:00')),
+            ['www.example.com'])
+
+        page = self.search(count=2)
+        self.assertEqual(
+            values(page), ['www.example.net', 'www.example.com'])
+        self.assertTrue(page['next_page_present'])
+        self.assertFalse(page['previous_page_present'])
+
+        page = self.search(before_id=page['groups'][-1]['id'], count=2)
+        self.assertEqual(
+            values(page), ['late.example.org', 'www.example.com'])
+        self.assertEqual(len(page['groups'][0]['queries']), 2)
+        self.assertFalse(page['next_page_present'])
+        self.assertTrue(page['previous_page_present'])
+
+        page = self.search(after_id=page['groups'][0]['id'], count=2)
+        self.assertEqual(
+            values(page), ['www.example.net', 'www.example.com'])
+
+    def test_lazy(self) -> None:
+
+        'Test that only the day files needed for a page are read'
+
+        self.archive(3)
+        read_archive_tables = epipyarchive.read_archive_tables
+        read_paths = []
+
+        def traced_read_archive_tables(path: str) -> Any:
+            read_paths.append(os.path.basename(path))
+            return read_archive_tables(path)
+
+        with unittest.mock.patch.object(
+                epipyarchive, 'read_archive_tables',
+                traced_read_archive_tables):
+            self.search(since='2017-01-02T12:00:00')
+            self.assertEqual(
+                read_paths,
+                ['dns-2017-01-03.json.xz', 'dns-2017-01-02.json.xz'])
+
+            del read_paths[:]
+            self.search(count=1)
+            self.assertEqual(
+                read_paths,
+                ['dns-2017-01-03.json.xz', 'dns-2017-01-02.json.xz'])
+
+    def test_cache(self) -> None:
+
+        '''Test that a page and then the queries of its groups read each
+        file once, and that paging on skips the files already read'''
+
+        self.archive(3)
+        cache = epipyarchive.ArchiveCache()
+        read_archive_tables = epipyarchive.read_archive_tables
+        read_paths = []
+
+        def traced_read_archive_tables(path: str) -> Any:
+            read_paths.append(os.path.basename(path))
+            return read_archive_tables(path)
+
+        with unittest.mock.patch.object(
+                epipyarchive, 'read_archive_tables',
+                traced_read_archive_tables):
+            page = self.search(count=1, cache=cache)
+            self.search(count=1, cache=cache)
+            self.assertEqual(
+                read_paths,
+                ['dns-2017-01-03.json.xz', 'dns-2017-01-02.json.xz'])
+
+            del read_paths[:]
+            page = self.search(
+                before_id=page['groups'][-1]['id'], count=1, cache=cache)
+            self.assertEqual(
+                [group['value'] for group in page['groups']],
+                ['www.example.com'])
+            self.assertEqual(read_paths, ['dns-2017-01-01.json.xz'])
+
+        #  Days are cached as column arrays rather than decoded rows
+        (groups, queries) = cache.read(epipyarchive.archive_path(
+            datetime.date(2017, 1, 1), self.archive_dir))
+        self.assertIsInstance(groups['id'], array.array)
+        self.assertIsInstance(queries['value'], array.array)
+
+    def test_max_days(self) -> None:
+
+        '''Test that no more than the maximum number of files are read
+        for a page, which ends with the groups found so far'''
+
+        self.archive(3)
+        cache = epipyarchive.ArchiveCache()
+
+        with unittest.mock.patch.object(
+                epipyarchive, 'ARCHIVE_MAX_DAYS_READ', 2):
+            page = self.search('example.org')
+            self.assertEqual(page['groups'], [])
+            self.assertFalse(page['next_page_present'])
+
+            page = self.search('www', cache=cache)
+            self.assertEqual(
+                [group['value'] for group in page['groups']],
+                ['www.example.net', 'www.example.com'])
+            self.assertTrue(page['next_page_present'])
+
+            #  The file of the newest day is skipped, as the cache knows
+            #  it has only groups newer than the page
+            page = self.search(
+                'www', before_id=page['groups'][-1]['id'], cache=cache)
+            self.assertEqual(
+                [group['value'] for group in page['groups']],
+                ['www.example.com'])
+
+    def test_rotate(self) -> None:
+
+        '''Test that rotating the database moves a group spanning the
+        discard time out of it whole, with its later queries'''
+
+        rotate = epipytest.load_rotate_script()
+        discard_time = datetime.datetime(2017, 1, 2)
+        with contextlib.redirect_stdout(None):
+            rotate.rotate(self.db, discard_time, self.archive_dir)
+
+        (groups, queries) = epipyarchive.read_archive(
+            epipyarchive.archive_path(
+                datetime.date(2017, 1, 1), self.archive_dir))
+        self.assertEqual(len(groups), 2)
+        self.assertEqual(len(queries), 4)
+
+        with contextlib.closing(self.db.cursor()) as cursor:
+            cursor.execute('SELECT value FROM dnsquery ORDER BY id')
+            self.assertEqual(
+                [row[0] for row in cursor.fetchall()],
+                ['www.example.com', 'www.example.net'])
+            cursor.execute('SELECT DISTINCT group_id FROM querydomain')
+            self.assertEqual(
+                sorted(row[0] for row in cursor.fetchall()),
+                [group[0] for group in cursor.execute(
+                    'SELECT id FROM querygroup ORDER BY id')])
+
+    def test_prune(self) -> None:
+
+        'Test that archive files older than the retention period are deleted'
+
+        self.archive(3)
+        epipyarchive.prune_archive(
+            datetime.date(2017, 1, 3), self.archive_dir)
+        self.assertEqual(
+            epipyarchive.list_archive_days(self.archive_dir),
+            [datetime.date(2017, 1, 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'record'))
+import epipydb  # noqa: E402
+import epipytrie  # noqa: E402
+
+from typing import *  # noqa: E402
+
+
+CATEGORIES = [
+    ('malware', ['bad.ads.example.com']),
+    ('ads', [
+        'ads.example.com', 'doubleclick.net', 'bad.ads.example.com']),
+    ('tracker', ['example.com', 'tracker.example.org']),
+]
+
+
+class CategoryTrieTest(unittest.TestCase):
+
+    'Check lookups in a compiled category trie, and tagging with them'
+
+    def setUp(self) -> None:
+
+        'Compile the test categories to a temporary trie file'
+
+        self.temp_dir = tempfile.mkdtemp(prefix='epipywebtrie')
+        self.trie_path = os.path.join(self.temp_dir, 'categories.trie')
+        epipytrie.write_trie(self.trie_path, epipytrie.build_trie(
+            cast(List[Tuple[str, Iterable[str]]], CATEGORIES)))
+
+        self.trie = epipytrie.open_category_trie(self.trie_path)
+
+    def tearDown(self) -> None:
+
+        'Discard the trie file'
+
+        self.trie.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_lookup(self) -> None:
+
+        'Test that domains take the category of the nearest listed domain'
+
+        self.assertEqual(self.trie.lookup('doubleclick.net'), 'ads')
+        self.assertEqual(self.trie.lookup('stats.g.doubleclick.net'), 'ads')
+        self.assertEqual(self.trie.lookup('www.example.com'), 'tracker')
+        self.assertEqual(self.trie.lookup('x.ads.example.com'), 'ads')
+        self.assertEqual(self.trie.lookup('BAD.ads.example.com'), 'malware')
+        self.assertIsNone(self.trie.lookup('example.org'))
+        self.assertIsNone(self.trie.lookup('net'))
+        self.assertIsNone(self.trie.lookup('clickdouble.net'))
+
+    def test_replaced(self) -> None:
+
+        'Test that a replaced trie file is reopened, and a removed one unused'
+
+        epipytrie.write_trie(self.trie_path, epipytrie.build_trie(
+            [('ads', ['example.org'])]))
+        self.trie.refresh()
+        self.assertEqual(self.trie.lookup('www.example.org'), 'ads')
+        self.assertIsNone(self.trie.lookup('doubleclick.net'))
+
+        os.unlink(self.trie_path)
+        self.trie.refresh()
+        self.assertIsNone(self.trie.lookup('www.example.org'))
+
+    def test_parse_list(self) -> None:
+
+        'Test that plain and hosts file format lists are both understood'
+
+        self.assertEqual(
+            list(epipytrie.parse_domain_list([
+                '# comment',
+                'ads.example.com',
+                '0.0.0.0 Tracker.Example.com  # trailing comment',
+                '127.0.0.1 localhost',
+                '',
+            ])),
+            ['ads.example.com', 'tracker.example.com'])
+
+    def test_tagging(self) -> None:
+
+        'Test that recorded queries and their groups are tagged'
+
+        with contextlib.closing(sqlite3.connect(':memory:')) as db:
+            epipydb.create_tables(db)
+            for value in ['www.example.net', 'ad.doubleclick.net']:
+                epipydb.log_line(
+                    db,
+                    'Jan  1 09:00:00 sys dnsmasq[1]: query[A] ' + value +
+                    ' from 192.168.1.1',
+                    category_lookup=self.trie.lookup)
+
+            with contextlib.closing(db.cursor()) as cursor:
+                cursor.execute('SELECT category FROM dnsquery ORDER BY id')
+                self.assertEqual(cursor.fetchall(), [(None,), ('ads',)])
+
+                cursor.execute('SELECT category FROM querygroup')
+                self.assertEqual(cursor.fetchall(), [('ads',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
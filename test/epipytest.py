@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''Helpers shared by the tests which need the database rotation script,
+or a database filled with a large number of simulated DNS queries.
+The record directory must be on the module path before importing.'''
+
+import datetime
+import importlib.machinery
+import importlib.util
+import os
+import random
+import sqlite3
+import sys
+import types
+
+import epipydb
+
+from typing import *
+
+
+TOP_PATH = os.path.join(os.path.dirname(__file__), '..')
+
+
+def load_rotate_script() -> types.ModuleType:
+
+    'Load the database rotation script, which has no .py extension'
+
+    path = os.path.join(TOP_PATH, 'bin', 'epipyweb-database-rotate')
+    loader = importlib.machinery.SourceFileLoader('rotate', path)
+    spec = importlib.util.spec_from_loader('rotate', loader)
+    assert spec is not None
+    module = importlib.util.module_from_spec(spec)
+
+    #  Don't leave compiled bytecode in bin, where it would be linted
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    try:
+        loader.exec_module(module)
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+
+    return module
+
+
+def seed_database(
+        db: sqlite3.Connection,
+        query_count: int,
+        host_count: int,
+        start_time: datetime.datetime,
+        step: Optional[datetime.timedelta] = None,
+        site_count: int = 500) -> None:
+
+    '''Fill the database with simulated DNS queries in groups, from hosts
+    named device-0 onward, each query a step after the last, or a random
+    number of seconds after it if no step is given'''
+
+    rand = random.Random(0)
+    querytime = start_time
+    groups = []
+    queries = []
+    domains = []
+    dhcp = []
+
+    for host_index in range(host_count):
+        dhcp.append((
+            '192.168.1.' + str(host_index),
+            '01:01:01:01:01:' + str(host_index),
+            'device-' + str(host_index),
+            querytime.isoformat()))
+
+    query_id = 1
+    group_id = 1
+    while query_id <= query_count:
+        host_index = rand.randrange(host_count)
+        host = 'device-' + str(host_index)
+        group_size = rand.randrange(1, 10)
+        start_iso = querytime.isoformat()
+
+        for i in range(group_size):
+            value = 'www{}.site{}.example{}.com'.format(
+                rand.randrange(3), rand.randrange(site_count),
+                rand.randrange(5))
+            isotime = querytime.isoformat()
+            queries.append((
+                query_id, group_id, isotime, 'A', value, host,
+                '192.168.1.' + str(host_index)))
+            for subdomain in epipydb.list_domains(value):
+                domains.append((query_id, group_id, isotime, subdomain))
+
+            query_id += 1
+            if step is None:
+                querytime += datetime.timedelta(
+                    seconds=rand.randrange(1, 20))
+            else:
+                querytime += step
+
+        groups.append((
+            group_id, host, start_iso, querytime.isoformat(),
+            queries[-group_size][4], group_size))
+        group_id += 1
+
+    db.executemany(
+        'INSERT INTO dhcpassignment' +
+        ' (ip_address, mac_address, hostname, time)' +
+        ' VALUES (?,?,?,?)', dhcp)
+    db.executemany(
+        'INSERT INTO querygroup' +
+        ' (id, host, start_time, end_time, first_value, query_count)' +
+        ' VALUES (?,?,?,?,?,?)', groups)
+    db.executemany(
+        'INSERT INTO dnsquery' +
+        ' (id, group_id, time, type, value, host, host_ip)' +
+        ' VALUES (?,?,?,?,?,?,?)', queries)
+    db.executemany(
+        'INSERT INTO querydomain (query_id, group_id, time, domain)' +
+        ' VALUES (?,?,?,?)', domains)
+    db.commit()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextlib
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import types
+import unittest
+import unittest.mock
+import urllib.parse
+
+TOP_PATH = os.path.join(os.path.dirname(__file__), '..')
+sys.path.append(os.path.join(TOP_PATH, 'record'))
+sys.path.append(os.path.join(TOP_PATH, 'serve'))
+
+#  The uwsgi module only exists inside uWSGI, and exports don't use it
+sys.modules.setdefault('uwsgi', types.ModuleType('uwsgi'))
+
+import epipydb  # noqa: E402
+import epipyweb_uwsgi  # noqa: E402
+
+from typing import *  # noqa: E402
+
+
+QUERY_COUNT = 5
+
+
+class ExportTest(unittest.TestCase):
+
+    'Check the formats and compression of streamed exports'
+
+    def setUp(self) -> None:
+
+        'Create a database with a few DNS queries'
+
+        self.temp_dir = tempfile.mkdtemp(prefix='epipywebexport')
+        self.database_path = os.path.join(self.temp_dir, 'dns.db')
+
+        with contextlib.closing(sqlite3.connect(self.database_path)) as db:
+            epipydb.create_tables(db)
+            for index in range(QUERY_COUNT):
+                epipydb.log_line(
+                    db,
+                    'Jan  1 09:00:0' + str(index) +
+                    ' sys dnsmasq[1]: query[A] www' + str(index) +
+                    '.example.com from 192.168.1.1')
+            db.commit()
+
+    def tearDown(self) -> None:
+
+        'Remove the database'
+
+        shutil.rmtree(self.temp_dir)
+
+    def export(
+            self,
+            query_string: str,
+            accept_encoding: str) -> Tuple[Dict[str, str], bytes]:
+
+        '''Run an export request, in chunks of two rows, returning the
+        response headers and body'''
+
+        headers = cast(Dict[str, str], {})
+
+        def start_response(
+                status: str,
+                response_headers: Iterable[Tuple[str, str]]) -> None:
+            self.assertEqual(status, '200 OK')
+            headers.update(response_headers)
+
+        with unittest.mock.patch.object(
+                epipyweb_uwsgi, 'DATABASE_PATH', self.database_path):
+            with unittest.mock.patch.object(
+                    epipyweb_uwsgi, 'EXPORT_CHUNK_SIZE', 2):
+                body = b''.join(epipyweb_uwsgi.export(
+                    urllib.parse.parse_qs(query_string), accept_encoding,
+                    start_response))
+
+        return (headers, body)
+
+    def test_csv_header(self) -> None:
+
+        'Test that a CSV export has one header line, however many chunks'
+
+        (headers, body) = self.export('format=csv', '')
+        self.assertEqual(headers['Content-Type'], 'text/csv')
+
+        rows = list(csv.reader(io.StringIO(body.decode('utf-8'))))
+        self.assertEqual(rows[0], epipyweb_uwsgi.EXPORT_COLUMNS)
+        self.assertEqual(len(rows), QUERY_COUNT + 1)
+        self.assertEqual(
+            [row[4] for row in rows[1:]],
+            ['www' + str(index) + '.example.com'
+             for index in range(QUERY_COUNT)])
+
+    def test_csv_empty(self) -> None:
+
+        'Test that a CSV export matching no queries still has a header'
+
+        (headers, body) = self.export('format=csv&host=nobody', '')
+        rows = list(csv.reader(io.StringIO(body.decode('utf-8'))))
+        self.assertEqual(rows, [epipyweb_uwsgi.EXPORT_COLUMNS])
+
+    def test_gzip(self) -> None:
+
+        'Test that a compressed export decompresses to the same rows'
+
+        (_, plain_body) = self.export('', '')
+        (headers, gzip_body) = self.export('', 'gzip, deflate')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(gzip_body), plain_body)
+
+        rows = [
+            json.loads(line)
+            for line in plain_body.decode('utf-8').splitlines()]
+        self.assertEqual(
+            [row['id'] for row in rows], list(range(1, QUERY_COUNT + 1)))
+
+    def test_gzip_csv(self) -> None:
+
+        'Test that a compressed CSV export has the header once'
+
+        (_, plain_body) = self.export('format=csv', '')
+        (_, gzip_body) = self.export('format=csv', 'gzip')
+        self.assertEqual(gzip.decompress(gzip_body), plain_body)
+
+
+if __name__ == '__main__':
+    unittest.main()
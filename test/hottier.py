@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'record'))
+import epipydb  # noqa: E402
+import epipyhot  # noqa: E402
+import epipytrie  # noqa: E402
+import episyslog  # noqa: E402
+
+from typing import *  # noqa: E402
+
+
+def query_line(
+        minute: int,
+        value: str) -> str:
+
+    'A dnsmasq log line for a query far enough apart to start a group'
+
+    return 'Jan  1 09:{:02}:00 sys dnsmasq[1]: query[A] {} from {}'.format(
+        minute, value, '192.168.1.1')
+
+
+class HotTierTest(unittest.TestCase):
+
+    '''Check that the hot tier notices writes by anything other than the
+    recorder, even when they come between the recorder's own writes'''
+
+    def setUp(self) -> None:
+
+        'Point the recorder at a temporary database'
+
+        self.temp_dir = tempfile.mkdtemp(prefix='epipywebhot')
+        database_path = os.path.join(self.temp_dir, 'dns.db')
+
+        patches = [
+            unittest.mock.patch.object(
+                epipydb, 'DATABASE_PATH', database_path),
+            unittest.mock.patch.object(
+                epipydb, 'TEST_LOCK_FILENAME',
+                os.path.join(self.temp_dir, 'dns.test-lock')),
+        ]
+        for patch in cast(List[Any], patches):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.categories = epipytrie.CategoryTrie(
+            os.path.join(self.temp_dir, 'categories.trie'))
+        self.hot_tier = epipyhot.HotTier()
+
+        for minute in range(3):
+            self.record(minute, 'www{}.example.com'.format(minute))
+        self.assertEqual(self.newest_value(), 'www2.example.com')
+        self.assertTrue(self.hot_tier.warm)
+
+    def tearDown(self) -> None:
+
+        'Remove the database'
+
+        shutil.rmtree(self.temp_dir)
+
+    def record(
+            self,
+            minute: int,
+            value: str) -> None:
+
+        'Record a log line as the recorder does'
+
+        episyslog.handle_log_line(
+            query_line(minute, value), None, self.hot_tier, False,
+            self.categories)
+
+    def other_writer(
+            self,
+            minute: int,
+            value: str) -> None:
+
+        'Record a log line through a connection of another writer'
+
+        with contextlib.closing(epipydb.open_database()) as db:
+            epipydb.log_line(db, query_line(minute, value))
+            db.commit()
+
+    def newest_value(self) -> str:
+
+        'Get the first value of the newest group served by the hot tier'
+
+        result = self.hot_tier.handle_request('dnsquerygroup 1', False)
+        return result['groups'][0]['value']
+
+    def test_recorder_writes(self) -> None:
+
+        'Test that the recorder\'s own writes keep the hot tier warm'
+
+        self.record(3, 'www3.example.com')
+        self.assertTrue(self.hot_tier.warm)
+        self.assertEqual(self.newest_value(), 'www3.example.com')
+
+    def test_write_between_records(self) -> None:
+
+        'Test that a write by another writer between records is noticed'
+
+        self.other_writer(3, 'other.example.com')
+        self.record(4, 'www4.example.com')
+
+        result = self.hot_tier.handle_request('dnsquerygroup 2', False)
+        self.assertEqual(
+            [group['value'] for group in result['groups']],
+            ['www4.example.com', 'other.example.com'])
+
+    def test_write_after_commit(self) -> None:
+
+        '''Test that a write by another writer just after the recorder's
+        commit, before the hot tier is updated, is noticed'''
+
+        record = self.hot_tier.record
+
+        def record_after_other_writer(
+                db: sqlite3.Connection,
+                query_id: Optional[int]) -> None:
+            self.other_writer(4, 'other.example.com')
+            record(db, query_id)
+
+        with unittest.mock.patch.object(
+                self.hot_tier, 'record', record_after_other_writer):
+            self.record(3, 'www3.example.com')
+        self.assertFalse(self.hot_tier.warm)
+
+        result = self.hot_tier.handle_request('dnsquerygroup 2', False)
+        self.assertEqual(
+            [group['value'] for group in result['groups']],
+            ['other.example.com', 'www3.example.com'])
+
+    def test_groupqueries_page(self) -> None:
+
+        '''Test that the queries of the newest page of groups are served
+        for the groups with more than one query'''
+
+        self.record(3, 'www3.example.com')
+        self.record(3, 'img3.example.com')
+
+        result = self.hot_tier.handle_request('groupqueries_page 2', False)
+        self.assertEqual(len(result['groups']), 1)
+        (queries,) = [group['queries'] for group in result['groups'].values()]
+        self.assertEqual(
+            [query['value'] for query in queries],
+            ['www3.example.com', 'img3.example.com'])
+
+        result = self.hot_tier.handle_request('groupqueries_page 4', False)
+        self.assertEqual(result, {'cold': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextlib
+import gzip
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+import unittest.mock
+import urllib.error
+
+TOP_PATH = os.path.join(os.path.dirname(__file__), '..')
+sys.path.append(os.path.join(TOP_PATH, 'record'))
+sys.path.append(os.path.join(TOP_PATH, 'serve'))
+
+#  The uwsgi module only exists inside uWSGI, and ingest doesn't use it
+sys.modules.setdefault('uwsgi', types.ModuleType('uwsgi'))
+
+import epipydb  # noqa: E402
+import epipyforward  # noqa: E402
+import epipyweb_uwsgi  # noqa: E402
+
+from typing import *  # noqa: E402
+
+
+BATCH = [
+    epipydb.parse_line(
+        'Jan  1 08:00:00 sys dnsmasq-dhcp[1]: DHCPACK(eth0) 192.168.1.1' +
+        ' 01:01:01:01:01:01 device-name'),
+    epipydb.parse_line(
+        'Jan  1 09:00:00 sys dnsmasq[1]: query[A] www.example.com' +
+        ' from 192.168.1.1'),
+]
+
+
+class IngestBatchTest(unittest.TestCase):
+
+    'Check that forwarded batches are applied once, with namespaced hosts'
+
+    def setUp(self) -> None:
+
+        'Create an empty in-memory database'
+
+        self.db = sqlite3.connect(':memory:')
+        epipydb.create_tables(self.db)
+
+    def tearDown(self) -> None:
+
+        'Discard the database'
+
+        self.db.close()
+
+    def query_hosts(self) -> List[str]:
+
+        'Get the host of every recorded DNS query'
+
+        with contextlib.closing(self.db.cursor()) as cursor:
+            cursor.execute('SELECT host FROM dnsquery ORDER BY id')
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_namespace(self) -> None:
+
+        'Test that hosts are prefixed with the forwarding device name'
+
+        self.assertTrue(epipydb.log_ingest_batch(
+            self.db, 'remote', 1, cast(List[Dict[str, str]], BATCH)))
+        self.assertEqual(self.query_hosts(), ['remote/device-name'])
+
+    def test_retry(self) -> None:
+
+        'Test that a retried batch is not applied a second time'
+
+        batch = cast(List[Dict[str, str]], BATCH)
+        self.assertTrue(epipydb.log_ingest_batch(self.db, 'remote', 1, batch))
+        self.assertFalse(
+            epipydb.log_ingest_batch(self.db, 'remote', 1, batch))
+        self.assertTrue(epipydb.log_ingest_batch(self.db, 'other', 1, batch))
+
+        self.assertEqual(
+            self.query_hosts(), ['remote/device-name', 'other/device-name'])
+
+    def test_regression(self) -> None:
+
+        'Test that a batch numbered below the last applied is refused'
+
+        batch = cast(List[Dict[str, str]], BATCH)
+        self.assertTrue(epipydb.log_ingest_batch(self.db, 'remote', 5, batch))
+        with self.assertRaises(epipydb.IngestSequenceError) as raised:
+            epipydb.log_ingest_batch(self.db, 'remote', 1, batch)
+        self.assertEqual(raised.exception.last_sequence, 5)
+        self.assertEqual(self.query_hosts(), ['remote/device-name'])
+
+
+class IngestHandlerTest(unittest.TestCase):
+
+    'Check the /q/ingest request handler of the central instance'
+
+    def setUp(self) -> None:
+
+        '''Create a temporary directory for the central database, and
+        enable ingest with a shared token'''
+
+        self.temp_dir = tempfile.mkdtemp(prefix='epipywebingest')
+        self.database_path = os.path.join(self.temp_dir, 'dns.db')
+        self.token_path = os.path.join(self.temp_dir, 'ingest.token')
+        with open(self.token_path, 'w') as token_file:
+            token_file.write('secret\n')
+
+        patches = [
+            unittest.mock.patch.object(
+                epipyweb_uwsgi, 'DATABASE_PATH', self.database_path),
+            unittest.mock.patch.object(
+                epipyweb_uwsgi, 'INGEST_TOKEN_PATH', self.token_path),
+        ]
+        for patch in cast(List[Any], patches):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self) -> None:
+
+        'Remove the central database'
+
+        shutil.rmtree(self.temp_dir)
+
+    def post(
+            self,
+            query_string: str,
+            body: bytes,
+            method: str = 'POST',
+            token: str = 'secret') -> Tuple[str, Dict]:
+
+        'Run an ingest request, returning the status and decoded result'
+
+        env = {
+            'PATH_INFO': '/q/ingest',
+            'QUERY_STRING': query_string,
+            'REQUEST_METHOD': method,
+            'CONTENT_LENGTH': str(len(body)),
+            'HTTP_CONTENT_ENCODING': 'gzip',
+            'HTTP_X_EPIPYWEB_TOKEN': token,
+            'wsgi.input': io.BytesIO(body),
+        }
+        statuses = []
+
+        def start_response(
+                status: str,
+                headers: Iterable[Tuple[str, str]]) -> None:
+            statuses.append(status)
+
+        response = b''.join(epipyweb_uwsgi.application(
+            cast(Dict[str, str], env), start_response))
+
+        return (statuses[0], json.loads(response.decode('utf-8')))
+
+    def query_hosts(self) -> List[str]:
+
+        'Get the host of every DNS query in the central database'
+
+        with contextlib.closing(sqlite3.connect(self.database_path)) as db:
+            with contextlib.closing(db.cursor()) as cursor:
+                cursor.execute('SELECT host FROM dnsquery ORDER BY id')
+                return [row[0] for row in cursor.fetchall()]
+
+    def test_ingest(self) -> None:
+
+        'Test that a batch is applied once, and a regression is refused'
+
+        body = gzip.compress(str.join('', [
+            json.dumps(record) + '\n' for record in BATCH]).encode('utf-8'))
+
+        self.assertEqual(
+            self.post('device=remote&sequence=2', body),
+            ('200 OK', {'sequence': 2, 'applied': True}))
+        self.assertEqual(
+            self.post('device=remote&sequence=2', body),
+            ('200 OK', {'sequence': 2, 'applied': False}))
+
+        (status, result) = self.post('device=remote&sequence=1', body)
+        self.assertEqual(status, '409 Conflict')
+        self.assertEqual(result['sequence'], 2)
+
+        self.assertEqual(self.query_hosts(), ['remote/device-name'])
+
+    def test_invalid(self) -> None:
+
+        'Test that malformed requests are refused without being applied'
+
+        body = gzip.compress(b'["not a record"]\n')
+        (status, _) = self.post('device=remote&sequence=1', body)
+        self.assertEqual(status, '400 Bad Request')
+
+        (status, _) = self.post('device=remote&sequence=1', b'', 'GET')
+        self.assertEqual(status, '400 Bad Request')
+
+        (status, _) = self.post('device=bad/name&sequence=1', b'')
+        self.assertEqual(status, '400 Bad Request')
+
+    def test_token(self) -> None:
+
+        '''Test that a batch without the shared token is forbidden, and
+        that ingest isn't found at all until a token is configured'''
+
+        body = gzip.compress(str.join('', [
+            json.dumps(record) + '\n' for record in BATCH]).encode('utf-8'))
+
+        (status, _) = self.post('device=remote&sequence=1', body, token='')
+        self.assertEqual(status, '403 Forbidden')
+        (status, _) = self.post(
+            'device=remote&sequence=1', body, token='wrong')
+        self.assertEqual(status, '403 Forbidden')
+
+        os.unlink(self.token_path)
+        (status, _) = self.post('device=remote&sequence=1', body)
+        self.assertEqual(status, '404 Not Found')
+
+        self.assertFalse(os.path.exists(self.database_path))
+
+
+class FakeCentral:
+
+    '''Stands in for send_batch, failing a given number of times, and
+    refusing sequence numbers below a given one as the central instance
+    would after a reset'''
+
+    def __init__(
+            self,
+            failures: int = 0,
+            last_sequence: int = 0) -> None:
+
+        self.failures = failures
+        self.last_sequence = last_sequence
+        self.attempts = cast(List[int], [])
+        self.applied = cast(List[Tuple[int, List[Dict]]], [])
+        self.release = threading.Event()
+        self.release.set()
+
+    def send_batch(
+            self,
+            url: str,
+            device: str,
+            token: str,
+            sequence: int,
+            payload: bytes) -> None:
+
+        'Record an attempt to send a batch, and apply it if it succeeds'
+
+        self.release.wait()
+        self.attempts.append(sequence)
+
+        if self.failures > 0:
+            self.failures -= 1
+            raise urllib.error.URLError('connection refused')
+
+        if sequence < self.last_sequence:
+            raise urllib.error.HTTPError(
+                url, 409, 'Conflict', cast(Any, {}),
+                io.BytesIO(json.dumps({
+                    'sequence': self.last_sequence}).encode('utf-8')))
+
+        records = [
+            json.loads(line)
+            for line in gzip.decompress(payload).decode('utf-8').splitlines()]
+        self.applied.append((sequence, records))
+        self.last_sequence = sequence
+
+
+class ForwarderTest(unittest.TestCase):
+
+    'Check that the forwarder sends batches in order, retrying failures'
+
+    def setUp(self) -> None:
+
+        'Create a temporary queue directory, and shorten retry delays'
+
+        self.temp_dir = tempfile.mkdtemp(prefix='epipywebforward')
+        self.queue_dir = os.path.join(self.temp_dir, 'forward')
+        self.sequence_path = os.path.join(self.temp_dir, 'forward.sequence')
+
+        patches = [
+            unittest.mock.patch.object(
+                epipyforward, 'FORWARD_RETRY_MIN_DELAY', 0.01),
+            unittest.mock.patch.object(
+                epipyforward, 'FORWARD_RETRY_MAX_DELAY', 0.04),
+            unittest.mock.patch.object(epipyforward.syslog, 'syslog'),
+        ]
+        for patch in cast(List[Any], patches):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self) -> None:
+
+        'Remove the queue directory'
+
+        shutil.rmtree(self.temp_dir)
+
+    def forwarder(
+            self,
+            central: FakeCentral) -> epipyforward.Forwarder:
+
+        'Create a forwarder sending each record as its own batch'
+
+        patch = unittest.mock.patch.object(
+            epipyforward, 'send_batch', central.send_batch)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        return epipyforward.Forwarder(
+            'http://central/q/ingest', 'remote', 'secret', 1, 10.0,
+            self.queue_dir, self.sequence_path)
+
+    def test_retry_order(self) -> None:
+
+        'Test that batches are sent in order after failures are retried'
+
+        central = FakeCentral(failures=3)
+        forwarder = self.forwarder(central)
+        for index in range(3):
+            forwarder.add({'index': str(index)})
+        forwarder.close(timeout=5.0)
+
+        self.assertEqual(central.attempts[:3], [1, 1, 1])
+        self.assertEqual(
+            [sequence for (sequence, _) in central.applied], [1, 2, 3])
+        self.assertEqual(
+            [records for (_, records) in central.applied],
+            [[{'index': '0'}], [{'index': '1'}], [{'index': '2'}]])
+        self.assertEqual(os.listdir(self.queue_dir), [])
+
+    def test_not_blocking(self) -> None:
+
+        'Test that queueing a batch doesn\'t wait for a slow central'
+
+        central = FakeCentral()
+        central.release.clear()
+        forwarder = self.forwarder(central)
+
+        start = time.monotonic()
+        for index in range(3):
+            forwarder.add({'index': str(index)})
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(central.applied, [])
+
+        central.release.set()
+        forwarder.close(timeout=5.0)
+        self.assertEqual(
+            [sequence for (sequence, _) in central.applied], [1, 2, 3])
+
+    def test_restart(self) -> None:
+
+        'Test that batches not yet sent are sent by the next run'
+
+        central = FakeCentral(failures=1000)
+        forwarder = self.forwarder(central)
+        forwarder.add({'index': '0'})
+        forwarder.add({'index': '1'})
+        forwarder.close(timeout=0.1)
+        forwarder.sender.join()
+        self.assertEqual(central.applied, [])
+
+        central.failures = 0
+        forwarder = self.forwarder(central)
+        forwarder.add({'index': '2'})
+        forwarder.close(timeout=5.0)
+
+        self.assertEqual(
+            [sequence for (sequence, _) in central.applied], [1, 2, 3])
+        self.assertEqual(
+            [records[0]['index'] for (_, records) in central.applied],
+            ['0', '1', '2'])
+
+    def test_renumber(self) -> None:
+
+        'Test that batches follow on after the central\'s last sequence'
+
+        central = FakeCentral(last_sequence=10)
+        forwarder = self.forwarder(central)
+        forwarder.add({'index': '0'})
+        forwarder.add({'index': '1'})
+        forwarder.close(timeout=5.0)
+
+        self.assertEqual(
+            [sequence for (sequence, _) in central.applied], [11, 12])
+        self.assertEqual(forwarder.next_sequence, 13)
+        self.assertEqual(
+            epipyforward.read_sequence(self.sequence_path), 13)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'record'))
+import epipyprofile  # noqa: E402
+
+from typing import *  # noqa: E402
+
+
+def allocate_domains() -> List[str]:
+
+    'Do some work which allocates memory, to be found in the reports'
+
+    return ['www{}.example.com'.format(i) for i in range(20000)]
+
+
+class ProfilerTest(unittest.TestCase):
+
+    'Check switching profiling on and off, and the reports written'
+
+    def setUp(self) -> None:
+
+        'Create a temporary directory for the reports'
+
+        self.temp_dir = tempfile.mkdtemp(prefix='epipywebprofile')
+        self.previous_handler = signal.getsignal(
+            epipyprofile.PROFILE_SIGNAL)
+
+    def tearDown(self) -> None:
+
+        'Discard the reports and restore the signal handler'
+
+        signal.signal(epipyprofile.PROFILE_SIGNAL, self.previous_handler)
+        shutil.rmtree(self.temp_dir)
+
+    def test_reports(self) -> None:
+
+        'Test that hot functions and allocation sites are reported'
+
+        profiler = epipyprofile.Profiler('test', self.temp_dir)
+        self.assertFalse(profiler.active)
+        self.assertEqual(profiler.stop(), [])
+
+        self.assertEqual(profiler.toggle(), [])
+        self.assertTrue(profiler.active)
+        domains = allocate_domains()
+        paths = profiler.toggle()
+        self.assertFalse(profiler.active)
+
+        self.assertEqual(len(paths), 3)
+        for path in paths:
+            self.assertEqual(os.path.dirname(path), self.temp_dir)
+            self.assertTrue(os.path.exists(path))
+
+        with open(paths[1]) as report_file:
+            self.assertIn('allocate_domains', report_file.read())
+        with open(paths[2]) as report_file:
+            self.assertIn(__file__, report_file.read())
+        self.assertEqual(len(domains), 20000)
+
+    def test_disabled(self) -> None:
+
+        'Test that nothing is installed without the environment variable'
+
+        with unittest.mock.patch.dict(
+                os.environ, {epipyprofile.PROFILE_ENVIRONMENT: '0'}):
+            self.assertIsNone(
+                epipyprofile.install_signal_toggle('test', print))
+
+        self.assertIs(
+            signal.getsignal(epipyprofile.PROFILE_SIGNAL),
+            self.previous_handler)
+
+    def test_signal(self) -> None:
+
+        'Test switching profiling on and off with a signal'
+
+        logged = cast(List[str], [])
+        with unittest.mock.patch.dict(
+                os.environ, {epipyprofile.PROFILE_ENVIRONMENT: '1'}):
+            with unittest.mock.patch('atexit.register'):
+                profiler = epipyprofile.install_signal_toggle(
+                    'test', logged.append, self.temp_dir)
+
+        assert profiler is not None
+        self.assertEqual(profiler.profile_dir, self.temp_dir)
+        self.assertFalse(profiler.active)
+
+        os.kill(os.getpid(), epipyprofile.PROFILE_SIGNAL)
+        self.assertTrue(profiler.active)
+        allocate_domains()
+        os.kill(os.getpid(), epipyprofile.PROFILE_SIGNAL)
+        self.assertFalse(profiler.active)
+
+        self.assertEqual(len(logged), 3)
+        self.assertEqual(len(os.listdir(self.temp_dir)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
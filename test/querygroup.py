@@ -137,6 +137,56 @@ class GetQueryGroupTest(unittest.TestCase):
         self.assertEqual(response['groups'][0]['value'], 'www.example.com')
         self.assertEqual(response['groups'][0]['host'], 'device-name')
 
+    def test_columnar(self) -> None:
+
+        'Test that we can get a page of DNS query groups in columnar format'
+
+        conn = http.client.HTTPConnection("localhost")
+        try:
+            conn.request("GET", "/q/dnsquerygroup?format=columnar")
+            response_str = conn.getresponse().read().decode('utf-8')
+        finally:
+            conn.close()
+
+        groups = json.loads(response_str)['groups']
+        self.assertEqual(groups['length'], 1)
+        self.assertEqual(groups['value'], ['www.example.com'])
+        self.assertEqual(groups['host_dictionary'], ['device-name'])
+        self.assertEqual(groups['host'], [0])
+
+    def test_groupqueries_batch(self) -> None:
+
+        'Test that we can get the DNS queries of several groups at once'
+
+        conn = http.client.HTTPConnection("localhost")
+        try:
+            conn.request("GET", "/q/groupqueries?id=1&id=2")
+            response_str = conn.getresponse().read().decode('utf-8')
+        finally:
+            conn.close()
+
+        groups = json.loads(response_str)['groups']
+        self.assertEqual(
+            groups['1']['queries'][0]['value'], 'www.example.com')
+        self.assertEqual(groups['1']['queries'][0]['repeat_count'], 1)
+        self.assertEqual(groups['2']['queries'], [])
+
+    def test_export(self) -> None:
+
+        'Test that we can export DNS queries as newline delimited JSON'
+
+        conn = http.client.HTTPConnection("localhost")
+        try:
+            conn.request("GET", "/q/export?host=device-name")
+            response_str = conn.getresponse().read().decode('utf-8')
+        finally:
+            conn.close()
+
+        rows = [json.loads(line) for line in response_str.splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['value'], 'www.example.com')
+        self.assertEqual(rows[0]['host_ip'], '192.168.1.1')
+
 
 if __name__ == '__main__':
     unittest.main()
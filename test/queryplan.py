@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextlib
+import datetime
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+import unittest
+import unittest.mock
+
+TOP_PATH = os.path.join(os.path.dirname(__file__), '..')
+sys.path.append(os.path.join(TOP_PATH, 'record'))
+sys.path.append(os.path.join(TOP_PATH, 'serve'))
+
+#  The uwsgi module only exists inside uWSGI, and none of the functions
+#  traced here use it
+sys.modules.setdefault('uwsgi', types.ModuleType('uwsgi'))
+
+import epipyarchive  # noqa: E402
+import epipydb  # noqa: E402
+import epipyhot  # noqa: E402
+import epipysuggest  # noqa: E402
+import epipytest  # noqa: E402
+import epipyweb_uwsgi  # noqa: E402
+
+from typing import *  # noqa: E402
+
+
+SEED_QUERY_COUNT = int(os.environ.get('EPIPYWEB_QUERYPLAN_QUERIES', 100000))
+SEED_HOST_COUNT = 20
+SEED_START_TIME = datetime.datetime(2017, 1, 1)
+
+#  Statements which scan a table, but stop after a bounded number of
+#  rows because they walk the table in rowid order with a LIMIT
+BOUNDED_SCANS = [
+    r'^SELECT .* FROM querygroup ORDER BY (querygroup\.)?id (ASC|DESC)' +
+    r' LIMIT [0-9]+$',
+]
+
+
+class Statement:
+
+    'A SQL statement traced while running a workload, and its query plan'
+
+    def __init__(
+            self,
+            workload: str,
+            hot: bool,
+            sql: str) -> None:
+
+        self.workload = workload
+        self.hot = hot
+        self.sql = sql
+        self.plan = cast(List[str], [])
+        self.seconds = 0.0
+
+    def problems(self) -> List[str]:
+
+        'List the steps of the plan which fall back to scans or sorts'
+
+        problems = []
+        for detail in self.plan:
+            if detail.startswith('SCAN ') and \
+                    not detail.startswith('SCAN CONSTANT ROW'):
+                if not any(re.match(pattern, self.sql)
+                           for pattern in BOUNDED_SCANS):
+                    problems.append(detail)
+            elif 'TEMP B-TREE' in detail:
+                problems.append(detail)
+
+        return problems
+
+
+def run_request(
+        request: Generator[bytes, None, Dict]) -> Dict:
+
+    'Run a request handler of the web back-end to completion'
+
+    try:
+        while True:
+            next(request)
+    except StopIteration as stop:
+        return stop.value
+
+
+class QueryPlanTest(unittest.TestCase):
+
+    '''Run the statements issued by the recorder, the web back-end and
+    database rotation against a large database, and check that the
+    frequently run ones use indices rather than scanning or sorting'''
+
+    statements = cast(List[Statement], [])
+    temp_dir = ''
+    database_path = ''
+
+    @classmethod
+    def setUpClass(cls) -> None:
+
+        'Build the seeded database shared by all workloads'
+
+        cls.temp_dir = tempfile.mkdtemp(prefix='epipywebplan')
+        cls.database_path = os.path.join(cls.temp_dir, 'dns.db')
+
+        with contextlib.closing(sqlite3.connect(cls.database_path)) as db:
+            epipydb.create_tables(db)
+            epipytest.seed_database(
+                db, SEED_QUERY_COUNT, SEED_HOST_COUNT, SEED_START_TIME)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+
+        'Report the plan and timing of every statement'
+
+        for statement in cls.statements:
+            marker = ' '
+            if statement.hot and statement.problems():
+                marker = '!'
+            elif not statement.hot:
+                marker = '-'
+
+            sys.stdout.write('{} {:9.3f}ms {:14} {}\n'.format(
+                marker, statement.seconds * 1000.0, statement.workload,
+                statement.sql))
+            for detail in statement.plan:
+                sys.stdout.write('        ' + detail + '\n')
+
+        shutil.rmtree(cls.temp_dir)
+
+    def trace(
+            self,
+            workload: str,
+            hot: bool,
+            database_path: str,
+            run: Callable[[], Any]) -> List[Statement]:
+
+        '''Run a workload, collecting every statement it executes, and
+        measure the query plan and run time of each'''
+
+        traced = cast(List[str], [])
+        connect = sqlite3.connect
+
+        def traced_connect(*args: Any, **kwargs: Any) -> sqlite3.Connection:
+            db = connect(*args, **kwargs)
+            db.set_trace_callback(traced.append)
+            return db
+
+        #  Keep a copy of the database as it was before the workload, to
+        #  replay the statements against for timing
+        replay_path = os.path.join(self.temp_dir, 'replay.db')
+        shutil.copy(database_path, replay_path)
+
+        with unittest.mock.patch.object(sqlite3, 'connect', traced_connect):
+            with unittest.mock.patch.object(
+                    epipydb, 'DATABASE_PATH', database_path):
+                with unittest.mock.patch.object(
+                        epipyweb_uwsgi, 'DATABASE_PATH', database_path):
+                    run()
+
+        statements = []
+        for sql in traced:
+            sql = str.join(' ', sql.split())
+            if re.match(r'^(SELECT|INSERT|UPDATE|DELETE) ', sql):
+                statements.append(Statement(workload, hot, sql))
+
+        with contextlib.closing(sqlite3.connect(replay_path)) as db:
+            db.isolation_level = None
+            replay_statements(db, statements)
+        os.unlink(replay_path)
+
+        self.statements.extend(statements)
+        return statements
+
+    def check(
+            self,
+            workload: str,
+            database_path: str,
+            run: Callable[[], Any]) -> None:
+
+        'Trace a frequently run workload and fail on scans and sorts'
+
+        for statement in self.trace(workload, True, database_path, run):
+            self.assertEqual(
+                statement.problems(), [],
+                'Statement: ' + statement.sql)
+
+    def test_recorder(self) -> None:
+
+        'Check the statements issued when recording log lines'
+
+        def run() -> None:
+            with contextlib.closing(epipydb.open_database()) as db:
+                epipydb.log_line(
+                    db,
+                    'Jan  1 08:00:00 sys dnsmasq-dhcp[1]: DHCPACK(eth0)' +
+                    ' 192.168.1.3 01:01:01:01:01:03 device-3')
+                for coalesce in [False, True]:
+                    epipydb.log_line(
+                        db,
+                        'Jan  1 09:00:00 sys dnsmasq[1]: query[A]' +
+                        ' www.example.com from 192.168.1.3',
+                        coalesce)
+                epipydb.log_ingest_batch(db, 'remote', 1, [])
+                db.rollback()
+
+        self.check('recorder', self.database_path, run)
+
+    def test_dnsquerygroup(self) -> None:
+
+        'Check the statements issued when serving pages of query groups'
+
+        def run() -> None:
+            for query in [
+                    {},
+                    {'before': ['1000']},
+                    {'after': ['1000']},
+                    {'search': ['site1']},
+                    {'search': ['site1'], 'before': ['1000']},
+                    {'search': ['site1'], 'after': ['1000']},
+                    {'category': ['ads']},
+                    {'category': ['ads'], 'before': ['1000']},
+                    {'category': ['ads'], 'search': ['site1']}]:
+                run_request(epipyweb_uwsgi.dnsquerygroup(query))
+
+        self.check('dnsquerygroup', self.database_path, run)
+
+    def test_groupqueries(self) -> None:
+
+        'Check the statements issued when serving the queries of a group'
+
+        def run() -> None:
+            for query in [
+                    {'id': ['1000']},
+                    {'id': ['1000', '1001', '1002']},
+                    {'page': ['1'], 'count': ['25']}]:
+                run_request(epipyweb_uwsgi.groupqueries(query))
+
+        self.check('groupqueries', self.database_path, run)
+
+    def test_hot_tier(self) -> None:
+
+        'Check the statements issued when loading and updating the hot tier'
+
+        def run() -> None:
+            hot_tier = epipyhot.HotTier()
+            with contextlib.closing(epipydb.open_database()) as db:
+                hot_tier.load(db)
+                query_id = epipydb.log_line(
+                    db,
+                    'Jan  1 09:00:00 sys dnsmasq[1]: query[A]' +
+                    ' www.example.com from 192.168.1.3')
+                hot_tier.record(db, query_id)
+                db.rollback()
+
+        self.check('hot tier', self.database_path, run)
+
+    def test_suggest(self) -> None:
+
+        '''Check the statements issued when building the index of domains
+        for suggestions a chunk at a time, and when refreshing it'''
+
+        index = epipysuggest.DomainIndex()
+
+        def refresh() -> None:
+            with contextlib.closing(epipydb.open_database()) as db:
+                index.refresh(
+                    db, epipydb.database_signature(self.database_path))
+
+        def build() -> None:
+            refresh()
+            refresh()
+
+        def run() -> None:
+            index.refresh_time = None
+            index.signature = None
+            refresh()
+            index.suggest('www1.site1', 10)
+
+        self.check('suggest build', self.database_path, build)
+        self.check('suggest', self.database_path, run)
+
+    def test_timeline(self) -> None:
+
+        'Check the statements issued when counting queries for a timeline'
+
+        def run() -> None:
+            for query in [
+                    {'host': ['device-1']},
+                    {'host': ['device-1'], 'since': ['2017-01-01'],
+                     'until': ['2017-01-08'], 'bucket': ['60']},
+                    {'host': ['device-1'], 'since': ['2017-01-01'],
+                     'bucket': ['3600'], 'domains': ['5']}]:
+                epipyweb_uwsgi.timeline(query)
+
+        self.check('timeline', self.database_path, run)
+
+    def test_rotate(self) -> None:
+
+        'Check the statements issued when rotating the database'
+
+        rotate_path = os.path.join(self.temp_dir, 'rotate.db')
+        shutil.copy(self.database_path, rotate_path)
+        rotate = epipytest.load_rotate_script()
+
+        def run() -> None:
+            discard_time = SEED_START_TIME + datetime.timedelta(days=1)
+            with contextlib.closing(sqlite3.connect(rotate_path)) as db:
+                with contextlib.redirect_stdout(None):
+                    rotate.rotate(
+                        db, discard_time,
+                        os.path.join(self.temp_dir, 'archive'))
+
+        self.check('rotate', rotate_path, run)
+
+    def test_export(self) -> None:
+
+        '''Check the statements issued when exporting the queries of a
+        host, and of a time range, which must continue from the last
+        exported id without sorting again for each chunk'''
+
+        def run() -> None:
+            with contextlib.closing(sqlite3.connect(
+                    self.database_path)) as db:
+                for _ in epipyweb_uwsgi.export_chunks(
+                        db, None, None, 'device-1'):
+                    pass
+                for _ in epipyweb_uwsgi.export_chunks(
+                        db, '2017-01-02T00:00:00', '2017-01-03T00:00:00',
+                        None):
+                    pass
+
+        with unittest.mock.patch.object(
+                epipyweb_uwsgi, 'EXPORT_CHUNK_SIZE', 1000):
+            self.check('export', self.database_path, run)
+
+
+def replay_statements(
+        db: sqlite3.Connection,
+        statements: List[Statement]) -> None:
+
+    '''Find the query plan of each statement, and time running them in
+    order against a copy of the database, rolling back the changes'''
+
+    with contextlib.closing(db.cursor()) as cursor:
+        cursor.execute('BEGIN')
+
+        for statement in statements:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement.sql)
+            statement.plan = [row[3] for row in cursor.fetchall()]
+
+            start = time.perf_counter()
+            cursor.execute(statement.sql)
+            cursor.fetchall()
+            statement.seconds = time.perf_counter() - start
+
+        cursor.execute('ROLLBACK')
+
+
+if __name__ == '__main__':
+    unittest.main()
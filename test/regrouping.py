@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextlib
+import os
+import sqlite3
+import sys
+import unittest
+import unittest.mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'record'))
+import epipydb  # noqa: E402
+import regroup  # noqa: E402
+
+from typing import *  # noqa: E402
+
+
+DEFAULT_RULES = regroup.GroupingRules(
+    epipydb.QUERY_GROUP_TIME_TOLERANCE,
+    epipydb.QUERY_GROUP_EXTENDED_TIME,
+    epipydb.QUERY_GROUP_MAX_QUERIES)
+
+
+class RegroupTest(unittest.TestCase):
+
+    'Check that query groups are recomputed in a single pass'
+
+    def setUp(self) -> None:
+
+        'Record DNS queries from two hosts to an in-memory database'
+
+        self.db = sqlite3.connect(':memory:')
+        epipydb.create_tables(self.db)
+
+        queries = [
+            ('09:00:00', 'www.example.com', '192.168.1.1'),
+            ('09:00:10', 'cdn.example.com', '192.168.1.1'),
+            ('09:00:20', 'www.example.org', '192.168.1.2'),
+            ('09:05:00', 'www.example.com', '192.168.1.1'),
+            ('09:05:00', 'mail.example.com', '192.168.1.1'),
+            ('09:30:00', 'www.example.org', '192.168.1.2'),
+        ]
+        for (time, value, address) in queries:
+            epipydb.log_line(
+                self.db,
+                'Jan  1 ' + time + ' sys dnsmasq[1]: query[A] ' + value +
+                ' from ' + address)
+        self.db.commit()
+
+    def tearDown(self) -> None:
+
+        'Discard the database'
+
+        self.db.close()
+
+    def snapshot(self) -> Tuple[List[Any], List[Any]]:
+
+        'Get the query groups and the group of each query domain'
+
+        with contextlib.closing(self.db.cursor()) as cursor:
+            cursor.execute(
+                'SELECT id, host, start_time, end_time,' +
+                '     first_value, query_count' +
+                ' FROM querygroup ORDER BY id')
+            groups = cursor.fetchall()
+
+            cursor.execute(
+                'SELECT query_id, group_id FROM querydomain ORDER BY rowid')
+            domains = cursor.fetchall()
+
+        return (groups, domains)
+
+    def test_same_rules(self) -> None:
+
+        'Test that regrouping with the ingest rules changes nothing'
+
+        before = self.snapshot()
+        regroup.regroup(self.db, DEFAULT_RULES, None)
+
+        self.assertEqual(self.snapshot(), before)
+
+    def test_max_queries(self) -> None:
+
+        'Test that a lower query cap splits groups'
+
+        rules = regroup.GroupingRules(
+            epipydb.QUERY_GROUP_TIME_TOLERANCE,
+            epipydb.QUERY_GROUP_EXTENDED_TIME,
+            2)
+        self.assertEqual(regroup.regroup(self.db, rules, None), 3)
+
+        (groups, domains) = self.snapshot()
+        self.assertEqual(
+            [(group[1], group[5]) for group in groups],
+            [('192.168.1.1', 2), ('192.168.1.2', 2), ('192.168.1.1', 2)])
+        self.assertEqual(
+            [group_id for (_, group_id) in domains],
+            [1, 1, 1, 1, 2, 2, 3, 3, 3, 3, 2, 2])
+
+    def test_retry(self) -> None:
+
+        'Test that a regroup can be retried after one which failed'
+
+        before = self.snapshot()
+        with unittest.mock.patch.object(
+                regroup, 'rewrite_groups', side_effect=sqlite3.Error):
+            with self.assertRaises(sqlite3.Error):
+                regroup.regroup(self.db, DEFAULT_RULES, None)
+        self.assertEqual(self.snapshot(), before)
+
+        self.assertEqual(regroup.regroup(self.db, DEFAULT_RULES, None), 2)
+        self.assertEqual(self.snapshot(), before)
+
+    def test_closed_values(self) -> None:
+
+        'Test that only the newest group of each host keeps its set of values'
+
+        rules = regroup.GroupingRules(
+            epipydb.QUERY_GROUP_TIME_TOLERANCE,
+            epipydb.QUERY_GROUP_EXTENDED_TIME,
+            2)
+        self.db.execute(
+            'CREATE TEMP TABLE regroupquery' +
+            ' (query_id INTEGER PRIMARY KEY, group_index INTEGER)')
+        groups = regroup.sweep_queries(
+            self.db, rules, 1, regroup.newest_query_id(self.db))
+
+        self.assertEqual(
+            [(group.host, len(group.values)) for group in groups],
+            [('192.168.1.1', 0), ('192.168.1.1', 2), ('192.168.1.2', 1)])
+
+    def test_batches(self) -> None:
+
+        '''Test that sweeping in batches, with several queries at the time
+        a batch ends, reads each query once'''
+
+        before = self.snapshot()
+        with unittest.mock.patch.object(regroup, 'REGROUP_BATCH_SIZE', 1):
+            self.assertEqual(
+                regroup.regroup(self.db, DEFAULT_RULES, None), 2)
+        self.assertEqual(self.snapshot(), before)
+
+    def test_carry_over(self) -> None:
+
+        '''Test that queries recorded while sweeping are moved to the new
+        groups, and that no transaction is open during the sweep'''
+
+        sweep_queries = regroup.sweep_queries
+
+        def record_after_sweep(
+                *args: Any) -> List[regroup.QueryGroup]:
+            groups = sweep_queries(*args)
+            self.assertFalse(self.db.in_transaction)
+            for (time, value, address) in [
+                    ('09:05:30', 'cdn.example.com', '192.168.1.1'),
+                    ('09:06:00', 'www.example.net', '192.168.1.3')]:
+                epipydb.log_line(
+                    self.db,
+                    'Jan  1 ' + time + ' sys dnsmasq[1]: query[A] ' +
+                    value + ' from ' + address)
+            self.db.commit()
+            return groups
+
+        rules = regroup.GroupingRules(
+            epipydb.QUERY_GROUP_TIME_TOLERANCE,
+            epipydb.QUERY_GROUP_EXTENDED_TIME,
+            5)
+        with unittest.mock.patch.object(
+                regroup, 'sweep_queries', record_after_sweep):
+            self.assertEqual(regroup.regroup(self.db, rules, None), 3)
+
+        (groups, domains) = self.snapshot()
+        self.assertEqual(
+            [(group[1], group[5]) for group in groups],
+            [('192.168.1.1', 5), ('192.168.1.2', 2), ('192.168.1.3', 1)])
+        with contextlib.closing(self.db.cursor()) as cursor:
+            cursor.execute(
+                'SELECT COUNT(*) FROM dnsquery' +
+                ' WHERE group_id NOT IN (SELECT id FROM querygroup)')
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextlib
+import os
+import sqlite3
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'record'))
+import epipydb  # noqa: E402
+
+from typing import *  # noqa: E402
+
+
+LINES = [
+    'Jan  1 09:00:00 sys dnsmasq[1]: query[A] www.example.com' +
+    ' from 192.168.1.1',
+    'Jan  1 09:00:00 sys dnsmasq[1]: query[AAAA] www.example.com' +
+    ' from 192.168.1.1',
+    'Jan  1 09:00:10 sys dnsmasq[1]: query[A] www.example.com' +
+    ' from 192.168.1.1',
+    'Jan  1 09:00:20 sys dnsmasq[1]: query[A] www.example.com' +
+    ' from 192.168.1.1',
+]
+
+
+class RepeatedQueryTest(unittest.TestCase):
+
+    'Check that repeated queries are coalesced only when requested'
+
+    def setUp(self) -> None:
+
+        'Create an empty in-memory database'
+
+        self.db = sqlite3.connect(':memory:')
+        epipydb.create_tables(self.db)
+
+    def tearDown(self) -> None:
+
+        'Discard the database'
+
+        self.db.close()
+
+    def query_rows(self) -> List[Tuple]:
+
+        'Get the type, repeat count and times of every DNS query'
+
+        with contextlib.closing(self.db.cursor()) as cursor:
+            cursor.execute(
+                'SELECT type, repeat_count, time, last_time' +
+                ' FROM dnsquery ORDER BY id')
+            return cursor.fetchall()
+
+    def query_domain_count(self) -> int:
+
+        'Count the subdomains recorded for the DNS queries'
+
+        with contextlib.closing(self.db.cursor()) as cursor:
+            cursor.execute('SELECT COUNT(*) FROM querydomain')
+            return cursor.fetchone()[0]
+
+    def group_row(self) -> Tuple:
+
+        'Get the end time and query count of the only query group'
+
+        with contextlib.closing(self.db.cursor()) as cursor:
+            cursor.execute('SELECT end_time, query_count FROM querygroup')
+            rows = cursor.fetchall()
+
+        self.assertEqual(len(rows), 1)
+        return rows[0]
+
+    def test_separate(self) -> None:
+
+        'Test that each query has its own row by default'
+
+        for line in LINES:
+            epipydb.log_line(self.db, line)
+
+        self.assertEqual(
+            [row[:2] for row in self.query_rows()],
+            [('A', 1), ('AAAA', 1), ('A', 1), ('A', 1)])
+        self.assertEqual(self.query_domain_count(), 8)
+        self.assertEqual(self.group_row()[1], 4)
+
+    def test_coalesce(self) -> None:
+
+        'Test that repeats of a type and value are counted on one row'
+
+        query_ids = [
+            epipydb.log_line(self.db, line, coalesce=True)
+            for line in LINES]
+        self.assertEqual(query_ids[0], query_ids[2])
+        self.assertEqual(query_ids[0], query_ids[3])
+
+        rows = self.query_rows()
+        self.assertEqual(
+            [row[:2] for row in rows], [('A', 3), ('AAAA', 1)])
+        self.assertEqual(rows[0][2][-8:], '09:00:00')
+        self.assertEqual(rows[0][3][-8:], '09:00:20')
+        self.assertEqual(self.query_domain_count(), 4)
+
+        (end_time, query_count) = self.group_row()
+        self.assertEqual(end_time[-8:], '09:00:20')
+        self.assertEqual(query_count, 2)
+
+    def test_upgrade(self) -> None:
+
+        'Test that the columns are added to a database without them'
+
+        db = sqlite3.connect(':memory:')
+        db.execute(
+            'CREATE TABLE dnsquery' +
+            ' (id INTEGER PRIMARY KEY, group_id INTEGER, time,' +
+            '     type, value, host, host_ip)')
+        db.execute(
+            "INSERT INTO dnsquery (id, time) VALUES (1, '2017-01-01')")
+        epipydb.create_tables(db)
+
+        with contextlib.closing(db.cursor()) as cursor:
+            cursor.execute('SELECT repeat_count, last_time FROM dnsquery')
+            self.assertEqual(cursor.fetchall(), [(1, None)])
+
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
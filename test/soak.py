@@ -0,0 +1,674 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''Soak test the recorder, the web back-end and database rotation
+running together against a temporary database.
+
+The recorder runs in its own process, reading dnsmasq log lines from
+a pipe at a target rate.  Several client processes call the WSGI
+application in parallel, as uWSGI workers would, and database rotation
+is run partway through, archiving and discarding old history as the
+cron job does.  Ingest lag, time the recorder spent in database writes
+and commits, dropped lines and request latency are reported for each
+interval of the run, and the exit status is non-zero if any lines were
+dropped, any requests failed, or rotation failed.
+
+The write time includes any wait for the database lock, but SQLite's
+busy handler isn't visible from Python, so the wait can't be told apart
+from the time spent writing.'''
+
+import argparse
+import contextlib
+import datetime
+import multiprocessing
+import multiprocessing.queues
+import os
+import queue
+import random
+import re
+import select
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+
+TOP_PATH = os.path.join(os.path.dirname(__file__), '..')
+sys.path.append(os.path.join(TOP_PATH, 'record'))
+sys.path.append(os.path.join(TOP_PATH, 'serve'))
+
+from typing import *  # noqa: E402
+
+
+#  The uwsgi module only exists inside uWSGI, so the clients stand in
+#  for its asynchronous wait on the recorder's hot tier socket
+UWSGI_WAIT = cast(Dict[str, Any], {})
+
+
+def uwsgi_wait_fd_read(
+        fd: int,
+        timeout: int = 0) -> None:
+
+    'Record the file descriptor a request handler is waiting on'
+
+    UWSGI_WAIT['fd'] = fd
+    UWSGI_WAIT['timeout'] = timeout
+
+
+def uwsgi_ready_fd() -> int:
+
+    'Return the file descriptor which became ready, if any'
+
+    return UWSGI_WAIT.pop('ready', -1)
+
+
+uwsgi_module = types.ModuleType('uwsgi')
+setattr(uwsgi_module, 'wait_fd_read', uwsgi_wait_fd_read)
+setattr(uwsgi_module, 'ready_fd', uwsgi_ready_fd)
+sys.modules.setdefault('uwsgi', uwsgi_module)
+
+import epipydb  # noqa: E402
+import epipyhot  # noqa: E402
+import epipytest  # noqa: E402
+import episyslog  # noqa: E402
+import epipyweb_uwsgi  # noqa: E402
+
+
+SOAK_HOST_COUNT = 20
+SOAK_SITE_COUNT = 500
+
+#  Requests made by the clients, in the proportions they are made
+SOAK_REQUESTS = [
+    '/q/dnsquerygroup?format=columnar&count=25',
+    '/q/dnsquerygroup?format=columnar&count=25',
+    '/q/groupqueries?format=columnar&page=1&count=25',
+    '/q/groupqueries?format=columnar&page=1&count=25',
+    '/q/dnsquerygroup?format=columnar&count=25&search=site{site}',
+    '/q/groupqueries?format=columnar&page=1&count=25&search=site{site}',
+    '/q/export?host=device-{host}',
+]
+
+#  How long ago the history seeded before the run ends, and the age
+#  beyond which rotation discards it
+SOAK_HISTORY_DAYS = 31
+SOAK_ROTATE_DAYS = 30
+
+#  Query values of the lines sent during the run carry their sequence
+SOAK_QUERY_RE = r'^q([0-9]+)\.'
+
+
+class RecorderStats:
+
+    'Counters shared by the recorder process with the harness'
+
+    def __init__(self) -> None:
+
+        self.write_time = multiprocessing.Value('d', 0.0)
+        self.dropped = multiprocessing.Value('i', 0)
+
+
+class TimedCursor(sqlite3.Cursor):
+
+    '''A cursor which adds the time spent in write statements, including
+    any wait for the database lock, to the recorder's write time'''
+
+    write_time = cast(Any, None)
+
+    def execute(self, sql: str, *args: Any) -> 'TimedCursor':
+        if not re.match(r'^\s*(INSERT|UPDATE|DELETE)', sql):
+            return super().execute(sql, *args)
+
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            add_write_time(time.perf_counter() - start)
+
+    def executemany(self, sql: str, *args: Any) -> 'TimedCursor':
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            add_write_time(time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+
+    'A connection which times its writes and commits'
+
+    def cursor(self, factory: Any = None) -> Any:
+        return super().cursor(TimedCursor)
+
+    def execute(self, sql: str, *args: Any) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql: str, *args: Any) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, *args)
+
+    def commit(self) -> None:
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            add_write_time(time.perf_counter() - start)
+
+
+def add_write_time(
+        seconds: float) -> None:
+
+    'Add to the write time counter of the recorder process'
+
+    with TimedCursor.write_time.get_lock():
+        TimedCursor.write_time.value += seconds
+
+
+class Interval:
+
+    'Measurements collected during one reporting interval of the run'
+
+    def __init__(
+            self,
+            elapsed: float) -> None:
+
+        self.elapsed = elapsed
+        self.sent = 0
+        self.stored = 0
+        self.lag = 0.0
+        self.write_time = 0.0
+        self.dropped = 0
+        self.latencies = cast(List[float], [])
+        self.errors = 0
+
+
+def parse_cmdline() -> argparse.Namespace:
+
+    'Parse the commandline, collecting the parameters of the run'
+
+    parser = argparse.ArgumentParser(
+        description='Soak test the epipyweb recorder, web back-end and' +
+        ' database rotation against a temporary database')
+
+    parser.add_argument(
+        '--duration', type=float, default=60.0,
+        help='seconds to run for')
+    parser.add_argument(
+        '--rate', type=float, default=100.0,
+        help='DNS query log lines sent to the recorder per second')
+    parser.add_argument(
+        '--clients', type=int, default=8,
+        help='number of web clients making requests in parallel')
+    parser.add_argument(
+        '--rotate-at', type=float,
+        help='seconds into the run to rotate the database,' +
+        ' by default halfway')
+    parser.add_argument(
+        '--seed-queries', type=int, default=100000,
+        help='DNS queries of history in the database before the run,' +
+        ' about half of which is discarded by rotation')
+    parser.add_argument(
+        '--interval', type=float, default=5.0,
+        help='seconds between reports')
+
+    return parser.parse_args()
+
+
+def patch_paths(
+        temp_dir: str) -> None:
+
+    'Point the recorder and the web back-end at the temporary directory'
+
+    database_path = os.path.join(temp_dir, 'dns.db')
+    hot_socket_path = os.path.join(temp_dir, 'hot.sock')
+
+    epipydb.DATABASE_PATH = database_path
+    epipydb.TEST_LOCK_FILENAME = os.path.join(temp_dir, 'dns.test-lock')
+    epipyhot.HOT_SOCKET_PATH = hot_socket_path
+    epipyweb_uwsgi.DATABASE_PATH = database_path
+
+
+def syslog_time(
+        logtime: datetime.datetime) -> str:
+
+    'Format a time as syslog does'
+
+    return '{} {:2} {}'.format(
+        logtime.strftime('%b'), logtime.day, logtime.strftime('%H:%M:%S'))
+
+
+def run_recorder(
+        temp_dir: str,
+        stdin_fd: int,
+        stdin_write_fd: int,
+        stats: RecorderStats) -> None:
+
+    '''Run the recorder, as rsyslog would, reading log lines from a
+    pipe.  Lines which fail to be stored are counted as dropped.'''
+
+    patch_paths(temp_dir)
+    os.close(stdin_write_fd)
+    os.dup2(stdin_fd, sys.stdin.fileno())
+    sys.argv = ['episyslog.py', '--hot-socket', epipyhot.HOT_SOCKET_PATH]
+
+    TimedCursor.write_time = stats.write_time
+
+    def open_timed_database() -> sqlite3.Connection:
+        db = sqlite3.connect(epipydb.DATABASE_PATH, factory=TimedConnection)
+        epipydb.create_tables(db)
+        return db
+
+    def count_trace(trace: str) -> None:
+        if 'handle_log_line' in trace:
+            with stats.dropped.get_lock():
+                stats.dropped.value += 1
+        sys.stderr.write(
+            'recorder: ' + trace.strip().split('\n')[-1] + '\n')
+
+    epipydb.open_database = open_timed_database
+    episyslog.syslog_trace = count_trace
+
+    episyslog.main()
+
+
+def wait_uwsgi_fd() -> None:
+
+    'Wait on the file descriptor a request handler asked uWSGI to wait on'
+
+    fd = UWSGI_WAIT.pop('fd', None)
+    if fd is None:
+        return
+
+    timeout = UWSGI_WAIT.pop('timeout') or None
+    (readable, _, _) = select.select([fd], [], [], timeout)
+    if readable:
+        UWSGI_WAIT['ready'] = fd
+
+
+def request_page(
+        path: str) -> bool:
+
+    '''Make a request of the WSGI application, reading the response to
+    the end.  Returns False if the request failed.'''
+
+    (path_info, _, query_string) = path.partition('?')
+    env = {
+        'PATH_INFO': path_info,
+        'QUERY_STRING': query_string,
+        'HTTP_ACCEPT_ENCODING': 'gzip',
+    }
+    status = []
+
+    def start_response(
+            response_status: str,
+            headers: Iterable[Tuple[str, str]]) -> None:
+
+        status.append(response_status)
+
+    try:
+        for chunk in epipyweb_uwsgi.application(env, start_response):
+            wait_uwsgi_fd()
+            if chunk.startswith(b'{"error"'):
+                return False
+    except Exception as e:
+        #  uWSGI would respond with an internal server error
+        sys.stderr.write('{}: {}\n'.format(path, e))
+        return False
+
+    return status == ['200 OK']
+
+
+def run_client(
+        temp_dir: str,
+        index: int,
+        end_time: float,
+        results: multiprocessing.queues.Queue) -> None:
+
+    '''Make requests in a loop until the end of the run, as a busy
+    dashboard would, reporting the latency of each'''
+
+    patch_paths(temp_dir)
+    rand = random.Random(index)
+
+    while time.time() < end_time:
+        path = rand.choice(SOAK_REQUESTS).format(
+            site=rand.randrange(SOAK_SITE_COUNT),
+            host=rand.randrange(SOAK_HOST_COUNT))
+
+        start = time.perf_counter()
+        succeeded = request_page(path)
+        seconds = time.perf_counter() - start
+
+        results.put((time.time(), path.split('?')[0], seconds, succeeded))
+
+
+def feed_recorder(
+        stdin_fd: int,
+        rate: float,
+        end_time: float,
+        sent_times: List[float]) -> None:
+
+    '''Write DNS query log lines to the recorder at the target rate,
+    noting when each was due to be sent, until the end of the run'''
+
+    rand = random.Random(0)
+
+    for host_index in range(SOAK_HOST_COUNT):
+        line = '{} sys dnsmasq-dhcp[1]: DHCPACK(eth0) {} {} {}\n'.format(
+            syslog_time(datetime.datetime.now()),
+            '192.168.1.' + str(host_index),
+            '01:01:01:01:01:{:02x}'.format(host_index),
+            'device-' + str(host_index))
+        os.write(stdin_fd, line.encode('utf-8'))
+
+    start = time.time()
+    while True:
+        due = start + len(sent_times) / rate
+        if due >= end_time:
+            break
+
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        line = '{} sys dnsmasq[1]: query[A] q{}.site{}.example.com' \
+            ' from {}\n'.format(
+                syslog_time(datetime.datetime.now()), len(sent_times),
+                rand.randrange(SOAK_SITE_COUNT),
+                '192.168.1.' + str(rand.randrange(SOAK_HOST_COUNT)))
+        sent_times.append(due)
+        os.write(stdin_fd, line.encode('utf-8'))
+
+
+def rotate_database(
+        rotate: types.ModuleType,
+        database_path: str,
+        rotate_time: float,
+        outcome: multiprocessing.queues.Queue) -> None:
+
+    '''Archive and discard old history partway through the run, in its
+    own process, through the same function as the cron job'''
+
+    time.sleep(max(rotate_time - time.time(), 0))
+
+    discard_time = datetime.datetime.now() - \
+        datetime.timedelta(days=SOAK_ROTATE_DAYS)
+
+    archive_dir = os.path.join(os.path.dirname(database_path), 'archive')
+
+    result = cast(Dict[str, Any], {'start': time.time()})
+    try:
+        with contextlib.closing(sqlite3.connect(database_path)) as db:
+            with contextlib.redirect_stdout(None):
+                rotate.rotate(db, discard_time, archive_dir)
+    except sqlite3.Error as e:
+        result['error'] = str(e)
+    result['seconds'] = time.time() - result['start']
+
+    outcome.put(result)
+
+
+def last_stored_sequence(
+        database_path: str) -> int:
+
+    'Find the sequence number of the newest line stored by the recorder'
+
+    with contextlib.closing(sqlite3.connect(database_path)) as db:
+        with contextlib.closing(db.cursor()) as cursor:
+            cursor.execute(
+                'SELECT value FROM dnsquery ORDER BY id DESC LIMIT 1')
+            row = cursor.fetchone()
+
+    if row:
+        match = re.match(SOAK_QUERY_RE, row[0])
+        if match:
+            return int(match.group(1))
+
+    return -1
+
+
+def count_stored_lines(
+        database_path: str) -> int:
+
+    'Count the lines sent during the run which were stored'
+
+    with contextlib.closing(sqlite3.connect(database_path)) as db:
+        with contextlib.closing(db.cursor()) as cursor:
+            cursor.execute(
+                "SELECT COUNT(id) FROM dnsquery WHERE value LIKE 'q%'")
+            return cursor.fetchone()[0]
+
+
+def percentile(
+        values: List[float],
+        fraction: float) -> float:
+
+    'The value below which a fraction of the values fall'
+
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def write_interval(
+        interval: Interval) -> None:
+
+    'Write a line of the report for one interval'
+
+    sys.stdout.write(
+        '{:7.1f} {:7} {:7} {:8.2f} {:9.1f} {:7} {:8} {:6}'
+        ' {:8.1f} {:8.1f} {:8.1f}\n'.format(
+            interval.elapsed, interval.sent, interval.stored, interval.lag,
+            interval.write_time * 1000.0, interval.dropped,
+            len(interval.latencies), interval.errors,
+            percentile(interval.latencies, 0.5) * 1000.0,
+            percentile(interval.latencies, 0.99) * 1000.0,
+            max(interval.latencies, default=0.0) * 1000.0))
+
+
+def write_endpoints(
+        latencies: Dict[str, List[float]],
+        errors: Dict[str, int]) -> None:
+
+    'Write the latency of each endpoint over the whole run'
+
+    sys.stdout.write(
+        '\n{:20} {:8} {:6} {:8} {:8} {:8} {:8}\n'.format(
+            'endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+            'max ms'))
+
+    for endpoint in sorted(latencies):
+        values = latencies[endpoint]
+        sys.stdout.write(
+            '{:20} {:8} {:6} {:8.1f} {:8.1f} {:8.1f} {:8.1f}\n'.format(
+                endpoint, len(values), errors.get(endpoint, 0),
+                percentile(values, 0.5) * 1000.0,
+                percentile(values, 0.95) * 1000.0,
+                percentile(values, 0.99) * 1000.0,
+                max(values, default=0.0) * 1000.0))
+
+
+def soak(
+        args: argparse.Namespace,
+        temp_dir: str) -> bool:
+
+    '''Run the recorder, clients and rotation together, reporting as the
+    run progresses.  Returns True if nothing was dropped or failed.'''
+
+    patch_paths(temp_dir)
+    database_path = epipydb.DATABASE_PATH
+
+    #  History from around the age at which rotation discards it, so
+    #  that rotation has work to do
+    history_start = datetime.datetime.now().replace(microsecond=0) - \
+        datetime.timedelta(days=SOAK_HISTORY_DAYS)
+    history_step = datetime.timedelta(seconds=max(
+        (SOAK_HISTORY_DAYS - SOAK_ROTATE_DAYS) * 2 * 86400 //
+        max(args.seed_queries, 1), 1))
+    with contextlib.closing(epipydb.open_database()) as db:
+        epipytest.seed_database(
+            db, args.seed_queries, SOAK_HOST_COUNT, history_start,
+            history_step, SOAK_SITE_COUNT)
+
+    start_time = time.time()
+    end_time = start_time + args.duration
+    rotate_at = args.rotate_at
+    if rotate_at is None:
+        rotate_at = args.duration / 2
+
+    stats = RecorderStats()
+    (stdin_read_fd, stdin_write_fd) = os.pipe()
+    recorder = multiprocessing.Process(
+        target=run_recorder,
+        args=(temp_dir, stdin_read_fd, stdin_write_fd, stats),
+        daemon=True)
+    recorder.start()
+    os.close(stdin_read_fd)
+
+    results = cast(multiprocessing.queues.Queue, multiprocessing.Queue())
+    clients = [
+        multiprocessing.Process(
+            target=run_client, args=(temp_dir, index, end_time, results),
+            daemon=True)
+        for index in range(args.clients)]
+    for client in clients:
+        client.start()
+
+    sent_times = cast(List[float], [])
+    feeder = threading.Thread(
+        target=feed_recorder,
+        args=(stdin_write_fd, args.rate, end_time, sent_times))
+    feeder.start()
+
+    rotation_outcome = cast(
+        multiprocessing.queues.Queue, multiprocessing.Queue())
+    rotator = multiprocessing.Process(
+        target=rotate_database,
+        args=(epipytest.load_rotate_script(), database_path,
+              start_time + rotate_at, rotation_outcome),
+        daemon=True)
+    rotator.start()
+
+    sys.stdout.write(
+        '{:>7} {:>7} {:>7} {:>8} {:>9} {:>7} {:>8} {:>6}'
+        ' {:>8} {:>8} {:>8}\n'.format(
+            'time s', 'sent', 'stored', 'lag s', 'write ms', 'dropped',
+            'requests', 'errors', 'p50 ms', 'p99 ms', 'max ms'))
+
+    latencies = cast(Dict[str, List[float]], {})
+    errors = cast(Dict[str, int], {})
+    total_errors = 0
+    last_write_time = 0.0
+    last_dropped = 0
+
+    finishing = False
+    while not finishing:
+        interval_end = time.time() + args.interval
+        finishing = interval_end >= end_time
+        if finishing:
+            feeder.join()
+            os.close(stdin_write_fd)
+
+        interval = Interval(time.time() - start_time)
+        #  At the end of the run, wait for the clients to finish their
+        #  last requests
+        while time.time() < interval_end or (finishing and (
+                any(client.is_alive() for client in clients) or
+                not results.empty())):
+            try:
+                result = results.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            (_, endpoint, seconds, succeeded) = result
+            interval.latencies.append(seconds)
+            latencies.setdefault(endpoint, []).append(seconds)
+            if not succeeded:
+                interval.errors += 1
+                errors[endpoint] = errors.get(endpoint, 0) + 1
+
+        if finishing:
+            for client in clients:
+                client.join()
+            recorder.join()
+
+        interval.elapsed = time.time() - start_time
+        interval.sent = len(sent_times)
+        interval.stored = last_stored_sequence(database_path) + 1
+
+        if interval.stored < len(sent_times):
+            interval.lag = time.time() - sent_times[interval.stored]
+
+        interval.write_time = stats.write_time.value - last_write_time
+        last_write_time = stats.write_time.value
+        interval.dropped = stats.dropped.value - last_dropped
+        last_dropped = stats.dropped.value
+
+        total_errors += interval.errors
+        write_interval(interval)
+
+    rotator.join()
+    rotation = cast(Dict[str, Any], {})
+    with contextlib.suppress(queue.Empty):
+        rotation = rotation_outcome.get(timeout=1.0)
+    write_endpoints(latencies, errors)
+
+    stored = count_stored_lines(database_path)
+    sys.stdout.write('\nLines sent {}, stored {}, dropped {}\n'.format(
+        len(sent_times), stored, len(sent_times) - stored))
+    sys.stdout.write('Recorder write time {:.1f} ms in total\n'.format(
+        stats.write_time.value * 1000.0))
+
+    if 'error' in rotation:
+        sys.stdout.write('Rotation failed after {:.1f} s: {}\n'.format(
+            rotation['seconds'], rotation['error']))
+    elif 'seconds' in rotation:
+        sys.stdout.write('Rotation at {:.1f} s took {:.1f} s\n'.format(
+            rotation['start'] - start_time, rotation['seconds']))
+    else:
+        sys.stdout.write('Rotation did not run\n')
+
+    return stored == len(sent_times) and total_errors == 0 and \
+        'seconds' in rotation and 'error' not in rotation
+
+
+def main() -> None:
+
+    'Soak test against a temporary database, failing if anything failed'
+
+    args = parse_cmdline()
+
+    #  The recorder reads from a pipe inherited from the harness
+    multiprocessing.set_start_method('fork')
+
+    temp_dir = tempfile.mkdtemp(prefix='epipywebsoak')
+    try:
+        passed = soak(args, temp_dir)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
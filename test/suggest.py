@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'record'))
+import epipydb  # noqa: E402
+import epipysuggest  # noqa: E402
+
+from typing import *  # noqa: E402
+
+
+class DomainIndexTest(unittest.TestCase):
+
+    'Check suggestions from the in-memory index of queried domains'
+
+    def setUp(self) -> None:
+
+        'Create an empty database and index'
+
+        self.temp_dir = tempfile.mkdtemp(prefix='epipywebsuggest')
+        self.database_path = os.path.join(self.temp_dir, 'dns.db')
+        self.db = sqlite3.connect(self.database_path)
+        epipydb.create_tables(self.db)
+        self.index = epipysuggest.DomainIndex()
+
+        #  Refresh on every call, rather than at most every few seconds
+        patcher = unittest.mock.patch.object(
+            epipysuggest, 'SUGGEST_REFRESH_SECONDS', 0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+
+        'Close and remove the database'
+
+        self.db.close()
+        shutil.rmtree(self.temp_dir)
+
+    def log_queries(
+            self,
+            values: List[str]) -> None:
+
+        'Record a query for each of a list of domains'
+
+        for value in values:
+            epipydb.log_dns_query(
+                self.db, '2017-01-01T08:00:00', 'A', value, '192.168.1.2')
+        self.db.commit()
+
+    def suggested(
+            self,
+            prefix: str,
+            count: int = 10) -> List[str]:
+
+        'Refresh the index and list the domains suggested for a prefix'
+
+        self.index.refresh(
+            self.db, epipydb.database_signature(self.database_path))
+        return [
+            suggestion['domain']
+            for suggestion in self.index.suggest(prefix, count)
+        ]
+
+    def test_popularity(self) -> None:
+
+        'Test that the most frequently queried domains are suggested first'
+
+        self.log_queries(
+            ['www.example.com', 'example.org', 'example.org',
+             'mail.example.com', 'Example.org', 'other.net'])
+
+        self.assertEqual(
+            self.suggested('exa'),
+            ['example.org', 'example.com'])
+        self.assertEqual(self.suggested('exa', 1), ['example.org'])
+        self.assertEqual(
+            self.suggested('www'), ['www.example.com'])
+        self.assertEqual(self.suggested('z'), [])
+
+    def test_incremental(self) -> None:
+
+        'Test that only the rows recorded since the last refresh are read'
+
+        self.log_queries(['www.example.com'])
+        self.assertEqual(self.suggested('ex'), ['example.com'])
+
+        self.log_queries(['example.net', 'example.net'])
+        with unittest.mock.patch.object(
+                self.index, 'start_build',
+                side_effect=AssertionError('rebuilt')):
+            self.assertEqual(
+                self.suggested('ex'), ['example.net', 'example.com'])
+
+            #  Without a change to the database, nothing is read
+            with unittest.mock.patch.object(
+                    self.index, 'newest_rowid',
+                    side_effect=AssertionError('read')):
+                self.assertEqual(
+                    self.suggested('ex'), ['example.net', 'example.com'])
+
+        self.assertEqual(self.index.counts['example.net'], 2)
+        self.assertEqual(self.index.counts['example.com'], 1)
+
+    def test_replaced(self) -> None:
+
+        'Test that the index is rebuilt when the newest row seen is gone'
+
+        self.log_queries(['www.example.com', 'example.org'])
+        self.assertEqual(
+            self.suggested('example'), ['example.com', 'example.org'])
+
+        self.db.execute('DELETE FROM querydomain')
+        self.db.commit()
+        self.log_queries(['example.net'])
+
+        self.assertEqual(self.suggested('example'), ['example.net'])
+
+    def test_chunks(self) -> None:
+
+        '''Test that the index is built a chunk of domains per refresh,
+        and that nothing is suggested until it is built'''
+
+        self.log_queries(['site{}.com'.format(i) for i in range(5)])
+        self.log_queries(['Site1.com', 'site3.com'])
+
+        with unittest.mock.patch.object(
+                epipysuggest, 'SUGGEST_BUILD_CHUNK_DOMAINS', 2):
+            self.assertEqual(self.suggested('site'), [])
+            self.assertEqual(self.suggested('site'), [])
+
+            #  Rows recorded while building are counted once it is built
+            self.log_queries(['site5.com'])
+            self.assertEqual(len(self.suggested('site')), 5)
+            self.assertEqual(len(self.suggested('site')), 6)
+
+        self.assertEqual(self.index.counts['site1.com'], 2)
+        self.assertEqual(self.index.counts['site3.com'], 2)
+        self.assertEqual(self.index.counts['site5.com'], 1)
+
+    def test_rotated(self) -> None:
+
+        '''Test that the index isn't built again when only the oldest rows
+        are discarded, and that the rows recorded since are still added'''
+
+        self.log_queries(['example.org', 'example.org', 'example.com'])
+        self.assertEqual(
+            self.suggested('example'), ['example.org', 'example.com'])
+
+        self.db.execute('DELETE FROM querydomain WHERE rowid <= 2')
+        self.db.commit()
+        self.log_queries(['example.com', 'example.com'])
+
+        with unittest.mock.patch.object(
+                self.index, 'start_build',
+                side_effect=AssertionError('rebuilt')):
+            self.assertEqual(
+                self.suggested('example'), ['example.com', 'example.org'])
+
+        self.assertEqual(
+            self.index.counts, {'example.org': 2, 'example.com': 3})
+
+    def test_file_replaced(self) -> None:
+
+        'Test that the index is built again when the database is replaced'
+
+        self.log_queries(['example.org'])
+        self.assertEqual(self.suggested('example'), ['example.org'])
+
+        #  A new file with more rows than the old, as from a restore
+        new_path = os.path.join(self.temp_dir, 'new.db')
+        with contextlib.closing(sqlite3.connect(new_path)) as new_db:
+            epipydb.create_tables(new_db)
+            for _ in range(3):
+                epipydb.log_dns_query(
+                    new_db, '2017-01-01T08:00:00', 'A', 'example.net',
+                    '192.168.1.2')
+            new_db.commit()
+        self.db.close()
+        os.rename(new_path, self.database_path)
+        self.db = sqlite3.connect(self.database_path)
+
+        self.assertEqual(self.suggested('example'), ['example.net'])
+
+    def test_memory_budget(self) -> None:
+
+        'Test that the least popular domains are dropped beyond the budget'
+
+        self.index.memory_budget = 4 * (
+            epipysuggest.SUGGEST_ENTRY_OVERHEAD + len('site0.com'))
+
+        self.log_queries(['site0.com', 'site0.com', 'site1.com'])
+        self.log_queries(['site{}.com'.format(i) for i in range(2, 6)])
+
+        self.assertLessEqual(self.index.size, self.index.memory_budget)
+        self.assertEqual(self.suggested('site', 1), ['site0.com'])
+        self.assertEqual(
+            sorted(self.index.counts), self.index.domains)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+#
+#    epipyweb - Epipylon web user interface
+#    Copyright (C) 2017  Matt Kimball
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import datetime
+import os
+import sqlite3
+import sys
+import unittest
+import unittest.mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'record'))
+import epipydb  # noqa: E402
+import epipytimeline  # noqa: E402
+
+from typing import *  # noqa: E402
+
+
+START_TIME = datetime.datetime(2017, 1, 1, 8, 0, 0)
+START_EPOCH = 1483257600
+NOW_EPOCH = START_EPOCH + 3600
+
+
+class TimelineTest(unittest.TestCase):
+
+    'Check counting the queries of a host in buckets of time'
+
+    def setUp(self) -> None:
+
+        'Record queries for two hosts in an in-memory database'
+
+        self.db = sqlite3.connect(':memory:')
+        epipydb.create_tables(self.db)
+
+        for (seconds, value, host) in [
+                (0, 'www.example.com', '192.168.1.2'),
+                (10, 'cdn.example.com', '192.168.1.2'),
+                (59, 'other.org', '192.168.1.2'),
+                (60, 'www.example.com', '192.168.1.2'),
+                (65, 'www.example.com', '192.168.1.3'),
+                (250, 'ads.tracker.net', '192.168.1.2'),
+                (3500, 'www.example.com', '192.168.1.2')]:
+            isotime = (
+                START_TIME + datetime.timedelta(seconds=seconds)).isoformat()
+            epipydb.log_dns_query(self.db, isotime, 'A', value, host)
+
+        #  A query repeated twice more, coalesced onto one row
+        for _ in range(3):
+            epipydb.log_dns_query(
+                self.db, (START_TIME + datetime.timedelta(
+                    seconds=130)).isoformat(),
+                'A', 'repeated.org', '192.168.1.2', coalesce=True)
+        self.db.commit()
+
+        self.cache = epipytimeline.TimelineCache()
+
+    def tearDown(self) -> None:
+
+        'Close the database'
+
+        self.db.close()
+
+    def timeline(
+            self,
+            since: int,
+            until: int,
+            bucket: int,
+            by_domain: bool = False,
+            now: int = NOW_EPOCH) -> Tuple[int, List]:
+
+        'Count the queries of the first host, seconds after the start'
+
+        return self.cache.timeline(
+            self.db, None, '192.168.1.2', START_EPOCH + since,
+            START_EPOCH + until, bucket, now, by_domain)
+
+    def check_both(
+            self,
+            run: Callable[[], Any]) -> Any:
+
+        'Run with NumPy, if installed, and without, expecting the same'
+
+        result = run()
+        if epipytimeline.numpy is not None:
+            self.cache = epipytimeline.TimelineCache()
+            with unittest.mock.patch.object(epipytimeline, 'numpy', None):
+                self.assertEqual(run(), result)
+
+        return result
+
+    def test_totals(self) -> None:
+
+        'Test counting the queries of a host in each bucket'
+
+        (start, counts) = self.check_both(
+            lambda: self.timeline(0, 300, 60))
+        self.assertEqual(start, START_EPOCH)
+        self.assertEqual(counts, [3, 1, 3, 0, 1])
+
+        #  Buckets are aligned to multiples of their size
+        (start, counts) = self.check_both(
+            lambda: self.timeline(30, 150, 60))
+        self.assertEqual(start, START_EPOCH)
+        self.assertEqual(counts, [3, 1, 3])
+
+    def test_domains(self) -> None:
+
+        'Test counting the queries of each domain, and the top domains'
+
+        (_, buckets) = self.check_both(
+            lambda: self.timeline(0, 120, 60, True))
+        self.assertEqual(
+            buckets, [{'example.com': 2, 'other.org': 1}, {'example.com': 1}])
+
+        (_, buckets) = self.timeline(0, 300, 60, True)
+        split = epipytimeline.split_top_domains(buckets, 1)
+        self.assertEqual(split['counts'], [3, 1, 3, 0, 1])
+        self.assertEqual(
+            split['domains'],
+            [{'domain': 'example.com', 'counts': [2, 1, 0, 0, 0]}])
+        self.assertEqual(split['other'], [1, 0, 3, 0, 1])
+
+    def test_cache(self) -> None:
+
+        '''Test that only the buckets which ended less than an hour ago
+        are read again'''
+
+        now = NOW_EPOCH + 3600
+        self.timeline(0, 3600 + 120, 60, now=now)
+
+        read_buckets = epipytimeline.read_buckets
+        reads = []
+
+        def traced_read_buckets(*args: Any) -> Any:
+            reads.append(args[2:5])
+            return read_buckets(*args)
+
+        with unittest.mock.patch.object(
+                epipytimeline, 'read_buckets', traced_read_buckets):
+            (_, counts) = self.timeline(0, 3600 + 120, 60, now=now)
+
+        self.assertEqual(reads, [(NOW_EPOCH, 60, 2)])
+        self.assertEqual(counts[:5], [3, 1, 3, 0, 1])
+        self.assertEqual(counts[58], 1)
+
+    def test_late_queries(self) -> None:
+
+        '''Test that the cached buckets of queries stored late are read
+        again, and that those of queries stored on time are kept'''
+
+        now = NOW_EPOCH + 3600
+        (_, counts) = self.timeline(0, 300, 60, now=now)
+        self.assertEqual(counts, [3, 1, 3, 0, 1])
+        self.assertEqual(len(self.cache.buckets), 5)
+
+        #  Recorded on time, and for another host
+        for (seconds, host) in [
+                (7200, '192.168.1.2'), (100, '192.168.1.3')]:
+            epipydb.log_dns_query(
+                self.db, (START_TIME + datetime.timedelta(
+                    seconds=seconds)).isoformat(),
+                'A', 'www.example.com', host)
+        self.db.commit()
+        self.timeline(0, 300, 60, now=now)
+        self.assertEqual(len(self.cache.buckets), 5)
+
+        #  Ingested hours late, into the third bucket
+        epipydb.log_dns_query(
+            self.db, (START_TIME + datetime.timedelta(
+                seconds=150)).isoformat(),
+            'A', 'late.example.com', '192.168.1.2')
+        self.db.commit()
+        (_, counts) = self.timeline(0, 300, 60, now=now)
+        self.assertEqual(counts, [3, 1, 4, 0, 1])
+
+        #  Rotation discards the oldest queries, and the whole cache
+        self.db.execute(
+            'DELETE FROM dnsquery WHERE id = (SELECT MIN(id) FROM dnsquery)')
+        self.db.commit()
+        (_, counts) = self.timeline(0, 300, 60, now=now)
+        self.assertEqual(counts, [2, 1, 4, 0, 1])
+
+    def test_spread_repeats(self) -> None:
+
+        '''Test that the repeats of a coalesced query are spread from its
+        first time to its last, including into buckets read before it
+        was repeated again'''
+
+        def log_repeat(seconds: int) -> None:
+            epipydb.log_dns_query(
+                self.db, (START_TIME + datetime.timedelta(
+                    seconds=seconds)).isoformat(),
+                'A', 'spread.org', '192.168.1.4', coalesce=True)
+            self.db.commit()
+
+        def timeline(now: int) -> List:
+            return self.check_both(lambda: self.cache.timeline(
+                self.db, None, '192.168.1.4', START_EPOCH,
+                START_EPOCH + 600, 60, START_EPOCH + now, False))[1]
+
+        log_repeat(0)
+        log_repeat(0)
+        self.assertEqual(timeline(120), [2, 0, 0, 0, 0, 0, 0, 0, 0, 0])
+
+        #  Three repeats from 0 to 300 seconds, one at 150 seconds
+        log_repeat(300)
+        self.assertEqual(timeline(360), [1, 0, 1, 0, 0, 1, 0, 0, 0, 0])
+        self.assertEqual(
+            sum(timeline(360 + epipytimeline.TIMELINE_OPEN_SECONDS)), 3)
+
+        #  Only the buckets ending an hour or more ago are cached
+        self.assertEqual(len(self.cache.buckets), 6)
+
+        (_, buckets) = self.check_both(lambda: self.cache.timeline(
+            self.db, None, '192.168.1.4', START_EPOCH + 120,
+            START_EPOCH + 240, 60, START_EPOCH + 360, True))
+        self.assertEqual(buckets, [{'spread.org': 1}, {}])
+
+    def test_too_many_buckets(self) -> None:
+
+        'Test that a range with too many buckets is refused'
+
+        with self.assertRaises(ValueError):
+            self.timeline(0, 86400 * 30, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
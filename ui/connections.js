@@ -124,15 +124,81 @@ function format_local_time(
 }
 
 
+/*  Convert seconds since the epoch to an ISO 8601 time string  */
+function epoch_to_isotime(
+    epoch
+) {
+    return new Date(epoch * 1000).toISOString().substr(0, 19);
+}
+
+
+/*
+    Decode a list of rows from the columnar response format, where
+    each column is sent as an array.  Lists of rows in the default
+    response format are returned unchanged.
+*/
+function decode_columnar(
+    columns
+) {
+    var rows = [],
+        column_names,
+        column,
+        encoding,
+        values,
+        value,
+        previous,
+        i,
+        j;
+
+    if (columns.format !== "columnar") {
+        return columns;
+    }
+
+    for (i = 0; i < columns.length; i += 1) {
+        rows.push({});
+    }
+
+    column_names = Object.keys(columns.encoding);
+    for (j = 0; j < column_names.length; j += 1) {
+        column = column_names[j];
+        encoding = columns.encoding[column];
+        values = columns[column];
+        previous = 0;
+
+        for (i = 0; i < columns.length; i += 1) {
+            value = values[i];
+
+            if (encoding === "delta" || encoding === "delta_time") {
+                previous += value;
+                value = previous;
+            }
+
+            if (encoding === "delta_time") {
+                value = epoch_to_isotime(value);
+            } else if (encoding === "dictionary") {
+                value = columns[column + "_dictionary"][value];
+            }
+
+            rows[i][column] = value;
+        }
+    }
+
+    return rows;
+}
+
+
 /*
     Create an object for managing retrieving additional connections
     in a connection group, either in response to a user clicking on 
     "more connections" or for retrieving search results automatically.
+    The connections are taken from the details prefetched for the whole
+    page when available.
 */
 function create_connection_retriever(
     connection_div,
     group_id,
-    search_value
+    search_value,
+    page_details
 ) {
     var self,
         full_expand = false,
@@ -177,6 +243,11 @@ function create_connection_retriever(
                     search_value,
                     query.value
                 );
+                if (query.repeat_count > 1) {
+                    value_div.append($("<span>", {
+                        "class": "additional-connection-repeat"
+                    }).text(" \u00d7" + query.repeat_count));
+                }
                 connection_div.append(value_div);
 
                 time = format_local_time(query.time);
@@ -191,26 +262,26 @@ function create_connection_retriever(
         }
     }
 
-    /*  Retrieve the JSON with the additional connections in the group  */
-    function get_connections() {
-        var url,
-            additional_queries;
+    /*  Replace the connection list with the queries of the group  */
+    function show_queries(
+        queries
+    ) {
+        retrieve_in_progress = false;
 
-        if (retrieve_in_progress) {
-            return;
-        }
+        connection_div.empty();
 
-        url = "/q/groupqueries?id=" + group_id;
-        retrieve_in_progress = true;
+        fill_expanded_connections(decode_columnar(queries).slice(1));
+    }
 
-        /*jslint unparam: true */
-        $.getJSON(url).done(function (response) {
-            retrieve_in_progress = false;
+    /*  Request the JSON with the DNS queries of this group alone  */
+    function request_group_queries() {
+        var url;
 
-            connection_div.empty();
+        url = "/q/groupqueries?format=columnar&id=" + group_id;
 
-            additional_queries = response.queries.slice(1);
-            fill_expanded_connections(additional_queries);
+        /*jslint unparam: true */
+        $.getJSON(url).done(function (response) {
+            show_queries(response.queries);
         }).fail(function (xhr, status, error) {
             var err_str;
 
@@ -223,6 +294,29 @@ function create_connection_retriever(
         });
     }
 
+    /*  Retrieve the JSON with the additional connections in the group  */
+    function get_connections() {
+        if (retrieve_in_progress) {
+            return;
+        }
+
+        retrieve_in_progress = true;
+
+        if (page_details === undefined) {
+            request_group_queries();
+            return;
+        }
+
+        page_details.done(function (response) {
+            if (response.groups !== undefined &&
+                    response.groups[group_id] !== undefined) {
+                show_queries(response.groups[group_id].queries);
+            } else {
+                request_group_queries();
+            }
+        }).fail(request_group_queries);
+    }
+
     /*  Expand a "X more connections" list by requesting the DNS queries  */
     function expand_connections() {
         full_expand = true;
@@ -265,11 +359,13 @@ function create_connection_retriever(
 /*  Append a row of connection info to the connections list  */
 function append_connection_row(
     search_value,
+    page_details,
     id,
     value,
     time,
     host,
-    query_count
+    query_count,
+    category
 ) {
     var connection_retriever,
         value_div,
@@ -294,6 +390,13 @@ function append_connection_row(
         "class": "connection-host"
     }).text(" from " + host));
 
+    if (category) {
+        info_div.append($("<a>", {
+            "class": "connection-category",
+            "href": "/connections.html?category=" + category
+        }).text(category));
+    }
+
     if (query_count > 1) {
         more_div = $("<div>", {
             "class": "more-connections"
@@ -302,7 +405,8 @@ function append_connection_row(
         connection_retriever = create_connection_retriever(
             more_div,
             id,
-            search_value
+            search_value,
+            page_details
         );
 
         connection_retriever.append_more_link(query_count - 1);
@@ -325,14 +429,19 @@ function append_page_links(
     first_id,
     last_id
 ) {
-    var search_value,
-        href;
+    var kept_arguments = ["search", "category", "archive", "since", "until"],
+        value,
+        href,
+        i;
 
-    search_value = get_query_argument("search");
-    if (search_value !== undefined) {
-        href = '/connections.html?search=' + search_value + '&';
-    } else {
-        href = '/connections.html?';
+    href = '/connections.html?';
+
+    /*  Page through the same search, of the database or the archive  */
+    for (i = 0; i < kept_arguments.length; i += 1) {
+        value = get_query_argument(kept_arguments[i]);
+        if (value !== undefined) {
+            href += kept_arguments[i] + '=' + value + '&';
+        }
     }
 
     if (previous_page_present) {
@@ -359,7 +468,8 @@ function append_page_links(
 
 /*  Fill the connections list from the JSON list of querygroups  */
 function fill_connections(
-    response
+    response,
+    page_details
 ) {
     var groups,
         group,
@@ -369,7 +479,7 @@ function fill_connections(
         last_id,
         i;
 
-    groups = response.groups;
+    groups = decode_columnar(response.groups);
 
     if (groups.length === 0) {
         $("#page-links").text("No connections found");
@@ -388,11 +498,13 @@ function fill_connections(
 
         append_connection_row(
             search_value,
+            page_details,
             group.id,
             group.value,
             time,
             group.host,
-            group.query_count
+            group.query_count,
+            group.category
         );
     }
 
@@ -410,12 +522,21 @@ function fill_connections(
 }
 
 
-/*  Request JSON with the connections and fill the page with the results  */
+/*
+    Request JSON with the connections and fill the page with the results.
+    The DNS queries of all the groups on the page are requested at the
+    same time, in a single request, for expanding the groups.
+*/
 function fill_connections_from_url(
-    url
+    url,
+    details_url
 ) {
+    var page_details;
+
     $("#connections").text("Looking up connections...");
 
+    page_details = $.getJSON(details_url);
+
     /*jslint unparam: true */
     $.getJSON(url).done(function (response) {
         $("#connections").empty();
@@ -423,7 +544,7 @@ function fill_connections_from_url(
         if (response.error !== undefined) {
             $("#connections").text(response.error);
         } else if (response.groups !== undefined) {
-            fill_connections(response);
+            fill_connections(response, page_details);
         }
     }).fail(function (xhr, status, error) {
         var err_str;
@@ -439,13 +560,16 @@ function fill_connections_from_url(
 /*  When the document loads, retrieve and display DNS connections  */
 function show_connections() {
     $(document).ready(function () {
-        var dnsquery_url;
+        var dnsquery_url,
+            details_url;
 
-        dnsquery_url = "/q/dnsquerygroup?count=25";
+        dnsquery_url = "/q/dnsquerygroup?format=columnar&count=25";
+        details_url = "/q/groupqueries?format=columnar&page=1&count=25";
         if (location.search.length > 0) {
             dnsquery_url += '&' + location.search.substr(1);
+            details_url += '&' + location.search.substr(1);
         }
 
-        fill_connections_from_url(dnsquery_url);
+        fill_connections_from_url(dnsquery_url, details_url);
     });
 }
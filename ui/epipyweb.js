@@ -69,6 +69,39 @@ function on_search(
 }
 
 
+/*  Offer the most frequently queried domains starting with the
+    partly typed search term  */
+function on_search_input() {
+    var prefix = $("#search-input").get(0).value,
+        url;
+
+    if (!prefix.length) {
+        $("#search-suggestions").empty();
+        return;
+    }
+
+    url = "/q/suggest?prefix=" + encodeURIComponent(prefix);
+    $.getJSON(url).done(function (response) {
+        var datalist = $("#search-suggestions"),
+            i;
+
+        /*  Ignore the response if more has been typed since  */
+        if (!response.suggestions ||
+                $("#search-input").get(0).value !== prefix) {
+            return;
+        }
+
+        datalist.empty();
+        for (i = 0; i < response.suggestions.length; i += 1) {
+            datalist.append($("<option>").attr(
+                "value",
+                response.suggestions[i].domain
+            ));
+        }
+    });
+}
+
+
 /*  Attach event handlers to UI elements, such as the search bar  */
 function attach_ui_events() {
     var search_value;
@@ -82,7 +115,7 @@ function attach_ui_events() {
         if (event.keyCode === '\r'.charCodeAt(0)) {
             on_search();
         }
-    }).focus();
+    }).on("input", on_search_input).focus();
 
     $("#search-button").click(on_search);
 }